@@ -2,26 +2,38 @@ import db
 import h3
 from acl.acl import ACL
 from acl import get_acl
-import json
+from fastapi import HTTPException
+import geometry_cache
+import executor
+import metrics
+import snapshot
 
-def serialize_geometry(row):
-    return {
-        "zone_id": row["zone_id"],
-        "geojson": json.loads(row["area"]),
-        "municipality_code": row["municipality"],
-        "stats_ref": row["stats_ref"]
-    }
+# Returns the encoded geometries per municipality, sorted by municipality code.
+async def get_accessible_geometries(municipalities: list[str], zoom: int | None = None):
+    municipalities = sorted(municipalities)
+    bundles = {municipality: geometry_cache.get(municipality, zoom) for municipality in municipalities}
+    missing = [municipality for municipality, bundle in bundles.items() if bundle is None]
+    if len(missing) > 0:
+        rows = await db.get_accessible_geometries_with_geojson(missing)
+        if rows is None:
+            raise HTTPException(500, "geometries could not be loaded")
+        zones = await executor.run(geometry_cache.encode_zones, geometry_cache.zone_values(rows), zoom, size=geometry_cache.job_size(rows, zoom))
+        zones_per_municipality = {municipality: [] for municipality in missing}
+        for row, zone in zip(rows, zones):
+            zones_per_municipality[row["municipality"]].append(zone)
+        for municipality, municipality_zones in zones_per_municipality.items():
+            bundles[municipality] = geometry_cache.store(municipality, zoom, municipality_zones)
+    return [bundles[municipality] for municipality in municipalities]
 
-def get_accessible_geometries(municipalities: list[str]):
-    result = db.get_accessible_geometries_with_geojson(municipalities)
-    result = list(map(serialize_geometry, result))
-    return result
-
-def check_if_user_has_access_to_geometries(acl: ACL, requested_geometries: list[str]):
+@metrics.timed("check_if_user_has_access_to_geometries")
+async def check_if_user_has_access_to_geometries(acl: ACL, requested_geometries: list[str]):
     if acl.is_admin:
         return True
-    municipalities = get_acl.get_accessible_municipalities(acl)
-    result = db.get_accessible_geometries(municipalities=municipalities)
+    municipalities = await get_acl.get_accessible_municipalities(acl)
+    if snapshot.current is not None:
+        accessible_municipalities = set(municipalities)
+        return all(municipality in accessible_municipalities for municipality in snapshot.current.municipalities_of(requested_geometries))
+    result = await db.get_accessible_geometries(municipalities=municipalities)
     accessible_stats_refs = set(map(lambda row: row["stats_ref"], result))
     requested_geometries_set = set(requested_geometries)
     print(accessible_stats_refs)
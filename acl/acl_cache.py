@@ -0,0 +1,43 @@
+from cache import TTLCache
+from db_helper import db_helper
+import psycopg
+import asyncio
+import os
+
+acl_cache = TTLCache(
+    max_size=int(os.getenv("ACL_CACHE_MAX_SIZE", "1000")),
+    ttl=float(os.getenv("ACL_CACHE_TTL", "300"))
+)
+municipalities_cache = TTLCache(
+    max_size=int(os.getenv("ACL_CACHE_MAX_SIZE", "1000")),
+    ttl=float(os.getenv("ACL_CACHE_TTL", "300"))
+)
+
+def invalidate(user_id: str | None = None):
+    if user_id is None:
+        acl_cache.clear()
+        municipalities_cache.clear()
+        return
+    acl_cache.invalidate(user_id)
+    municipalities_cache.invalidate(user_id)
+
+def stats():
+    return {
+        "acl": acl_cache.stats(),
+        "accessible_municipalities": municipalities_cache.stats()
+    }
+
+# Invalidations are received with NOTIFY <channel>, '<user_id>'.
+# An empty payload clears the cache for all users.
+async def listen_for_invalidations(channel: str):
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(db_helper.conn_str, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {channel};")
+                async for notify in conn.notifies():
+                    invalidate(notify.payload or None)
+        except Exception as e:
+            print(e)
+        # Notifications could have been missed while disconnected.
+        invalidate()
+        await asyncio.sleep(5)
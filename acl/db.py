@@ -1,23 +1,23 @@
 from db_helper import db_helper
 
-def get_organisation_and_privileges(username):
-    stmt = """
-        SELECT user_id, organisation_id, privileges, type_of_organisation
-        FROM user_account
-        JOIN organisation
-        USING (organisation_id)
-        WHERE user_id = %(user_id)s;
-    """
-    with db_helper.get_resource() as (cur, conn):
+organisation_and_privileges_statement = db_helper.register("get_organisation_and_privileges", """
+    SELECT user_id, organisation_id, privileges, type_of_organisation
+    FROM user_account
+    JOIN organisation
+    USING (organisation_id)
+    WHERE user_id = %(user_id)s
+""")
+
+async def get_organisation_and_privileges(username):
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute(stmt, {"user_id": username})
-            return cur.fetchone()
+            await db_helper.execute(cur, organisation_and_privileges_statement, {"user_id": username})
+            return await cur.fetchone()
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
 
-def get_accessible_municipalities(username):
-    stmt = """
+accessible_municipalities_statement = db_helper.register("get_accessible_municipalities", """
     SELECT DISTINCT(UNNEST(data_owner_of_municipalities)) as municipality_code
     FROM organisation
     WHERE 
@@ -47,12 +47,14 @@ def get_accessible_municipalities(username):
         JOIN organisation
         USING(organisation_id)
         WHERE user_id = %(user_id)s
-    );    
-    """
-    with db_helper.get_resource() as (cur, conn):
+    )
+""")
+
+async def get_accessible_municipalities(username):
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute(stmt, {"user_id": username})
-            return cur.fetchall()
+            await db_helper.execute(cur, accessible_municipalities_statement, {"user_id": username})
+            return await cur.fetchall()
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
\ No newline at end of file
@@ -1,8 +1,11 @@
 import jwt
 from acl import acl, db
-from acl.acl import ACL
+from acl.acl import ACL, PrivilegesEnum
+from acl.acl_cache import acl_cache, municipalities_cache
+import metrics
 
-def get_access(request):
+@metrics.timed("get_acl.get_access")
+async def get_access(request):
     if not request.headers.get('Authorization'):
         return None
     encoded_token = request.headers.get('Authorization')
@@ -12,22 +15,31 @@ def get_access(request):
     result = jwt.decode(encoded_token, options={"verify_signature": False})
 
     # Get ACL and return result
-    return get_acl_for_user_id(result["email"])
+    return await get_acl_for_user_id(result["email"])
     
-def get_acl_for_user_id(user_id: str):
-    result = db.get_organisation_and_privileges(user_id)
+async def get_acl_for_user_id(user_id: str):
+    cached_acl = acl_cache.get(user_id)
+    if cached_acl:
+        return cached_acl
+    result = await db.get_organisation_and_privileges(user_id)
     if result == None:
         return None
-    return create_acl(result)
+    user_acl = create_acl(result)
+    acl_cache.set(user_id, user_acl)
+    return user_acl
 
-def get_accessible_municipalities(acl_user: ACL):
-    result = map(lambda row: row["municipality_code"], db.get_accessible_municipalities(acl_user.user_id))
-    return set(result)
+async def get_accessible_municipalities(acl_user: ACL):
+    cached_municipalities = municipalities_cache.get(acl_user.user_id)
+    if cached_municipalities != None:
+        return cached_municipalities
+    result = frozenset(map(lambda row: row["municipality_code"], await db.get_accessible_municipalities(acl_user.user_id)))
+    municipalities_cache.set(acl_user.user_id, result)
+    return result
 
 def create_acl(row):
     privileges = []
     if row["privileges"]:
-        privileges = map(lambda x: PrivilegesEnum(x), row["privileges"])
+        privileges = list(map(lambda x: PrivilegesEnum(x), row["privileges"]))
     return acl.ACL(
         user_id=row["user_id"],
         part_of_organisation=row["organisation_id"],
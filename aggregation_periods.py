@@ -0,0 +1,109 @@
+import numpy as np
+import asyncio
+import time
+import os
+from datetime import date
+from db_helper import db_helper
+import query_od_parameters
+
+refresh_interval = float(os.getenv("AGGREGATION_PERIOD_REFRESH_INTERVAL", "300"))
+# Queries that include the most recent day check for new periods when the index is older than this.
+max_age = float(os.getenv("AGGREGATION_PERIOD_MAX_AGE", "60"))
+
+class AggregationPeriodIndex:
+    """od_aggregation_period as arrays sorted by day, with day of week and hour in Europe/Amsterdam."""
+
+    def __init__(self):
+        self.aggregation_period_ids = np.array([], dtype=np.int64)
+        self.days = np.array([], dtype="datetime64[D]")
+        self.isodows = np.array([], dtype=np.int8)
+        self.hours = np.array([], dtype=np.int8)
+        self.last_aggregation_period_id = 0
+        self.loaded_at = None
+        self._lock = asyncio.Lock()
+
+    async def load_new_periods(self):
+        async with self._lock:
+            rows = await get_aggregation_periods(self.last_aggregation_period_id)
+            if rows is None:
+                return
+            self.loaded_at = time.monotonic()
+            if len(rows) == 0:
+                return
+            aggregation_period_ids = np.concatenate((self.aggregation_period_ids, np.array([row["aggregation_period_id"] for row in rows], dtype=np.int64)))
+            days = np.concatenate((self.days, np.array([row["day"] for row in rows], dtype="datetime64[D]")))
+            isodows = np.concatenate((self.isodows, np.array([row["isodow"] for row in rows], dtype=np.int8)))
+            hours = np.concatenate((self.hours, np.array([row["hour"] for row in rows], dtype=np.int8)))
+            order = np.argsort(days, kind="stable")
+            self.aggregation_period_ids = aggregation_period_ids[order]
+            self.days = days[order]
+            self.isodows = isodows[order]
+            self.hours = hours[order]
+            self.last_aggregation_period_id = int(aggregation_period_ids.max())
+
+    async def load_if_stale(self, last_day: date):
+        stale = self.loaded_at is None or time.monotonic() - self.loaded_at > max_age
+        if stale and (len(self.days) == 0 or np.datetime64(last_day) >= self.days[-1]):
+            await self.load_new_periods()
+
+    # The latest aggregation period, results of queries up to last_day can only change when it does.
+    async def version(self, last_day: date):
+        await self.load_if_stale(last_day)
+        return self.last_aggregation_period_id
+
+    # Positions in the arrays of the periods that match the filters of data.
+    async def select(self, data: query_od_parameters.QueryODParameters, first_day: date, last_day: date):
+        await self.load_if_stale(last_day)
+        start = np.searchsorted(self.days, np.datetime64(first_day), side="left")
+        end = np.searchsorted(self.days, np.datetime64(last_day), side="right")
+        mask = np.ones(end - start, dtype=bool)
+        if not data.dont_filter_on_days_of_week:
+            mask &= np.isin(self.isodows[start:end], data.days_of_week)
+        if not data.dont_filter_on_time_periods:
+            mask &= np.isin(self.hours[start:end], data.time_periods)
+        return np.arange(start, end)[mask]
+
+    async def resolve(self, data: query_od_parameters.QueryODParameters, first_day: date, last_day: date):
+        positions = await self.select(data, first_day, last_day)
+        return self.aggregation_period_ids[positions].tolist()
+
+    # Aggregation periods and the bucket of data.group_by they belong to, with the same values as the day rollup.
+    async def resolve_buckets(self, data: query_od_parameters.QueryODParameters, first_day: date, last_day: date):
+        positions = await self.select(data, first_day, last_day)
+        if data.group_by == "date":
+            buckets = np.datetime_as_string(self.days[positions]).tolist()
+        elif data.group_by == "isoweek":
+            days, inverse = np.unique(self.days[positions], return_inverse=True)
+            weeks = ["%04d-W%02d" % day.isocalendar()[:2] for day in days.tolist()]
+            buckets = [weeks[index] for index in inverse]
+        elif data.group_by == "isodow":
+            buckets = self.isodows[positions].astype(str).tolist()
+        else:
+            buckets = self.hours[positions].astype(str).tolist()
+        return self.aggregation_period_ids[positions].tolist(), buckets
+
+    async def refresh_periodically(self):
+        while True:
+            await asyncio.sleep(refresh_interval)
+            try:
+                await self.load_new_periods()
+            except Exception as e:
+                print(e)
+
+async def get_aggregation_periods(after_aggregation_period_id: int):
+    stmt = """
+        SELECT aggregation_period_id, start_time_period::date as day,
+        extract(isodow from start_time_period)::smallint as isodow,
+        extract(hour from start_time_period)::smallint as hour
+        FROM od_aggregation_period
+        WHERE aggregation_period_id > %(aggregation_period_id)s
+    """
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            await db_helper.execute(cur, stmt, {"aggregation_period_id": after_aggregation_period_id})
+            return await cur.fetchall()
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+
+aggregation_period_index = AggregationPeriodIndex()
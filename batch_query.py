@@ -0,0 +1,72 @@
+from pydantic import BaseModel, Field
+from fastapi import HTTPException
+from datetime import date
+from typing import Literal
+import query_od_parameters
+import numpy as np
+import os
+
+max_queries = int(os.getenv("BATCH_MAX_QUERIES", "20"))
+
+class ODQuerySpec(BaseModel):
+    direction: Literal["origins", "destinations"] = Field(
+        description="origins returns the origins of trips to the specified cells or stat_refs, destinations the destinations of trips from them."
+    )
+    cells: str | None = Field(
+        default=None,
+        regex="^(([a-z,0-9]{15}),?)*$",
+        example="87196bb56ffffff,87196bb57ffffff"
+    )
+    stat_refs: str | None = Field(
+        default=None,
+        example="cbs:WK059916,cbs:WK059917"
+    )
+    h3_resolution: str | None = Field(default=None, regex="^(5|6|7|8)$", example="7")
+    start_date: date = Field(example="2023-02-14")
+    end_date: date = Field(example="2023-02-14")
+    days_of_week: str | None = Field(default=None, regex="^((mo|tu|we|th|fr|sa|su),?)*$")
+    time_periods: str | None = Field(default=None, regex="^((2-6|6-10|10-14|14-18|18-22|22-2),?)*$")
+    modalities: str | None = Field(default=None, regex="^((bicycle|moped|car|scooter|cargo_bicycle|unknown),?)*$")
+
+# Converts the specs to (name of the db query function, args) tuples.
+def prepare_queries(specs: list[ODQuerySpec]):
+    if len(specs) > max_queries:
+        raise HTTPException(status_code=422, detail=f"a batch can contain at most {max_queries} queries")
+
+    queries = []
+    for spec in specs:
+        query_od_parameter = query_od_parameters.prepare_query(
+            start_date = spec.start_date,
+            end_date = spec.end_date,
+            days_of_week = spec.days_of_week,
+            time_periods = spec.time_periods,
+            modalities = spec.modalities
+        )
+        if (spec.cells is None) == (spec.stat_refs is None):
+            raise HTTPException(status_code=422, detail="specify either cells or stat_refs for every query")
+        if spec.cells is not None:
+            if spec.h3_resolution is None:
+                raise HTTPException(status_code=422, detail="h3_resolution is required when cells are specified")
+            h3_resolution = int(spec.h3_resolution)
+            cells = query_od_parameters.convert_h3_cells(cells=spec.cells, h3_resolution=h3_resolution)
+            queries.append((f"query_h3_{spec.direction}", (cells, h3_resolution, query_od_parameter)))
+        else:
+            queries.append((f"query_geometry_{spec.direction}", (spec.stat_refs.split(","), query_od_parameter)))
+    return queries
+
+# Results of all queries as one table for the columnar formats, query is the index of the spec.
+# cell is 0 for rows of geometry queries and stat_ref is null for rows of h3 queries.
+def columns(queries, results):
+    query, cells, stat_refs, number_of_trips = [], [], [], []
+    for index, ((name, _), rows) in enumerate(zip(queries, results)):
+        for row in rows:
+            query.append(index)
+            cells.append(row.get("cell", 0))
+            stat_refs.append(None if "cell" in row else row.get("origin_stat_ref", row.get("destination_stat_ref")))
+            number_of_trips.append(row["number_of_trips"])
+    return {
+        "query": np.array(query, dtype=np.int32),
+        "cell": np.array(cells, dtype=np.uint64),
+        "stat_ref": stat_refs,
+        "number_of_trips": np.array(number_of_trips, dtype=np.int64)
+    }
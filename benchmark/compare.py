@@ -0,0 +1,48 @@
+"""Compares two result files of benchmark.load_test or benchmark.micro and marks regressions.
+
+    python -m benchmark.compare benchmark/results/old.json benchmark/results/new.json --threshold 0.1
+"""
+from pathlib import Path
+import argparse
+import json
+import sys
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as a regression")
+    return parser.parse_args()
+
+def entries(report):
+    if "benchmarks" in report:
+        return report["benchmarks"]
+    return {"total": report["total"], **report["scenarios"]}
+
+def main():
+    args = parse_args()
+    baseline = json.loads(args.baseline.read_text())
+    current = json.loads(args.current.read_text())
+    print(f"{baseline['version']} -> {current['version']}")
+    regressions = 0
+    baseline_entries = entries(baseline)
+    for name, result in entries(current).items():
+        if name not in baseline_entries:
+            continue
+        changes = []
+        for metric in ("p50", "p95", "p99", "throughput"):
+            if metric not in result or metric not in baseline_entries[name] or not baseline_entries[name][metric]:
+                continue
+            change = result[metric] / baseline_entries[name][metric] - 1
+            # Higher latency is worse, lower throughput is worse.
+            regression = -change if metric == "throughput" else change
+            marker = " !" if regression > args.threshold else ""
+            regressions += bool(marker)
+            changes.append(f"{metric} {change:+7.1%}{marker}")
+        print(f"{name:32} " + "  ".join(changes))
+    if baseline.get("peak_rss_bytes") and current.get("peak_rss_bytes"):
+        print(f"{'peak_rss_bytes':32} {current['peak_rss_bytes'] / baseline['peak_rss_bytes'] - 1:+7.1%}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Fills a local Postgres database with a synthetic OD dataset for benchmarks.
+
+The connection is configured with the same DB_* environment variables as the API, all existing data
+in the tables of benchmark/schema.sql is dropped. Run from the repository root:
+
+    python -m benchmark.generate_data --cells 2000 --days 90 --municipalities 8
+"""
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+from pathlib import Path
+from db_helper import conn_str
+import numpy as np
+import argparse
+import psycopg
+import json
+import h3
+
+MODALITIES = ["bicycle", "moped", "scooter", "cargo_bicycle", "car", "unknown"]
+TIME_PERIODS = [2, 6, 10, 14, 18, 22]
+CENTER = (52.09, 5.12)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cells", type=int, default=2000, help="number of h3 cells of resolution 8")
+    parser.add_argument("--days", type=int, default=90, help="number of days, every day has 6 aggregation periods")
+    parser.add_argument("--start-date", type=date.fromisoformat, default=date(2023, 1, 1))
+    parser.add_argument("--modalities", type=int, default=3, help=f"number of modalities, at most {len(MODALITIES)}")
+    parser.add_argument("--od-pairs", type=int, default=500, help="number of od pairs with trips per aggregation period")
+    parser.add_argument("--municipalities", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20, help="number of non admin users")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def generate_cells(count: int):
+    center = h3.geo_to_h3(*CENTER, 8)
+    radius = 0
+    while 3 * radius * (radius + 1) + 1 < count:
+        radius += 1
+    cells = []
+    for ring in h3.k_ring_distances(center, radius):
+        cells.extend(sorted(ring))
+    return cells[:count]
+
+def split_municipalities(cells: list[str], count: int):
+    # Cells are grouped on their resolution 6 parent, so municipalities are more or less contiguous.
+    cells = sorted(cells, key=lambda cell: (h3.h3_to_parent(cell, 6), cell))
+    size = -(-len(cells) // count)
+    return {f"GM{index + 1:04d}": cells[index * size:(index + 1) * size] for index in range(count)}
+
+def create_aggregation_periods(cur, start_date: date, days: int):
+    timezone = ZoneInfo("Europe/Amsterdam")
+    with cur.copy("COPY od_aggregation_period (start_time_period, end_time_period) FROM STDIN") as copy:
+        for day in range(days):
+            for hour in TIME_PERIODS:
+                start = datetime.combine(start_date + timedelta(days=day), datetime.min.time()).replace(hour=hour, tzinfo=timezone)
+                copy.write_row((start, start + timedelta(hours=4)))
+    cur.execute("SELECT aggregation_period_id FROM od_aggregation_period ORDER BY aggregation_period_id")
+    return [row[0] for row in cur.fetchall()]
+
+# Popularity of cells follows a power law, trips per od pair a geometric distribution.
+def sample_od_pairs(rng, size: int, count: int):
+    weights = 1 / np.arange(1, size + 1) ** 0.8
+    weights = rng.permutation(weights / weights.sum())
+    origins = rng.choice(size, count, p=weights)
+    destinations = rng.choice(size, count, p=weights)
+    return origins, destinations, rng.geometric(0.3, count)
+
+def create_od_h3(cur, rng, aggregation_period_ids, cells: list[str], modalities: list[str], od_pairs: int):
+    cells8 = np.array([h3.string_to_h3(cell) for cell in cells], dtype=np.int64)
+    cells7 = np.array([h3.string_to_h3(h3.h3_to_parent(cell, 7)) for cell in cells], dtype=np.int64)
+    rows = 0
+    with cur.copy("COPY od_h3 (aggregation_period_id, h3_level, origin_cell, destination_cell, modality, number_of_trips) FROM STDIN") as copy:
+        for aggregation_period_id in aggregation_period_ids:
+            origins, destinations, trips = sample_od_pairs(rng, len(cells), od_pairs)
+            modality = rng.integers(0, len(modalities), od_pairs)
+            for h3_level, level_cells in ((8, cells8), (7, cells7)):
+                aggregated = {}
+                for key, number_of_trips in zip(zip(level_cells[origins].tolist(), level_cells[destinations].tolist(), modality.tolist()), trips.tolist()):
+                    aggregated[key] = aggregated.get(key, 0) + number_of_trips
+                for (origin, destination, modality_index), number_of_trips in aggregated.items():
+                    copy.write_row((aggregation_period_id, h3_level, origin, destination, modalities[modality_index], number_of_trips))
+                rows += len(aggregated)
+    return rows
+
+def create_residential_areas(cur, municipalities: dict[str, list[str]]):
+    zones = []
+    seen = set()
+    for municipality, cells in municipalities.items():
+        for cell in cells:
+            parent = h3.h3_to_parent(cell, 7)
+            if parent in seen:
+                continue
+            seen.add(parent)
+            boundary = [list(point) for point in h3.h3_to_geo_boundary(parent, geo_json=True)]
+            area = json.dumps({"type": "Polygon", "coordinates": [boundary]})
+            zones.append((len(zones), area, municipality, f"cbs:WK{len(zones):06d}"))
+    with cur.copy("COPY residential_areas (zone_id, area, municipality, stats_ref) FROM STDIN") as copy:
+        for zone in zones:
+            copy.write_row(zone)
+    return zones
+
+def create_od_geometry(cur, rng, aggregation_period_ids, zones, modalities: list[str], od_pairs: int):
+    stats_refs = [zone[3] for zone in zones]
+    rows = 0
+    with cur.copy("COPY od_geometry (aggregation_period_id, origin_stats_ref, destination_stats_ref, modality, number_of_trips) FROM STDIN") as copy:
+        for aggregation_period_id in aggregation_period_ids:
+            origins, destinations, trips = sample_od_pairs(rng, len(stats_refs), od_pairs)
+            modality = rng.integers(0, len(modalities), od_pairs)
+            aggregated = {}
+            for key, number_of_trips in zip(zip(origins.tolist(), destinations.tolist(), modality.tolist()), trips.tolist()):
+                aggregated[key] = aggregated.get(key, 0) + number_of_trips
+            for (origin, destination, modality_index), number_of_trips in aggregated.items():
+                copy.write_row((aggregation_period_id, stats_refs[origin], stats_refs[destination], modalities[modality_index], number_of_trips))
+            rows += len(aggregated)
+    return rows
+
+def create_h3_acl(cur, municipalities: dict[str, list[str]]):
+    for municipality, cells in municipalities.items():
+        cells8 = sorted({h3.string_to_h3(cell) for cell in cells})
+        cells7 = sorted({h3.string_to_h3(h3.h3_to_parent(cell, 7)) for cell in cells})
+        cur.execute(
+            "INSERT INTO od_h3_acl (municipality_code, h3_level, cells) VALUES (%s, 8, %s), (%s, 7, %s)",
+            (municipality, cells8, municipality, cells7)
+        )
+
+# One admin, one organisation per municipality and users that are spread over them,
+# every third user is granted access to the next municipality as well.
+def create_acl(cur, rng, municipality_codes: list[str], users: int):
+    cur.execute("INSERT INTO organisation VALUES (0, 'Benchmark admin', 'ADMIN', '{}')")
+    cur.execute("INSERT INTO user_account VALUES ('admin@benchmark.local', 0, '{}')")
+    for index, municipality in enumerate(municipality_codes):
+        cur.execute("INSERT INTO organisation VALUES (%s, %s, 'MUNICIPALITY', %s)", (index + 1, f"Municipality {municipality}", [municipality]))
+    for index in range(users):
+        organisation_id = int(rng.integers(1, len(municipality_codes) + 1))
+        user_id = f"user{index}@benchmark.local"
+        cur.execute("INSERT INTO user_account VALUES (%s, %s, NULL)", (user_id, organisation_id))
+        if index % 3 == 0 and len(municipality_codes) > 1:
+            cur.execute(
+                "INSERT INTO view_data_access (owner_organisation_id, granted_user) VALUES (%s, %s)",
+                (organisation_id % len(municipality_codes) + 1, user_id)
+            )
+
+def create_indexes(cur):
+    cur.execute("""
+        CREATE INDEX ON od_h3 (aggregation_period_id, h3_level, origin_cell);
+        CREATE INDEX ON od_h3 (aggregation_period_id, h3_level, destination_cell);
+        CREATE INDEX ON od_geometry (aggregation_period_id, origin_stats_ref);
+        CREATE INDEX ON od_geometry (aggregation_period_id, destination_stats_ref);
+        CREATE INDEX ON od_aggregation_period (start_time_period);
+        CREATE INDEX ON residential_areas (municipality);
+    """)
+    cur.execute("ANALYZE")
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    modalities = MODALITIES[:args.modalities]
+    cells = generate_cells(args.cells)
+    municipalities = split_municipalities(cells, args.municipalities)
+
+    with psycopg.connect(conn_str) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET TIME ZONE 'Europe/Amsterdam'")
+            cur.execute((Path(__file__).parent / "schema.sql").read_text())
+            aggregation_period_ids = create_aggregation_periods(cur, args.start_date, args.days)
+            od_h3_rows = create_od_h3(cur, rng, aggregation_period_ids, cells, modalities, args.od_pairs)
+            zones = create_residential_areas(cur, municipalities)
+            od_geometry_rows = create_od_geometry(cur, rng, aggregation_period_ids, zones, modalities, args.od_pairs)
+            create_h3_acl(cur, municipalities)
+            create_acl(cur, rng, list(municipalities), args.users)
+            conn.commit()
+            create_indexes(cur)
+    print(json.dumps({
+        "aggregation_periods": len(aggregation_period_ids),
+        "od_h3": od_h3_rows,
+        "od_geometry": od_geometry_rows,
+        "residential_areas": len(zones),
+        "municipalities": len(municipalities),
+        "users": args.users + 1
+    }))
+
+if __name__ == "__main__":
+    main()
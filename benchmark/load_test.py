@@ -0,0 +1,342 @@
+"""Drives the API with a concurrent mix of requests and reports latency percentiles, throughput and peak RSS.
+
+Request parameters are taken from the database the API uses (generate it with benchmark.generate_data).
+Without --url an uvicorn server is started with the current environment. Run from the repository root:
+
+    python -m benchmark.load_test --mix default --concurrency 16 --duration 60
+"""
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from db_helper import conn_str
+import numpy as np
+import subprocess
+import argparse
+import asyncio
+import psycopg
+import random
+import httpx
+import json
+import time
+import jwt
+import sys
+import h3
+
+# scenario: weight, the mixes are meant to resemble the traffic of the dashboard.
+MIXES = {
+    "default": {
+        "destinations_h3": 25, "origins_h3": 15, "destinations_geometry": 10, "origins_geometry": 5,
+        "accessible_h3": 15, "accessible_geometry": 10, "batch": 3, "matrix_h3": 2,
+        "destinations_h3_stream": 1, "tiles_destinations_h3": 5, "tiles_destinations_geometry": 2,
+        "tiles_accessible_h3": 3, "tiles_accessible_geometry": 2, "metrics": 1, "admin": 1
+    },
+    "heavy": {
+        "destinations_h3": 20, "origins_h3": 20, "destinations_geometry": 10, "origins_geometry": 10,
+        "batch": 15, "matrix_h3": 15, "destinations_h3_stream": 5, "tiles_destinations_h3": 5
+    },
+    "accessible": {
+        "accessible_h3": 40, "accessible_geometry": 30, "tiles_accessible_h3": 15, "tiles_accessible_geometry": 15
+    }
+}
+# Share of the date ranges per length in days, long ranges are rarer.
+RANGE_LENGTHS = {1: 30, 7: 35, 31: 25, 92: 8, 365: 2}
+DAYS_OF_WEEK = ["mo", "tu", "we", "th", "fr", "sa", "su"]
+TIME_PERIODS = ["2-6", "6-10", "10-14", "14-18", "18-22", "22-2"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="url of a running API, by default a server is started")
+    parser.add_argument("--server-pid", type=int, help="pid of the server at --url, to report its peak RSS")
+    parser.add_argument("--port", type=int, default=8765, help="port of the server that is started")
+    parser.add_argument("--workers", type=int, default=1, help="number of uvicorn workers of the server that is started")
+    parser.add_argument("--mix", choices=MIXES, default="default")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before measuring starts")
+    parser.add_argument("--repeat-share", type=float, default=0.5, help="share of requests that repeat an earlier request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, help="json file, by default benchmark/results/load_test-<version>-<time>.json")
+    return parser.parse_args()
+
+def token(user_id: str):
+    return "Bearer " + jwt.encode({"email": user_id}, "benchmark", algorithm="HS256")
+
+class Dataset:
+    """Users, their accessible cells and stat_refs and the days with data, read from the database."""
+
+    def __init__(self):
+        with psycopg.connect(conn_str) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SET TIME ZONE 'Europe/Amsterdam'")
+                cur.execute("SELECT min(start_time_period)::date, max(start_time_period)::date FROM od_aggregation_period")
+                self.first_day, self.last_day = cur.fetchone()
+                cur.execute("SELECT municipality_code, h3_level, cells FROM od_h3_acl")
+                self.cells = {}
+                for municipality, h3_level, cells in cur.fetchall():
+                    self.cells.setdefault(municipality, {})[h3_level] = [format(cell, "x") for cell in cells]
+                cur.execute("SELECT municipality, array_agg(stats_ref) FROM residential_areas GROUP BY municipality")
+                self.stats_refs = dict(cur.fetchall())
+                cur.execute("""
+                    SELECT user_id, type_of_organisation = 'ADMIN', data_owner_of_municipalities
+                    FROM user_account JOIN organisation USING (organisation_id)
+                """)
+                users = cur.fetchall()
+                self.counts = {}
+                for table in ("od_h3", "od_geometry", "od_aggregation_period", "residential_areas", "user_account"):
+                    cur.execute(f"SELECT count(*) FROM {table}")
+                    self.counts[table] = cur.fetchone()[0]
+        self.admins = [user_id for user_id, is_admin, _ in users if is_admin]
+        # Only the municipalities of the own organisation are used, so every generated request is allowed.
+        self.users = [(user_id, municipalities) for user_id, is_admin, municipalities in users if not is_admin and municipalities]
+
+class RequestGenerator:
+    def __init__(self, dataset: Dataset, mix: dict, repeat_share: float, seed: int):
+        self.dataset = dataset
+        self.random = random.Random(seed)
+        self.scenarios = list(mix)
+        self.weights = list(mix.values())
+        self.repeat_share = repeat_share
+        self.history = []
+
+    def next(self):
+        if self.history and self.random.random() < self.repeat_share:
+            return self.random.choice(self.history)
+        scenario = self.random.choices(self.scenarios, self.weights)[0]
+        request = (scenario, *getattr(self, scenario)())
+        self.history.append(request)
+        del self.history[:-1000]
+        return request
+
+    def user(self):
+        user_id, municipalities = self.random.choice(self.dataset.users)
+        return token(user_id), self.random.choice(municipalities)
+
+    def dates(self):
+        length = self.random.choices(list(RANGE_LENGTHS), list(RANGE_LENGTHS.values()))[0]
+        total_days = (self.dataset.last_day - self.dataset.first_day).days + 1
+        length = min(length, total_days)
+        start = self.dataset.first_day + timedelta(days=self.random.randrange(total_days - length + 1))
+        params = {"start_date": start.isoformat(), "end_date": (start + timedelta(days=length - 1)).isoformat()}
+        if self.random.random() < 0.2:
+            params["days_of_week"] = ",".join(self.random.sample(DAYS_OF_WEEK, self.random.randint(1, 5)))
+        if self.random.random() < 0.2:
+            params["time_periods"] = ",".join(self.random.sample(TIME_PERIODS, self.random.randint(1, 3)))
+        if self.random.random() < 0.2:
+            params["modalities"] = "bicycle,moped"
+        return params
+
+    def cells(self, municipality: str, h3_resolution: int, maximum: int):
+        cells = self.dataset.cells.get(municipality, {}).get(h3_resolution, [])
+        return self.random.sample(cells, min(len(cells), self.random.randint(1, maximum)))
+
+    def stat_refs(self, municipality: str, maximum: int):
+        stats_refs = self.dataset.stats_refs.get(municipality, [])
+        return self.random.sample(stats_refs, min(len(stats_refs), self.random.randint(1, maximum)))
+
+    def tile(self, cells: list[str], z: int):
+        lat, lng = h3.h3_to_geo(cells[0])
+        n = 2 ** z
+        x = int((lng + 180) / 360 * n)
+        y = int((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n)
+        return f"{z}/{x}/{y}"
+
+    def od_h3(self, direction: str):
+        authorization, municipality = self.user()
+        h3_resolution = self.random.choice([7, 8])
+        cells = self.cells(municipality, h3_resolution, 10)
+        key = "origin_cells" if direction == "destinations" else "destination_cells"
+        return "GET", f"/{direction}/h3", {**self.dates(), "h3_resolution": h3_resolution, key: ",".join(cells)}, None, authorization
+
+    def od_geometry(self, direction: str):
+        authorization, municipality = self.user()
+        key = "origin_stat_refs" if direction == "destinations" else "destination_stat_refs"
+        return "GET", f"/{direction}/geometry", {**self.dates(), key: ",".join(self.stat_refs(municipality, 5))}, None, authorization
+
+    def destinations_h3(self):
+        return self.od_h3("destinations")
+
+    def origins_h3(self):
+        return self.od_h3("origins")
+
+    def destinations_geometry(self):
+        return self.od_geometry("destinations")
+
+    def origins_geometry(self):
+        return self.od_geometry("origins")
+
+    def destinations_h3_stream(self):
+        method, path, params, body, authorization = self.od_h3("destinations")
+        return method, path, {**params, "stream": "ndjson"}, body, authorization
+
+    def accessible_h3(self):
+        authorization, _ = self.user()
+        return "GET", "/accessible/h3", {"h3_resolution": self.random.choice([7, 8])}, None, authorization
+
+    def accessible_geometry(self):
+        authorization, _ = self.user()
+        return "GET", "/accessible/geometry", {}, None, authorization
+
+    def batch(self):
+        authorization, municipality = self.user()
+        specs = []
+        for _ in range(self.random.randint(2, 10)):
+            spec = {"direction": self.random.choice(["origins", "destinations"]), **self.dates()}
+            if self.random.random() < 0.7:
+                spec["h3_resolution"] = "8"
+                spec["cells"] = ",".join(self.cells(municipality, 8, 5))
+            else:
+                spec["stat_refs"] = ",".join(self.stat_refs(municipality, 3))
+            specs.append(spec)
+        return "POST", "/batch", {}, specs, authorization
+
+    def matrix_h3(self):
+        authorization, municipality = self.user()
+        return "GET", "/matrix/h3", {
+            **self.dates(),
+            "h3_resolution": 8,
+            "origin_cells": ",".join(self.cells(municipality, 8, 50)),
+            "destination_cells": ",".join(self.cells(municipality, 8, 50)),
+            "representation": self.random.choice(["sparse", "dense"])
+        }, None, authorization
+
+    def tiles_destinations_h3(self):
+        method, _, params, body, authorization = self.od_h3("destinations")
+        cells = params["origin_cells"].split(",")
+        return method, f"/tiles/destinations/h3/{self.tile(cells, self.random.choice([11, 12, 13]))}", params, body, authorization
+
+    def tiles_destinations_geometry(self):
+        method, _, params, body, authorization = self.od_geometry("destinations")
+        municipality = self.random.choice(list(self.dataset.cells))
+        return method, f"/tiles/destinations/geometry/{self.tile(self.dataset.cells[municipality][8], 11)}", params, body, authorization
+
+    def tiles_accessible_h3(self):
+        authorization, municipality = self.user()
+        cells = self.dataset.cells[municipality][8]
+        return "GET", f"/tiles/accessible/h3/{self.tile(cells, 12)}", {"h3_resolution": 8}, None, authorization
+
+    def tiles_accessible_geometry(self):
+        authorization, municipality = self.user()
+        cells = self.dataset.cells[municipality][8]
+        return "GET", f"/tiles/accessible/geometry/{self.tile(cells, 11)}", {}, None, authorization
+
+    def metrics(self):
+        return "GET", "/metrics", {}, None, None
+
+    def admin(self):
+        path = self.random.choice(["/admin/acl_cache", "/admin/result_cache", "/admin/geometry_cache"])
+        return "GET", path, {}, None, token(self.random.choice(self.dataset.admins))
+
+async def worker(client: httpx.AsyncClient, generator: RequestGenerator, measure_from: float, until: float, results: dict):
+    while time.perf_counter() < until:
+        scenario, method, path, params, body, authorization = generator.next()
+        headers = {"Authorization": authorization} if authorization else {}
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, params=params, json=body, headers=headers)
+            await response.aread()
+            status = response.status_code
+            size = len(response.content)
+        except httpx.HTTPError:
+            status, size = 0, 0
+        end = time.perf_counter()
+        if start >= measure_from:
+            result = results.setdefault(scenario, {"latencies": [], "statuses": {}, "bytes": 0})
+            result["latencies"].append(end - start)
+            result["statuses"][status] = result["statuses"].get(status, 0) + 1
+            result["bytes"] += size
+
+def summarize(latencies: list[float], duration: float):
+    latencies = np.array(latencies)
+    if len(latencies) == 0:
+        return {"requests": 0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / duration,
+        "mean": float(latencies.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(latencies.max())
+    }
+
+def peak_rss(pid: int):
+    # VmHWM is the peak resident set size, the pids of worker processes are included as well.
+    total = 0
+    pids = [pid] + [int(child) for child in Path(f"/proc/{pid}/task/{pid}/children").read_text().split()] if Path(f"/proc/{pid}").exists() else []
+    for process in pids:
+        for line in Path(f"/proc/{process}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                total += int(line.split()[1]) * 1024
+    return total or None
+
+def version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def start_server(port: int, workers: int):
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"
+    ])
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("server did not start")
+
+async def run(args, url: str, dataset: Dataset):
+    generator = RequestGenerator(dataset, MIXES[args.mix], args.repeat_share, args.seed)
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        measure_from = start + args.warmup
+        until = measure_from + args.duration
+        await asyncio.gather(*(worker(client, generator, measure_from, until, results) for _ in range(args.concurrency)))
+    return results
+
+def main():
+    args = parse_args()
+    dataset = Dataset()
+    server = None
+    url = args.url
+    pid = args.server_pid
+    if url is None:
+        server = start_server(args.port, args.workers)
+        url = f"http://127.0.0.1:{args.port}"
+        pid = server.pid
+    try:
+        results = asyncio.run(run(args, url, dataset))
+        rss = peak_rss(pid) if pid else None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "version": version(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "dataset": dataset.counts,
+        "peak_rss_bytes": rss,
+        "total": summarize([latency for result in results.values() for latency in result["latencies"]], args.duration),
+        "scenarios": {
+            scenario: {
+                **summarize(result["latencies"], args.duration),
+                "statuses": {str(status): count for status, count in sorted(result["statuses"].items())},
+                "bytes": result["bytes"]
+            }
+            for scenario, result in sorted(results.items())
+        }
+    }
+    output = args.output or Path(__file__).parent / "results" / f"load_test-{report['version']}-{date.today().isoformat()}-{int(time.time())}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(json.dumps({"output": str(output), "peak_rss_bytes": rss, "total": report["total"]}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Micro-benchmarks of the stages of a request that don't need a database.
+
+Run from the repository root:
+
+    python -m benchmark.micro --rows 10000 --cells 1000
+"""
+from datetime import date, datetime, timezone
+from pathlib import Path
+from h3_access_index import H3AccessIndex
+from benchmark.load_test import version
+import query_od_parameters
+import result_cache
+import od_matrix
+import h3_codec
+import numpy as np
+import argparse
+import resource
+import asyncio
+import json
+import time
+import main
+import mvt
+import h3
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="number of rows in an od result")
+    parser.add_argument("--cells", type=int, default=1000, help="number of requested cells")
+    parser.add_argument("--municipalities", type=int, default=400, help="number of municipalities in the access index")
+    parser.add_argument("--repeat", type=int, default=20, help="number of measurements per benchmark")
+    parser.add_argument("--output", type=Path, help="json file, by default benchmark/results/micro-<version>-<time>.json")
+    return parser.parse_args()
+
+def measure(func, repeat: int):
+    # Every measurement runs func often enough to take at least 10ms.
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= 0.01:
+            break
+        number *= 2
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    timings = np.array(timings)
+    return {
+        "number": number,
+        "min": float(timings.min()),
+        "p50": float(np.percentile(timings, 50)),
+        "p95": float(np.percentile(timings, 95)),
+        "p99": float(np.percentile(timings, 99))
+    }
+
+def run_async(coroutine_function):
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(coroutine_function())
+
+def main_benchmarks(args):
+    rng = np.random.default_rng(1)
+    center = h3.geo_to_h3(52.09, 5.12, 4)
+    all_cells = h3_codec.to_array([h3.string_to_h3(cell) for cell in h3.h3_to_children(center, 8)])
+    cells = rng.choice(all_cells, args.cells, replace=False)
+    cell_strings = ",".join(h3_codec.to_strings(cells))
+    rows = [{"cell": int(cell), "number_of_trips": int(trips)} for cell, trips in zip(rng.choice(all_cells, args.rows), rng.integers(4, 1000, args.rows))]
+    matrix_rows = [{"origin_cell": row["cell"], "destination_cell": int(cell), "number_of_trips": row["number_of_trips"]} for row, cell in zip(rows, rng.choice(cells, args.rows))]
+
+    # Every municipality gets a disjoint part of the cells, the user has access to the first two.
+    access_index = H3AccessIndex()
+    parts = np.array_split(np.sort(all_cells), args.municipalities)
+    access_index._cells_per_level[8] = {f"GM{index:04d}": part for index, part in enumerate(parts)}
+    municipalities = ["GM0000", "GM0001"]
+    requested_cells = np.concatenate(parts[:2])[:args.cells].tolist()
+
+    data = query_od_parameters.prepare_query(date(2023, 1, 1), date(2023, 3, 31), "mo,tu,we", "6-10,14-18", "bicycle")
+    angles = np.linspace(0, 2 * np.pi, 7)
+    hexagon = np.column_stack((2048 + 40 * np.cos(angles), 2048 + 40 * np.sin(angles)))
+    features = [mvt.Feature(id=index, properties={"number_of_trips": index}, polygons=[[hexagon + index % 40]]) for index in range(args.rows)]
+
+    benchmarks = {
+        "serialize_od_h3_result": lambda: main.serialize_od_h3_result(rows),
+        "convert_h3_cells": lambda: query_od_parameters.convert_h3_cells(cell_strings, 8),
+        "h3_codec.to_strings": lambda: h3_codec.to_strings(cells),
+        "check_h3_access": run_async(lambda: access_index.has_access(municipalities, requested_cells, 8)),
+        "accessible_cells": run_async(lambda: access_index.accessible_cells(municipalities, 8)),
+        "prepare_query": lambda: query_od_parameters.prepare_query(date(2023, 1, 1), date(2023, 3, 31), "mo,tu,we", "6-10,14-18", "bicycle"),
+        "result_cache_key": lambda: result_cache.cache_key("query_h3_destinations", (cells.tolist(), 8, data)),
+        "create_od_matrix": lambda: od_matrix.create_od_matrix(matrix_rows, cells.tolist(), cells.tolist()),
+        "encode_mvt_layer": lambda: mvt.encode_layer("destinations", features)
+    }
+    return {name: measure(func, args.repeat) for name, func in benchmarks.items()}
+
+def run():
+    args = parse_args()
+    results = main_benchmarks(args)
+    report = {
+        "version": version(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "benchmarks": results
+    }
+    output = args.output or Path(__file__).parent / "results" / f"micro-{report['version']}-{date.today().isoformat()}-{int(time.time())}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    for name, result in results.items():
+        print(f"{name:28} p50 {result['p50'] * 1e6:12.1f} us  p95 {result['p95'] * 1e6:12.1f} us")
+    print(output)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,58 @@
+-- Tables read by the API, with the columns it uses. Only meant for benchmark databases.
+DROP TABLE IF EXISTS od_h3, od_geometry, od_aggregation_period, od_h3_acl, residential_areas,
+    view_data_access, user_account, organisation CASCADE;
+
+CREATE TABLE od_aggregation_period (
+    aggregation_period_id serial PRIMARY KEY,
+    start_time_period timestamptz NOT NULL,
+    end_time_period timestamptz NOT NULL
+);
+
+CREATE TABLE od_h3 (
+    aggregation_period_id integer NOT NULL REFERENCES od_aggregation_period,
+    h3_level smallint NOT NULL,
+    origin_cell bigint NOT NULL,
+    destination_cell bigint NOT NULL,
+    modality text NOT NULL,
+    number_of_trips integer NOT NULL
+);
+
+CREATE TABLE od_geometry (
+    aggregation_period_id integer NOT NULL REFERENCES od_aggregation_period,
+    origin_stats_ref text NOT NULL,
+    destination_stats_ref text NOT NULL,
+    modality text NOT NULL,
+    number_of_trips integer NOT NULL
+);
+
+CREATE TABLE od_h3_acl (
+    municipality_code text NOT NULL,
+    h3_level smallint NOT NULL,
+    cells bigint[] NOT NULL
+);
+
+CREATE TABLE residential_areas (
+    zone_id integer PRIMARY KEY,
+    area text NOT NULL,
+    municipality text NOT NULL,
+    stats_ref text NOT NULL
+);
+
+CREATE TABLE organisation (
+    organisation_id integer PRIMARY KEY,
+    name text NOT NULL,
+    type_of_organisation text NOT NULL,
+    data_owner_of_municipalities text[]
+);
+
+CREATE TABLE user_account (
+    user_id text PRIMARY KEY,
+    organisation_id integer NOT NULL REFERENCES organisation,
+    privileges text[]
+);
+
+CREATE TABLE view_data_access (
+    owner_organisation_id integer NOT NULL REFERENCES organisation,
+    granted_organisation_id integer REFERENCES organisation,
+    granted_user text REFERENCES user_account
+);
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+import threading
+import time
+
+_MISSING = object()
+
+class TTLCache:
+    """Bounded LRU cache where every entry expires ttl seconds after it was stored.
+
+    Entries can be given a weight (for example an estimate of their size in bytes),
+    the least recently used entries are evicted when the total weight exceeds max_weight.
+    """
+
+    def __init__(self, max_size: int, ttl: float, max_weight: float | None = None):
+        self.max_size = max_size
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING or entry[0] < time.monotonic():
+                if entry is not _MISSING:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float | None = None, weight: float = 1):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value, weight)
+            self.weight += weight
+            while len(self._entries) > self.max_size or (self.max_weight is not None and self.weight > self.max_weight):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "weight": self.weight,
+            "max_weight": self.max_weight,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
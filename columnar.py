@@ -0,0 +1,117 @@
+import numpy as np
+import h3_codec
+import metrics
+import json
+
+# Both formats are optional, a format is only offered when its package is installed.
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+json_media_type = "application/json"
+arrow_media_type = "application/vnd.apache.arrow.stream"
+msgpack_media_type = "application/msgpack"
+
+def available_media_types():
+    media_types = {json_media_type: json_media_type, "*/*": json_media_type, "application/*": json_media_type}
+    if pyarrow is not None:
+        media_types[arrow_media_type] = arrow_media_type
+    if msgpack is not None:
+        media_types[msgpack_media_type] = msgpack_media_type
+        media_types["application/x-msgpack"] = msgpack_media_type
+    return media_types
+
+# Returns the media type of the response for an Accept header, json is the default.
+def negotiate(accept: str | None):
+    if not accept:
+        return json_media_type
+    media_types = available_media_types()
+    candidates = []
+    for index, part in enumerate(accept.split(",")):
+        media_type, *parameters = [value.strip() for value in part.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, index, media_type.lower()))
+    for _, _, media_type in sorted(candidates):
+        if media_type in media_types:
+            return media_types[media_type]
+    # Clients that only accept formats the API doesn't produce get json, as before the columnar formats.
+    return json_media_type
+
+# Columns of OD result rows, h3 cells as uint64 and numbers of trips as int64.
+def od_columns(rows, key: str, bucket_labels: dict | None = None):
+    columns = {}
+    if key == "cell":
+        columns[key] = np.fromiter((row[key] for row in rows), dtype=np.uint64, count=len(rows))
+    else:
+        columns[key] = [row[key] for row in rows]
+    if len(rows) > 0 and "bucket" in rows[0]:
+        columns["bucket"] = [bucket_labels[row["bucket"]] if bucket_labels else row["bucket"] for row in rows]
+    columns["number_of_trips"] = np.fromiter((row["number_of_trips"] for row in rows), dtype=np.int64, count=len(rows))
+    return columns
+
+# Encoded like the json responses of FastAPI, so large results can be encoded in the executor
+# without changing the response.
+def json_bytes(content):
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+def od_json_rows(values, number_of_trips: np.ndarray, key: str):
+    if key == "cell":
+        values = h3_codec.to_strings(values)
+    return [{key: value, "number_of_trips": trips} for value, trips in zip(values, number_of_trips.tolist())]
+
+# JSON response of the columns of od_columns, the cells are converted to strings in the executor as well.
+def encode_od_json(columns: dict, key: str, metadata: dict):
+    return json_bytes({"result": {"destinations": od_json_rows(columns[key], columns["number_of_trips"], key), **metadata}})
+
+# JSON response of the columns of batch_query.columns, keys are the keys of the rows of every query.
+def encode_batch_json(columns: dict, keys: list[str]):
+    boundaries = np.searchsorted(columns["query"], np.arange(len(keys) + 1)).tolist()
+    result = []
+    for index, key in enumerate(keys):
+        start, end = boundaries[index], boundaries[index + 1]
+        values = columns["cell"][start:end] if key == "cell" else columns["stat_ref"][start:end]
+        result.append({"destinations": od_json_rows(values, columns["number_of_trips"][start:end], key)})
+    return json_bytes({"result": result})
+
+# Arrow IPC stream with one record batch, metadata values are stored json encoded in the schema metadata.
+def encode_arrow(columns: dict, metadata: dict):
+    table = pyarrow.table(
+        {name: pyarrow.array(values) for name, values in columns.items()},
+        metadata={name: json.dumps(value) for name, value in metadata.items()}
+    )
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+# A map with the metadata, the columns and their dtypes. Numeric columns are raw little endian buffers,
+# so they can be read with numpy.frombuffer.
+def encode_msgpack(columns: dict, metadata: dict):
+    encoded_columns = {}
+    dtypes = {}
+    for name, values in columns.items():
+        if isinstance(values, np.ndarray):
+            values = values.astype(values.dtype.newbyteorder("<"), copy=False)
+            encoded_columns[name] = values.tobytes()
+            dtypes[name] = values.dtype.str
+        else:
+            encoded_columns[name] = values
+    return msgpack.packb({**metadata, "columns": encoded_columns, "dtypes": dtypes})
+
+@metrics.timed("serialize.columnar")
+def encode(media_type: str, columns: dict, metadata: dict | None = None):
+    if media_type == arrow_media_type:
+        return encode_arrow(columns, metadata or {})
+    return encode_msgpack(columns, metadata or {})
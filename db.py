@@ -1,217 +1,245 @@
 from db_helper import db_helper
-from datetime import timedelta
+from psycopg.rows import dict_row
 import query_od_parameters
+import query_builder
+import result_cache
+import metrics
+import singleflight
+import od_cube
+import time
 
-def query_h3_destinations(
+@singleflight.coalesced
+@result_cache.cached
+async def query_h3_destinations(
     origin_cells: list[int], 
     h3_resolution: int, 
     data: query_od_parameters.QueryODParameters):
-    stmt = """
-        SELECT * 
-        FROM (
-            SELECT destination_cell as cell, sum(number_of_trips) as number_of_trips
-            FROM od_h3
-            WHERE origin_cell IN %(origin_cells)s
-            AND h3_level = %(h3_resolution)s
-            AND (%(dont_filter_on_modality)s = true OR modality IN %(modalities)s)
-            AND aggregation_period_id IN (
-                SELECT aggregation_period_id 
-                FROM od_aggregation_period
-                WHERE (%(dont_filter_on_days_of_week)s = true OR extract(isodow from start_time_period) IN %(days_of_week)s)
-                AND (%(dont_filter_on_time_periods)s = true OR extract(hour from start_time_period) IN %(time_periods)s)
-                AND start_time_period >= %(start_period)s AND start_time_period <= (%(end_period)s + 1)
-            ) GROUP by destination_cell order by sum(number_of_trips) DESC
-        ) as q1
-        WHERE number_of_trips >= 4
-    """
-    with db_helper.get_resource() as (cur, conn):
-        try:
-            cur.execute("SET TIME ZONE 'Europe/Amsterdam'")
-            cur.execute(stmt, {
-                "origin_cells": tuple(origin_cells),
-                "h3_resolution": h3_resolution,
-                "dont_filter_on_modality": data.dont_filter_on_modality,
-                "modalities": tuple(data.modalities),
-                "dont_filter_on_days_of_week": data.dont_filter_on_days_of_week,
-                "days_of_week": tuple(data.days_of_week),
-                "dont_filter_on_time_periods": data.dont_filter_on_time_periods,
-                "time_periods": tuple(data.time_periods),
-                "start_period": data.start_date,
-                "end_period": data.end_date
-                })
-            return cur.fetchall()
-        except Exception as e:
-            conn.rollback()
-            print(e)
+    return await query_od("query_h3_destinations", (origin_cells, h3_resolution, data))
 
-def query_h3_origins(
+@singleflight.coalesced
+@result_cache.cached
+async def query_h3_origins(
     destination_cells: list[int], 
     h3_resolution: int, 
     data: query_od_parameters.QueryODParameters):
-    stmt = """
-        SELECT * 
-        FROM (
-            SELECT origin_cell as cell, sum(number_of_trips) as number_of_trips
-            FROM od_h3
-            WHERE destination_cell IN %(destination_cells)s
-            AND h3_level = %(h3_resolution)s
-            AND (%(dont_filter_on_modality)s = true or modality IN %(modalities)s)
-            AND aggregation_period_id IN (
-                SELECT aggregation_period_id 
-                FROM od_aggregation_period
-                WHERE (%(dont_filter_on_days_of_week)s = true OR extract(isodow from start_time_period) IN %(days_of_week)s)
-                AND (%(dont_filter_on_time_periods)s = true OR extract(hour from start_time_period) IN %(time_periods)s)
-                AND start_time_period >= %(start_period)s and start_time_period <= %(end_period)s
-            ) GROUP by origin_cell order by sum(number_of_trips) DESC    
-        ) as q1
-        WHERE number_of_trips >= 4
-    """
-    with db_helper.get_resource() as (cur, conn):
+    return await query_od("query_h3_origins", (destination_cells, h3_resolution, data))
+
+@singleflight.coalesced
+@result_cache.cached
+async def query_geometry_destinations(
+    origin_stat_refs: list[str], 
+    data: query_od_parameters.QueryODParameters):
+    return await query_od("query_geometry_destinations", (origin_stat_refs, data))
+
+@singleflight.coalesced
+@result_cache.cached
+async def query_geometry_origins(
+    destination_stat_refs: list[str], 
+    data: query_od_parameters.QueryODParameters):
+    return await query_od("query_geometry_origins", (destination_stat_refs, data))
+
+@singleflight.coalesced
+@result_cache.cached
+async def query_h3_matrix(
+    origin_cells: list[int],
+    destination_cells: list[int],
+    h3_resolution: int,
+    data: query_od_parameters.QueryODParameters):
+    stmt, params = await query_builder.matrix_statement(origin_cells, destination_cells, h3_resolution, data)
+    start = time.perf_counter()
+    rows = None
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute("SET TIME ZONE 'Europe/Amsterdam'")
-            cur.execute(stmt, {
-                "destination_cells": tuple(destination_cells),
-                "h3_resolution": h3_resolution,
-                "dont_filter_on_modality": data.dont_filter_on_modality,
-                "modalities": tuple(data.modalities),
-                "dont_filter_on_days_of_week": data.dont_filter_on_days_of_week,
-                "days_of_week": tuple(data.days_of_week),
-                "dont_filter_on_time_periods": data.dont_filter_on_time_periods,
-                "time_periods": tuple(data.time_periods),
-                "start_period": data.start_date,
-                "end_period": data.end_date
-                })
-            return cur.fetchall()
+            await db_helper.execute(cur, stmt, params)
+            rows = await cur.fetchall()
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
+    metrics.observe_query("query_h3_matrix", time.perf_counter() - start, rows, data.normalized())
+    return rows
 
-def query_geometry_destinations(
-    origin_stat_refs: list[str], 
-    data: query_od_parameters.QueryODParameters):
-    stmt = """
-        SELECT * 
-        FROM (
-            SELECT destination_stats_ref as destination_stat_ref, sum(number_of_trips) as number_of_trips
-            FROM od_geometry
-            WHERE origin_stats_ref IN %(origin_stat_refs)s
-            AND (%(dont_filter_on_modality)s = true OR modality IN %(modalities)s)
-            AND aggregation_period_id IN (
-                SELECT aggregation_period_id 
-                FROM od_aggregation_period
-                WHERE (%(dont_filter_on_days_of_week)s = true OR extract(isodow from start_time_period) IN %(days_of_week)s)
-                AND (%(dont_filter_on_time_periods)s = true OR extract(hour from start_time_period) IN %(time_periods)s)
-                AND start_time_period >= %(start_period)s AND start_time_period <= (%(end_period)s + 1)
-            ) GROUP by destination_stats_ref order by sum(number_of_trips) DESC
-        ) as q1
-        WHERE number_of_trips >= 4
-    """
-    with db_helper.get_resource() as (cur, conn):
+# Answers a single OD query from the in-memory cube, None when the cube is disabled or doesn't cover the query.
+async def query_od_cube(name: str, args):
+    if not od_cube.enabled:
+        return None
+    table, filter_column, _, key = query_builder.od_queries[name]
+    if table == "od_h3":
+        values, h3_resolution, data = args
+        h3_level = query_builder.h3_base_level(h3_resolution)
+    else:
+        values, data = args
+        h3_level = h3_resolution = None
+    return await od_cube.od_cube.query(
+        table, filter_column.startswith("origin"), key, values, h3_level, h3_resolution, data
+    )
+
+async def query_od(name: str, args):
+    rows = await query_od_cube(name, args)
+    if rows is not None:
+        return rows
+    stmt, params = await query_builder.single_od_statement(name, args)
+    start = time.perf_counter()
+    rows = None
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute("SET TIME ZONE 'Europe/Amsterdam'")
-            cur.execute(stmt, {
-                "origin_stat_refs": tuple(origin_stat_refs),
-                "dont_filter_on_modality": data.dont_filter_on_modality,
-                "modalities": tuple(data.modalities),
-                "dont_filter_on_days_of_week": data.dont_filter_on_days_of_week,
-                "days_of_week": tuple(data.days_of_week),
-                "dont_filter_on_time_periods": data.dont_filter_on_time_periods,
-                "time_periods": tuple(data.time_periods),
-                "start_period": data.start_date,
-                "end_period": data.end_date
-                })
-            return cur.fetchall()
+            await db_helper.execute(cur, stmt, params)
+            rows = [query_builder.od_row(name, row) for row in await cur.fetchall()]
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
+    metrics.observe_query(name, time.perf_counter() - start, rows, args[-1].normalized())
+    return rows
 
-def query_geometry_origins(
-    destination_stat_refs: list[str], 
-    data: query_od_parameters.QueryODParameters):
-    stmt = """
-        SELECT * 
-        FROM (
-            SELECT origin_stats_ref as origin_stat_ref, sum(number_of_trips) as number_of_trips
-            FROM od_geometry
-            WHERE destination_stats_ref IN %(destination_stat_refs)s
-            AND (%(dont_filter_on_modality)s = true or modality IN %(modalities)s)
-            AND aggregation_period_id IN (
-                SELECT aggregation_period_id 
-                FROM od_aggregation_period
-                WHERE (%(dont_filter_on_days_of_week)s = true OR extract(isodow from start_time_period) IN %(days_of_week)s)
-                AND (%(dont_filter_on_time_periods)s = true OR extract(hour from start_time_period) IN %(time_periods)s)
-                AND start_time_period >= %(start_period)s and start_time_period <= %(end_period)s
-            ) GROUP by origin_stats_ref order by sum(number_of_trips) DESC    
-        ) as q1
-        WHERE number_of_trips >= 4
-    """
-    with db_helper.get_resource() as (cur, conn):
+# Streams the result of a single OD query in batches from a server side cursor,
+# the result is not cached. Errors are raised, a failed query must not look like an empty result.
+async def stream_query(name: str, args, batch_size: int):
+    stmt, params = await query_builder.single_od_statement(name, args)
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            async with conn.cursor(name="od_stream", row_factory=dict_row) as server_cursor:
+                await server_cursor.execute(stmt, params)
+                while True:
+                    rows = await server_cursor.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+                    yield [query_builder.od_row(name, row) for row in rows]
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+            raise
+
+# Runs several OD queries, specified as (name of the single query function, args), in one statement.
+# Results are shared with the result cache of the single queries.
+async def query_batch(queries: list[tuple[str, tuple]]):
+    results = [await result_cache.lookup(name, args) for name, args in queries]
+    missing = [index for index, result in enumerate(results) if result is None]
+    for index in missing:
+        results[index] = await query_od_cube(*queries[index])
+        if results[index] is not None:
+            await result_cache.store(*queries[index], results[index])
+    missing = [index for index, result in enumerate(results) if result is None]
+    if len(missing) == 0:
+        return results
+
+    stmt, params = await query_builder.batch_od_statement([(index, *queries[index]) for index in missing])
+
+    start = time.perf_counter()
+    rows = None
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute("SET TIME ZONE 'Europe/Amsterdam'")
-            cur.execute(stmt, {
-                "destination_stat_refs": tuple(destination_stat_refs),
-                "dont_filter_on_modality": data.dont_filter_on_modality,
-                "modalities": tuple(data.modalities),
-                "dont_filter_on_days_of_week": data.dont_filter_on_days_of_week,
-                "days_of_week": tuple(data.days_of_week),
-                "dont_filter_on_time_periods": data.dont_filter_on_time_periods,
-                "time_periods": tuple(data.time_periods),
-                "start_period": data.start_date,
-                "end_period": data.end_date
-                })
-            return cur.fetchall()
+            await db_helper.execute(cur, stmt, params)
+            rows = await cur.fetchall()
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
+    metrics.observe_query("query_batch", time.perf_counter() - start, rows, [(queries[index][0], queries[index][1][-1].normalized()) for index in missing])
+    if rows is None:
+        return None
+
+    for index in missing:
+        results[index] = []
+    for row in rows:
+        results[row["spec"]].append(query_builder.od_row(queries[row["spec"]][0], row))
+    for index in missing:
+        await result_cache.store(*queries[index], results[index])
+    return results
+
+h3_acl_statement = db_helper.register("get_h3_acl", """
+    SELECT municipality_code, cells
+    FROM od_h3_acl
+    WHERE h3_level = %(h3_level)s
+""")
 
-def get_accessible_h3_cells(municipalities: list[str], h3_resolution: int):
-    stmt = """
-        SELECT DISTINCT(UNNEST(cells)) as h3_cell
-        FROM od_h3_acl
-        WHERE municipality_code IN %(municipality_code)s
-        AND h3_level = %(h3_level)s
-    """
-    with db_helper.get_resource() as (cur, conn):
+async def get_h3_acl(h3_resolution: int):
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute(stmt, {
-                "municipality_code": tuple(municipalities),
+            await db_helper.execute(cur, h3_acl_statement, {
                 "h3_level": h3_resolution
             })
-            return cur.fetchall()
+            return await cur.fetchall()
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
 
-def get_accessible_geometries(municipalities: list[str]):
-    stmt = """
-    SELECT zone_id, municipality, stats_ref 
-    FROM residential_areas 
-    WHERE municipality IN %(municipalities)s;
-    """
-    with db_helper.get_resource() as (cur, conn):
+accessible_geometries_statement = db_helper.register("get_accessible_geometries", """
+    SELECT zone_id, municipality, stats_ref
+    FROM residential_areas
+    WHERE municipality = ANY(%(municipalities)s::text[])
+""")
+
+async def get_accessible_geometries(municipalities: list[str]):
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute(stmt, {
-                "municipalities": tuple(municipalities),
+            await db_helper.execute(cur, accessible_geometries_statement, {
+                "municipalities": list(municipalities),
             })
-            return cur.fetchall()
+            return await cur.fetchall()
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
 
-def get_accessible_geometries_with_geojson(municipalities: list[str]):
-    stmt = """
-    SELECT zone_id, area, municipality, stats_ref 
-    FROM residential_areas 
-    WHERE municipality IN %(municipalities)s;
-    """
-    with db_helper.get_resource() as (cur, conn):
+accessible_geometries_with_geojson_statement = db_helper.register("get_accessible_geometries_with_geojson", """
+    SELECT zone_id, area, municipality, stats_ref
+    FROM residential_areas
+    WHERE municipality = ANY(%(municipalities)s::text[])
+""")
+
+async def get_accessible_geometries_with_geojson(municipalities: list[str]):
+    async with db_helper.get_resource() as (cur, conn):
         try:
-            cur.execute(stmt, {
-                "municipalities": tuple(municipalities),
+            await db_helper.execute(cur, accessible_geometries_with_geojson_statement, {
+                "municipalities": list(municipalities),
             })
-            return cur.fetchall()
+            return await cur.fetchall()
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             print(e)
 
-  
\ No newline at end of file
+  
+
+geometries_with_geojson_statement = db_helper.register("get_geometries_with_geojson", """
+    SELECT zone_id, area, municipality, stats_ref
+    FROM residential_areas
+    WHERE stats_ref = ANY(%(stats_refs)s::text[])
+""")
+
+async def get_geometries_with_geojson(stats_refs: list[str]):
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            await db_helper.execute(cur, geometries_with_geojson_statement, {
+                "stats_refs": list(stats_refs),
+            })
+            return await cur.fetchall()
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+
+stats_ref_municipalities_statement = db_helper.register("get_stats_ref_municipalities", """
+    SELECT stats_ref, municipality
+    FROM residential_areas
+""")
+
+async def get_stats_ref_municipalities():
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            await db_helper.execute(cur, stats_ref_municipalities_statement)
+            return await cur.fetchall()
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+
+# Changes when rows of residential_areas are inserted, updated or deleted, without reading the areas.
+residential_areas_version_statement = db_helper.register("get_residential_areas_version", """
+    SELECT count(*) as count, coalesce(sum(xmin::text::bigint), 0) as xmin_sum
+    FROM residential_areas
+""")
+
+async def get_residential_areas_version():
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            await db_helper.execute(cur, residential_areas_version_statement)
+            row = await cur.fetchone()
+            return f"{row['count']}:{row['xmin_sum']}"
+        except Exception as e:
+            await conn.rollback()
+            print(e)
@@ -1,32 +1,111 @@
-from psycopg2 import pool
-from psycopg2.extras import RealDictCursor
-from contextlib import contextmanager
+from psycopg_pool import AsyncConnectionPool
+from psycopg.rows import dict_row
+from contextlib import asynccontextmanager
+import asyncio
 import os
 
 class DBHelper:
-    def __init__(self, conn_str):
+    def __init__(self, conn_str, min_size=2, max_size=10, timeout=30.0, max_lifetime=3600.0, max_idle=600.0,
+            check_interval=60.0, time_zone="Europe/Amsterdam", statement_timeout="0", application_name="od-api",
+            prepare=True, prepared_max=100):
         self._connection_pool = None
+        self._check_task = None
+        self._lock = asyncio.Lock()
         self.conn_str = conn_str
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.time_zone = time_zone
+        self.statement_timeout = statement_timeout
+        self.application_name = application_name
+        self.prepare = prepare
+        self.prepared_max = prepared_max
+        # name: statement, statements that are executed often with only different parameters.
+        self.statements = {}
+        self._registered = set()
 
-    def initialize_connection_pool(self):
-        self._connection_pool = pool.ThreadedConnectionPool(2, 10 , self.conn_str)
+    async def initialize_connection_pool(self):
+        async with self._lock:
+            if self._connection_pool is not None:
+                return
+            connection_pool = AsyncConnectionPool(
+                self.conn_str,
+                min_size=self.min_size,
+                max_size=self.max_size,
+                timeout=self.timeout,
+                max_lifetime=self.max_lifetime,
+                max_idle=self.max_idle,
+                configure=self.configure_connection,
+                open=False
+            )
+            await connection_pool.open()
+            self._connection_pool = connection_pool
+            if self.check_interval > 0:
+                self._check_task = asyncio.create_task(self.check_periodically())
 
-    @contextmanager
-    def get_resource(self):
+    # Session settings are set once per connection instead of before every query.
+    async def configure_connection(self, conn):
+        await conn.execute(
+            "SELECT set_config('timezone', %s, false), set_config('statement_timeout', %s, false), set_config('application_name', %s, false)",
+            (self.time_zone, self.statement_timeout, self.application_name)
+        )
+        await conn.commit()
+        conn.prepared_max = self.prepared_max
+        if not self.prepare:
+            conn.prepare_threshold = None
+
+    # Idle connections that were closed by the server are replaced before a request gets them.
+    async def check_periodically(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self._connection_pool.check()
+            except Exception as e:
+                print(e)
+
+    def register(self, name: str, stmt: str):
+        self.statements[name] = stmt
+        self._registered.add(stmt)
+        return stmt
+
+    # Registered statements are prepared on their first execution on a connection, psycopg keeps the
+    # prepared_max most recently used prepared statements per connection. Other statements, such as the
+    # generated OD queries, are only prepared when they are executed prepare_threshold times, so they
+    # don't push the registered statements out.
+    async def execute(self, cur, stmt: str, params=None):
+        if not self.prepare:
+            prepare = False
+        elif stmt in self._registered:
+            prepare = True
+        else:
+            prepare = None
+        await cur.execute(stmt, params, prepare=prepare)
+
+    @asynccontextmanager
+    async def get_resource(self):
         if self._connection_pool is None:
-            self.initialize_connection_pool()
+            await self.initialize_connection_pool()
+
+        async with self._connection_pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                yield cursor, conn
 
-        conn = self._connection_pool.getconn()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        try:
-            yield cursor, conn
-        finally:
-            cursor.close()
-            self._connection_pool.putconn(conn)
+    # Statistics of psycopg_pool, such as pool_size, pool_available, requests_waiting and requests_wait_ms.
+    def get_stats(self):
+        if self._connection_pool is None:
+            return {}
+        return self._connection_pool.get_stats()
 
-    def shutdown_connection_pool(self):
+    async def shutdown_connection_pool(self):
+        if self._check_task is not None:
+            self._check_task.cancel()
+            self._check_task = None
         if self._connection_pool is not None:
-            self._connection_pool.closeall()
+            await self._connection_pool.close()
+            self._connection_pool = None
 
 # Init normal db
 conn_str = f"dbname={os.getenv('DB_NAME')}"
@@ -40,4 +119,17 @@ if "DB_PASSWORD" in os.environ:
 if "DB_PORT" in os.environ:
     conn_str += " port={}".format(os.environ['DB_PORT'])
 
-db_helper = DBHelper(conn_str)
+db_helper = DBHelper(
+    conn_str,
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    max_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", "3600")),
+    max_idle=float(os.getenv("DB_POOL_MAX_IDLE", "600")),
+    check_interval=float(os.getenv("DB_POOL_CHECK_INTERVAL", "60")),
+    time_zone=os.getenv("DB_TIME_ZONE", "Europe/Amsterdam"),
+    statement_timeout=os.getenv("DB_STATEMENT_TIMEOUT", "0"),
+    application_name=os.getenv("DB_APPLICATION_NAME", "od-api"),
+    prepare=os.getenv("DB_PREPARED_STATEMENTS", "true") == "true",
+    prepared_max=int(os.getenv("DB_PREPARED_MAX", "100"))
+)
@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import asyncio
+import os
+
+# Serialization and aggregation of large results run outside the event loop. Jobs smaller than
+# EXECUTOR_THREAD_MIN_SIZE run inline, larger jobs on a thread pool and jobs of at least
+# EXECUTOR_PROCESS_MIN_SIZE on a process pool, when EXECUTOR_PROCESSES is set. Jobs for the process
+# pool take numpy arrays, strings and bytes and return bytes, those are pickled as flat buffers.
+threads = int(os.getenv("EXECUTOR_THREADS", "4"))
+processes = int(os.getenv("EXECUTOR_PROCESSES", "0"))
+thread_min_size = int(os.getenv("EXECUTOR_THREAD_MIN_SIZE", "10000"))
+process_min_size = int(os.getenv("EXECUTOR_PROCESS_MIN_SIZE", "200000"))
+
+_thread_pool: ThreadPoolExecutor | None = None
+_process_pool: ProcessPoolExecutor | None = None
+
+def thread_pool():
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="executor")
+    return _thread_pool
+
+# Workers are spawned instead of forked, forking a process with running threads and open connections isn't safe.
+def process_pool():
+    global _process_pool
+    if _process_pool is None and processes > 0:
+        _process_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+async def run_in_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(thread_pool(), func, *args)
+
+# size is the number of rows or items of the job, process=False keeps jobs with large python objects
+# as arguments on the thread pool, pickling those would cost more than it saves.
+async def run(func, *args, size: int, process: bool = True):
+    global _process_pool
+    if size < thread_min_size:
+        return func(*args)
+    if process and size >= process_min_size and process_pool() is not None:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(_process_pool, func, *args)
+        except BrokenProcessPool as e:
+            # A worker died, the pool is recreated for the next job and this job runs on a thread.
+            print(e)
+            _process_pool = None
+    return await run_in_thread(func, *args)
+
+def shutdown():
+    global _thread_pool, _process_pool
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
@@ -0,0 +1,106 @@
+from cache import TTLCache
+import numpy as np
+import json
+import os
+
+# Residential areas hardly ever change, so they are cached as encoded json per municipality and zoom level
+# and spliced into the response without parsing and encoding the coordinates again.
+bundle_cache = TTLCache(
+    max_size=int(os.getenv("GEOMETRY_CACHE_MAX_SIZE", "10000")),
+    ttl=float(os.getenv("GEOMETRY_CACHE_TTL", "3600")),
+    max_weight=int(os.getenv("GEOMETRY_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+)
+# Simplified polygons deviate at most this many pixels (of a 256 pixel tile) from the original.
+simplify_pixels = float(os.getenv("GEOMETRY_SIMPLIFY_PIXELS", "1"))
+
+class Bundle:
+    """Encoded geometries of one municipality, comma separated so bundles can be joined into a json list."""
+
+    def __init__(self, zones: list[bytes]):
+        self.content = b",".join(zones)
+
+def tolerance(zoom: int):
+    return simplify_pixels * 360 / (256 * 2 ** zoom)
+
+# Douglas-Peucker, rings that would collapse are kept as they are.
+def simplify_ring(ring: list, epsilon: float):
+    points = np.asarray(ring, dtype=np.float64)
+    if len(points) <= 4:
+        return ring
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first, :2], points[last, :2]
+        segment = points[first + 1:last, :2] - start
+        direction = end - start
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(segment[:, 0], segment[:, 1])
+        else:
+            distances = np.abs(segment[:, 0] * direction[1] - segment[:, 1] * direction[0]) / length
+        index = int(np.argmax(distances))
+        if distances[index] > epsilon:
+            index += first + 1
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    if keep.sum() < 4:
+        return ring
+    return points[keep].tolist()
+
+def simplify(geometry: dict, epsilon: float):
+    if geometry.get("type") == "Polygon":
+        geometry["coordinates"] = [simplify_ring(ring, epsilon) for ring in geometry["coordinates"]]
+    elif geometry.get("type") == "MultiPolygon":
+        geometry["coordinates"] = [[simplify_ring(ring, epsilon) for ring in polygon] for polygon in geometry["coordinates"]]
+    return geometry
+
+def encode_zone(zone_id, area: str, municipality: str, stats_ref: str, zoom: int | None):
+    if zoom is not None:
+        area = json.dumps(simplify(json.loads(area), tolerance(zoom)), separators=(",", ":"))
+    return b"".join((
+        b'{"zone_id":', json.dumps(zone_id).encode(),
+        b',"geojson":', area.encode(),
+        b',"municipality_code":', json.dumps(municipality).encode(),
+        b',"stats_ref":', json.dumps(stats_ref).encode(),
+        b"}"
+    ))
+
+def get(municipality: str, zoom: int | None) -> Bundle | None:
+    return bundle_cache.get((municipality, zoom))
+
+# Runs in the executor, simplifying the polygons of a municipality takes a while at low zoom levels.
+# Values of the rows that encode_zone uses, tuples are sent to the process pool instead of the row dicts.
+def zone_values(rows):
+    return [(row["zone_id"], row["area"], row["municipality"], row["stats_ref"]) for row in rows]
+
+def encode_zones(zones: list[tuple], zoom: int | None) -> list[bytes]:
+    return [encode_zone(*zone, zoom) for zone in zones]
+
+# Size of an encode_zones job for the executor, about the number of positions to simplify.
+def job_size(rows, zoom: int | None):
+    if zoom is None:
+        return 0
+    return sum(row["area"].count("[") for row in rows)
+
+def store(municipality: str, zoom: int | None, zones: list[bytes]) -> Bundle:
+    bundle = Bundle(zones)
+    bundle_cache.set((municipality, zoom), bundle, weight=len(bundle.content))
+    return bundle
+
+def encode_response(bundles: list[Bundle], all_accessible: bool):
+    return b"".join((
+        b'{"result":{"all_accessible":', json.dumps(all_accessible).encode(),
+        b',"accessible_geometries":[', b",".join(bundle.content for bundle in bundles if bundle.content),
+        b"]}}"
+    ))
+
+def invalidate():
+    bundle_cache.clear()
+
+def stats():
+    return bundle_cache.stats()
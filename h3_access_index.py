@@ -0,0 +1,110 @@
+import numpy as np
+import h3_codec
+import hashlib
+import asyncio
+import os
+import db
+
+# Levels below this aren't stored in od_h3_acl, a coarser cell is accessible when all its children at this level are.
+BASE_LEVEL = 7
+
+class H3AccessIndex:
+    """Sorted uint64 arrays of the cells in od_h3_acl per h3_level and municipality."""
+
+    def __init__(self):
+        self._cells_per_level = {}
+        self._versions = {}
+        self._lock = asyncio.Lock()
+
+    async def load(self, h3_level: int):
+        cells_per_municipality = {}
+        for row in await db.get_h3_acl(h3_level):
+            cells = np.array(row["cells"] or [], dtype=np.uint64)
+            cells_per_municipality.setdefault(row["municipality_code"], []).append(cells)
+        self._cells_per_level[h3_level] = {
+            municipality_code: np.unique(np.concatenate(cells))
+            for municipality_code, cells in cells_per_municipality.items()
+        }
+        self._versions[h3_level] = checksum(self._cells_per_level[h3_level])
+
+    async def get(self, h3_level: int):
+        if h3_level not in self._cells_per_level:
+            async with self._lock:
+                if h3_level not in self._cells_per_level:
+                    await self.load(h3_level)
+        return self._cells_per_level[h3_level]
+
+    async def has_access(self, municipalities, cells: list[int], h3_level: int):
+        requested_cells = np.array(cells, dtype=np.uint64)
+        if h3_level < BASE_LEVEL:
+            accessible_cells = await self.accessible_cells(municipalities, h3_level)
+            if len(accessible_cells) == 0:
+                return len(requested_cells) == 0
+            positions = np.searchsorted(accessible_cells, requested_cells)
+            positions[positions == len(accessible_cells)] = 0
+            return bool((accessible_cells[positions] == requested_cells).all())
+        index = await self.get(h3_level)
+        found = np.zeros(len(requested_cells), dtype=bool)
+        for municipality in municipalities:
+            accessible_cells = index.get(municipality)
+            if accessible_cells is None or len(accessible_cells) == 0:
+                continue
+            positions = np.searchsorted(accessible_cells, requested_cells)
+            positions[positions == len(accessible_cells)] = 0
+            found |= accessible_cells[positions] == requested_cells
+        return bool(found.all())
+
+    # Coarse cells can be covered by the children of several municipalities together.
+    async def accessible_cells(self, municipalities, h3_level: int):
+        if h3_level < BASE_LEVEL:
+            return h3_codec.complete_parents(await self.accessible_cells(municipalities, BASE_LEVEL), h3_level)
+        index = await self.get(h3_level)
+        cells = [index[municipality] for municipality in municipalities if municipality in index]
+        if len(cells) == 0:
+            return np.array([], dtype=np.uint64)
+        return np.unique(np.concatenate(cells))
+
+    # The municipalities, the offsets of their cells and the concatenated cells of a level, for snapshot files.
+    async def export(self, h3_level: int):
+        index = await self.get(h3_level)
+        municipalities = sorted(index)
+        lengths = [len(index[municipality]) for municipality in municipalities]
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        cells = np.concatenate([index[municipality] for municipality in municipalities] or [np.array([], dtype=np.uint64)])
+        return municipalities, offsets, cells.astype(np.uint64)
+
+    # Replaces a level with arrays written by export, the cells of a municipality are views of cells.
+    def load_export(self, h3_level: int, municipalities: list[str], offsets: np.ndarray, cells: np.ndarray):
+        self._cells_per_level[h3_level] = {
+            municipality: cells[offsets[index]:offsets[index + 1]]
+            for index, municipality in enumerate(municipalities)
+        }
+        self._versions[h3_level] = checksum(self._cells_per_level[h3_level])
+
+    # Checksum of the cells of a level as loaded from od_h3_acl, coarser levels are derived from BASE_LEVEL.
+    async def version(self, h3_level: int):
+        h3_level = max(h3_level, BASE_LEVEL)
+        await self.get(h3_level)
+        return self._versions[h3_level]
+
+    async def refresh_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            for h3_level in list(self._cells_per_level):
+                try:
+                    await self.load(h3_level)
+                except Exception as e:
+                    print(e)
+
+def checksum(cells_per_municipality: dict):
+    digest = hashlib.sha256()
+    for municipality in sorted(cells_per_municipality):
+        digest.update(municipality.encode() + b"\0")
+        digest.update(np.ascontiguousarray(cells_per_municipality[municipality], dtype=np.uint64).tobytes())
+    return digest.hexdigest()
+
+h3_access_index = H3AccessIndex()
+
+def start_background_refresh():
+    interval = float(os.getenv("H3_ACCESS_INDEX_REFRESH_INTERVAL", "600"))
+    return asyncio.create_task(h3_access_index.refresh_periodically(interval))
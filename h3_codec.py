@@ -0,0 +1,99 @@
+import numpy as np
+
+# Vectorized conversion between h3 indexes as uint64 and their hex string representation.
+# Bit layout of an h3 index: 1 reserved bit, 4 bits mode, 3 bits mode dependent,
+# 4 bits resolution, 7 bits base cell and 15 digits of 3 bits.
+
+_INVALID = 255
+_HEX_VALUES = np.full(256, _INVALID, dtype=np.uint8)
+_HEX_VALUES[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+_HEX_VALUES[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+_HEX_VALUES[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+
+H3_CELL_MODE = 1
+
+def to_array(cells):
+    return np.asarray(cells, dtype=np.uint64)
+
+def to_strings(cells) -> list[str]:
+    cells = to_array(cells)
+    if len(cells) == 0:
+        return []
+    # Like h3.h3_to_string leading zeros are omitted, for valid cells that is always exactly one.
+    if not (((cells >> np.uint64(60)) == 0) & ((cells >> np.uint64(56)) != 0)).all():
+        return [format(cell, "x") for cell in cells.tolist()]
+    hex_string = cells.astype(">u8").tobytes().hex()
+    return [hex_string[offset + 1:offset + 16] for offset in range(0, len(hex_string), 16)]
+
+def from_strings(strings: list[str]) -> np.ndarray:
+    if len(strings) == 0:
+        return np.array([], dtype=np.uint64)
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    if lengths.min() == 0 or lengths.max() > 16:
+        raise ValueError("h3 index should be between 1 and 16 characters")
+    try:
+        joined = "".join(strings).encode("ascii")
+    except UnicodeEncodeError:
+        raise ValueError("h3 index contains non hexadecimal characters")
+    if (lengths == lengths[0]).all():
+        chars = np.frombuffer(joined, dtype=np.uint8).reshape(len(strings), lengths[0])
+    else:
+        padded = np.char.rjust(np.array(strings, dtype="S16"), 16, b"0")
+        chars = padded.view(np.uint8).reshape(len(strings), 16)
+    values = _HEX_VALUES[chars]
+    if (values == _INVALID).any():
+        raise ValueError("h3 index contains non hexadecimal characters")
+    # Right align the nibbles in 16 positions, combine them into bytes and read those as big endian uint64.
+    nibbles = np.zeros((len(strings), 16), dtype=np.uint8)
+    nibbles[:, 16 - chars.shape[1]:] = values
+    octets = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+    return np.ascontiguousarray(octets).view(">u8").ravel().astype(np.uint64)
+
+def get_resolutions(cells) -> np.ndarray:
+    return ((to_array(cells) >> np.uint64(52)) & np.uint64(0xF)).astype(np.int64)
+
+def are_cells(cells) -> np.ndarray:
+    cells = to_array(cells)
+    return ((cells >> np.uint64(59)) & np.uint64(0xF)) == H3_CELL_MODE
+
+def _digit_bits(first_resolution: int, last_resolution: int):
+    # Bits of the digits first_resolution up to and including last_resolution.
+    return sum(0x7 << 3 * (15 - resolution) for resolution in range(first_resolution, last_resolution + 1))
+
+def parent_constants(resolution: int):
+    # to_parents is (cells & keep) | set.
+    unused_digits = _digit_bits(resolution + 1, 15)
+    keep = ~((0xF << 52) | unused_digits) & 0xFFFFFFFFFFFFFFFF
+    return keep, (resolution << 52) | unused_digits
+
+def to_parents(cells, resolution: int) -> np.ndarray:
+    keep, set_bits = parent_constants(resolution)
+    return (to_array(cells) & np.uint64(keep)) | np.uint64(set_bits)
+
+# Children of the deleted subsequence of pentagons are included as well, they don't occur in the data.
+def to_children(cells, resolution: int) -> np.ndarray:
+    cells = to_array(cells)
+    children = []
+    for cell_resolution in np.unique(get_resolutions(cells)).tolist():
+        group = cells[get_resolutions(cells) == cell_resolution]
+        if cell_resolution >= resolution:
+            children.append(group)
+            continue
+        offsets = np.zeros(1, dtype=np.uint64)
+        for digit in range(cell_resolution + 1, resolution + 1):
+            offsets = (offsets[:, None] | (np.arange(7, dtype=np.uint64) << np.uint64(3 * (15 - digit)))[None, :]).ravel()
+        keep = ~((0xF << 52) | _digit_bits(cell_resolution + 1, resolution)) & 0xFFFFFFFFFFFFFFFF
+        base = (group & np.uint64(keep)) | np.uint64(resolution << 52)
+        children.append((base[:, None] | offsets[None, :]).ravel())
+    if len(children) == 0:
+        return np.array([], dtype=np.uint64)
+    return np.concatenate(children)
+
+# Parents at resolution of which all children are in cells, cells should be unique and of one resolution.
+def complete_parents(cells, resolution: int) -> np.ndarray:
+    cells = to_array(cells)
+    if len(cells) == 0:
+        return cells
+    cell_resolution = int(get_resolutions(cells[:1])[0])
+    parents, counts = np.unique(to_parents(cells, resolution), return_counts=True)
+    return parents[counts == 7 ** (cell_resolution - resolution)]
@@ -0,0 +1,107 @@
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from aggregation_periods import aggregation_period_index
+from h3_access_index import h3_access_index
+import geometry_cache
+import result_cache
+import asyncio
+import hashlib
+import tiles
+import time
+import db
+import os
+
+# Responses carry an ETag of the normalized request and the version of the data they are made of,
+# If-None-Match is answered with a 304 before the query runs. OD results of historical ranges can be
+# stored for HTTP_CACHE_MAX_AGE seconds, other responses have to be revalidated.
+max_age = int(os.getenv("HTTP_CACHE_MAX_AGE", "86400"))
+# Responses depend on the Authorization header, shared caches only store them with HTTP_CACHE_PUBLIC=true.
+scope = "public" if os.getenv("HTTP_CACHE_PUBLIC", "false") == "true" else "private"
+residential_areas_refresh_interval = float(os.getenv("RESIDENTIAL_AREAS_VERSION_REFRESH_INTERVAL", "60"))
+
+# Count and xmin checksum of residential_areas, None until it is loaded.
+residential_areas_version = None
+
+class Validator:
+    """ETag and caching headers of a response, without an ETag when the data version is unknown."""
+
+    def __init__(self, etag: str | None, cache_control: str, vary: str):
+        self.etag = etag
+        self.cache_control = cache_control
+        self.vary = vary
+
+    def headers(self):
+        headers = {"Cache-Control": self.cache_control, "Vary": self.vary}
+        if self.etag is not None:
+            headers["ETag"] = self.etag
+        return headers
+
+    # Weak comparison, as If-None-Match requires.
+    def matches(self, request: Request):
+        if self.etag is None:
+            return False
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is None:
+            return False
+        etags = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+        return "*" in etags or self.etag in etags
+
+    def not_modified(self):
+        return Response(status_code=304, headers=self.headers())
+
+    # Responses that aren't cacheable, such as streams that can still fail after the headers are sent, get no ETag.
+    def apply(self, response, cacheable: bool = True):
+        if not isinstance(response, Response):
+            response = JSONResponse(content=jsonable_encoder(response))
+        headers = self.headers() if cacheable else {"Cache-Control": "no-store", "Vary": self.vary}
+        for name, value in headers.items():
+            response.headers[name] = value
+        return response
+
+def etag(*parts):
+    return '"' + hashlib.sha256(repr(parts).encode()).hexdigest()[:32] + '"'
+
+def revalidate():
+    return f"{scope}, no-cache"
+
+# The cache key of the result cache is the normalized query, variant holds what else changes the response.
+# Rows of the latest aggregation period can still arrive, so the ETag of recent ranges also changes
+# every RESULT_CACHE_RECENT_TTL seconds, like the results in the result cache.
+async def od_validator(name: str, args, *variant, vary: str = "Authorization, Accept"):
+    data = args[-1]
+    version = await aggregation_period_index.version(data.end_date)
+    if version == 0:
+        return Validator(None, revalidate(), vary)
+    if data.is_historical():
+        return Validator(etag(result_cache.cache_key(name, args), variant, version), f"{scope}, max-age={max_age}", vary)
+    window = int(time.time() // result_cache.recent_ttl)
+    return Validator(etag(result_cache.cache_key(name, args), variant, version, window), revalidate(), vary)
+
+async def accessible_h3_validator(municipalities, h3_level: int, *variant, vary: str = "Authorization, Accept"):
+    version = await h3_access_index.version(h3_level)
+    return Validator(etag("accessible_h3", sorted(municipalities), h3_level, variant, version), revalidate(), vary)
+
+def accessible_geometry_validator(municipalities, *variant, vary: str = "Authorization"):
+    if residential_areas_version is None:
+        return Validator(None, revalidate(), vary)
+    return Validator(etag("accessible_geometry", sorted(municipalities), variant, residential_areas_version), revalidate(), vary)
+
+async def load_residential_areas_version():
+    global residential_areas_version
+    version = await db.get_residential_areas_version()
+    if version is None:
+        return
+    if residential_areas_version is not None and version != residential_areas_version:
+        # The cached geometries are of the previous version.
+        geometry_cache.invalidate()
+        tiles.zone_cache.clear()
+    residential_areas_version = version
+
+async def refresh_periodically():
+    while True:
+        await asyncio.sleep(residential_areas_refresh_interval)
+        try:
+            await load_residential_areas_version()
+        except Exception as e:
+            print(e)
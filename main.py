@@ -1,24 +1,128 @@
-from fastapi import FastAPI, Query, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Query, Path, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from datetime import date
 import query_od_parameters
+import query_builder
 import db
-import h3
-from acl import get_acl, acl
+import h3_codec
+from acl import get_acl, acl, acl_cache
 import accessible_h3
 import accessible_geometry
+import geometry_cache
+import h3_access_index
+import result_cache
+import od_matrix
+import od_breakdown
+import columnar
+import tiles
+import metrics
+import batch_query
+import rollup
+import od_cube
+import snapshot
+import executor
+import http_cache
+from aggregation_periods import aggregation_period_index
+from db_helper import db_helper
+import numpy as np
+import asyncio
+import functools
+import json
+import time
+import os
 
 app = FastAPI()
 
+background_tasks = set()
+
+@app.on_event("startup")
+async def open_connection_pool():
+    await db_helper.initialize_connection_pool()
+
+@app.on_event("shutdown")
+async def close_connection_pool():
+    for task in background_tasks:
+        task.cancel()
+    executor.shutdown()
+    await db_helper.shutdown_connection_pool()
+
+@app.on_event("startup")
+async def start_acl_cache_listener():
+    channel = os.getenv("ACL_CACHE_NOTIFY_CHANNEL")
+    if channel:
+        background_tasks.add(asyncio.create_task(acl_cache.listen_for_invalidations(channel)))
+
+@app.on_event("startup")
+async def load_snapshot():
+    if snapshot.enabled:
+        await snapshot.refresh()
+        background_tasks.add(asyncio.create_task(snapshot.refresh_periodically()))
+
+# With snapshots the h3 access index and the od cube are refreshed by the snapshot loop.
+@app.on_event("startup")
+async def start_h3_access_index_refresh():
+    if not snapshot.enabled:
+        background_tasks.add(h3_access_index.start_background_refresh())
+
+# The API also starts when the database is unavailable, queries load the index when it is still empty.
+@app.on_event("startup")
+async def load_aggregation_periods():
+    try:
+        await aggregation_period_index.load_new_periods()
+    except Exception as e:
+        print(e)
+    background_tasks.add(asyncio.create_task(aggregation_period_index.refresh_periodically()))
+
+@app.on_event("startup")
+async def load_residential_areas_version():
+    try:
+        await http_cache.load_residential_areas_version()
+    except Exception as e:
+        print(e)
+    background_tasks.add(asyncio.create_task(http_cache.refresh_periodically()))
+
+@app.on_event("startup")
+async def start_od_cube_refresh():
+    if od_cube.enabled and not snapshot.enabled:
+        background_tasks.add(od_cube.start_background_refresh())
+
+@app.on_event("startup")
+async def start_rollup_refresh():
+    if rollup.enabled:
+        try:
+            await rollup.load_state()
+        except Exception as e:
+            print(e)
+        background_tasks.add(asyncio.create_task(rollup.refresh_periodically()))
+
 @app.middleware("http")
 async def authorize(request: Request, call_next):
-    result = get_acl.get_access(request=request)
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    result = await get_acl.get_access(request=request)
     if not result:
         return JSONResponse(status_code=401, content={"reason": "user is not authorized"})
     request.state.acl = result
     response = await call_next(request)
     return response
 
+# Registered after authorize, so the request duration includes authorization.
+@app.middleware("http")
+async def measure(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    endpoint = request.scope.get("endpoint")
+    metrics.request_duration.labels(
+        request.method,
+        route_paths().get(endpoint, "unmatched"),
+        response.status_code
+    ).observe(time.perf_counter() - start)
+    return response
+
+@functools.cache
+def route_paths():
+    return {route.endpoint: route.path for route in app.routes}
+
 start_date_query = Query(
     default = ...,
     example = "2023-02-14",
@@ -49,10 +153,11 @@ time_periods_query = Query(
 )
 h3_resolution_query = Query(
     default = ...,
-    regex = "^(7|8)$",
+    regex = "^(5|6|7|8)$",
     example = 7,
     title = "h3 resolution",
-    description = "h3 zoom level data should be received, 7 and 8 are allowed values.",
+    description = "h3 zoom level data should be received, 5, 6, 7 and 8 are allowed values. "
+    + "Resolutions 5 and 6 are aggregated from resolution 7.",
 )
 modalities_query = Query(
     default = None, 
@@ -84,26 +189,151 @@ destination_stat_refs_query = Query(
     description = "Specify destination stat_refs want to receive destinations from, currently only residential_areas (wijken) are supported."
 
 )
+matrix_representation_query = Query(
+    default = "sparse",
+    regex = "^(dense|sparse)$",
+    title = "Matrix representation",
+    description = "dense returns a full origins x destinations matrix, "
+    + "sparse returns only the non empty entries as parallel origin_index, destination_index and number_of_trips arrays (COO)."
+)
+matrix_format_query = Query(
+    default = "json",
+    regex = "^(json|npz)$",
+    title = "Output format",
+    description = "json or npz, npz is a NumPy archive with the origins and destinations as uint64 arrays "
+    + "and the arrays of the chosen representation."
+)
 origin_stat_refs_query = Query(
     default = ...,
     example = "cbs:WK059916,cbs:WK059917,cbs:WK059927,cbs:WK059901",
     title = "Origin cells",
     description = "Specify origin stat_refs want to receive destinations from, currently only residential_areas (wijken) are supported."
 )
+stream_query = Query(
+    default = None,
+    regex = "^(json|ndjson)$",
+    title = "Stream",
+    description = "Stream the result in batches instead of returning it at once, "
+    + "json streams the same document as the non streaming response, ndjson streams one row per line. "
+    + "Streamed results are not cached."
+)
+min_trips_query = Query(
+    default = query_od_parameters.MIN_TRIPS,
+    ge = query_od_parameters.MIN_TRIPS,
+    title = "Minimum number of trips",
+    description = f"Only return rows with at least this number of trips, never less than {query_od_parameters.MIN_TRIPS}."
+)
+top_k_query = Query(
+    default = None,
+    ge = 1,
+    title = "Top k",
+    description = "Only return the k rows with the most trips, pages with limit and offset or cursor are taken from these k rows."
+)
+limit_query = Query(
+    default = None,
+    ge = 1,
+    title = "Limit",
+    description = "Maximum number of rows of a page, rows are sorted on number_of_trips descending. "
+    + "When specified the result contains a next_cursor to request the next page, which is null on the last page."
+)
+offset_query = Query(
+    default = 0,
+    ge = 0,
+    title = "Offset",
+    description = "Number of rows to skip."
+)
+cursor_query = Query(
+    default = None,
+    title = "Cursor",
+    description = "next_cursor of the previous page, can't be combined with offset."
+)
+group_by_query = Query(
+    default = None,
+    regex = "^(date|isoweek|isodow|time_period|modality)$",
+    title = "Group by",
+    description = "Return the number of trips per date, isoweek, isodow (mo-su), time_period or modality. "
+    + "The result contains an array of buckets and per cell or stat_ref an array with the number of trips per bucket."
+)
+stream_batch_size = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
 
+# Results can be shared through the result cache, so rows are copied instead of modified.
+@metrics.timed("serialize.od_h3")
 def serialize_od_h3_result(results):
-    res = []
-    for result in results:
-        result["cell"] = h3.h3_to_string(result["cell"])
-        res.append(result)
-    return res
+    cells = h3_codec.to_strings([result["cell"] for result in results])
+    return [{**result, "cell": cell} for result, cell in zip(results, cells)]
 
 def serialize_od_geometry_result(results):
-    res = []
-    for result in results:
-        result["cell"] = h3.h3_to_string(result["cell"])
-        res.append(result)
-    return res
+    cells = h3_codec.to_strings([result["cell"] for result in results])
+    return [{**result, "cell": cell} for result, cell in zip(results, cells)]
+
+async def stream_od_result(first_batch, batches, stream: str, serialize):
+    async def all_batches():
+        yield first_batch
+        async for batch in batches:
+            yield batch
+
+    if stream == "json":
+        yield b'{"result":{"destinations":['
+    first = True
+    async for batch in all_batches():
+        rows = serialize(batch)
+        if len(rows) == 0:
+            continue
+        if stream == "ndjson":
+            yield "".join(json.dumps(row, separators=(",", ":"), default=float) + "\n" for row in rows).encode()
+        else:
+            encoded = json.dumps(rows, separators=(",", ":"), default=float)[1:-1]
+            yield (encoded if first else "," + encoded).encode()
+        first = False
+    if stream == "json":
+        yield b"]}}"
+
+async def columnar_response(media_type: str, columns: dict, metadata: dict | None = None):
+    size = len(next(iter(columns.values())))
+    content = await executor.run(columnar.encode, media_type, columns, metadata, size=size)
+    return Response(content=content, media_type=media_type, headers={"Vary": "Accept"})
+
+def json_response(content: bytes):
+    return Response(content=content, media_type=columnar.json_media_type)
+
+# Large results are encoded from columns in the executor, smaller ones are returned as dicts.
+async def od_response(rows, key: str, data: query_od_parameters.QueryODParameters, serialize = None, media_type: str = columnar.json_media_type):
+    if rows is None:
+        raise HTTPException(500, "query failed")
+    if media_type != columnar.json_media_type:
+        metadata = {}
+        if data.group_by is not None:
+            metadata["group_by"] = data.group_by
+        if data.limit is not None:
+            metadata["next_cursor"] = data.next_cursor(rows, key)
+        return await columnar_response(media_type, columnar.od_columns(rows, key, od_breakdown.bucket_labels.get(data.group_by)), metadata)
+    if data.group_by is not None:
+        breakdown = await executor.run(od_breakdown.create_od_breakdown, rows, key, data.group_by, size=len(rows), process=False)
+        return {"result": breakdown}
+    if len(rows) >= executor.thread_min_size:
+        metadata = {"next_cursor": data.next_cursor(rows, key)} if data.limit is not None else {}
+        return json_response(await executor.run(columnar.encode_od_json, columnar.od_columns(rows, key), key, metadata, size=len(rows)))
+    result = {"destinations": serialize(rows) if serialize else rows}
+    if data.limit is not None:
+        result["next_cursor"] = data.next_cursor(rows, key)
+    return {"result": result}
+
+# The first batch is fetched before the response starts, so a failing query gets a 500 instead of an
+# empty result. Errors after that abort the response, so the client doesn't get a truncated document
+# that is valid json.
+async def streaming_od_response(name: str, args, stream: str, serialize):
+    if args[-1].group_by is not None:
+        raise HTTPException(422, "group_by can't be combined with stream")
+    # A stream has no next_cursor, so it can't be paged through.
+    if args[-1].limit is not None or args[-1].after is not None:
+        raise HTTPException(422, "limit and cursor can't be combined with stream")
+    batches = db.stream_query(name, args, stream_batch_size)
+    try:
+        first_batch = await anext(batches, [])
+    except Exception:
+        raise HTTPException(500, "query failed")
+    media_type = "application/x-ndjson" if stream == "ndjson" else "application/json"
+    return StreamingResponse(stream_od_result(first_batch, batches, stream, serialize), media_type=media_type)
 
 @app.get("/origins/h3")
 async def get_origins_h3(
@@ -115,10 +345,17 @@ async def get_origins_h3(
     h3_resolution: str | None = h3_resolution_query,
     modalities: str | None = modalities_query,
     destination_cells: str | None = destination_cells_query,
+    stream: str | None = stream_query,
+    min_trips: int = min_trips_query,
+    top_k: int | None = top_k_query,
+    limit: int | None = limit_query,
+    offset: int = offset_query,
+    cursor: str | None = cursor_query,
+    group_by: str | None = group_by_query
 ):
     h3_resolution = int(h3_resolution)
     query_destinations = query_od_parameters.convert_h3_cells(cells=destination_cells, h3_resolution=h3_resolution)
-    if not accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, query_destinations, h3_resolution):
+    if not await accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, query_destinations, h3_resolution):
         raise HTTPException(403, "this user is not authorized to receive information of these h3 cells")
     
     query_od_parameter = query_od_parameters.prepare_query(
@@ -126,14 +363,23 @@ async def get_origins_h3(
         end_date = end_date,
         days_of_week = days_of_week,
         time_periods = time_periods,
-        modalities = modalities
+        modalities = modalities,
+        min_trips = min_trips,
+        top_k = top_k,
+        limit = limit,
+        offset = offset,
+        cursor = cursor,
+        group_by = group_by
     )
-    result = db.query_h3_origins(query_destinations, h3_resolution, query_od_parameter)
-    return {
-        "result": {
-            "destinations": serialize_od_h3_result(result)
-        } 
-    }
+    args = (query_destinations, h3_resolution, query_od_parameter)
+    media_type = None if stream else columnar.negotiate(request.headers.get("accept"))
+    validator = await http_cache.od_validator("query_h3_origins", args, media_type, stream)
+    if validator.matches(request):
+        return validator.not_modified()
+    if stream:
+        return validator.apply(await streaming_od_response("query_h3_origins", args, stream, serialize_od_h3_result), cacheable=False)
+    result = await db.query_h3_origins(*args)
+    return validator.apply(await od_response(result, "cell", query_od_parameter, serialize_od_h3_result, media_type))
 
 @app.get("/destinations/h3")
 async def get_destinations_h3(
@@ -144,11 +390,18 @@ async def get_destinations_h3(
     time_periods: str | None = time_periods_query,
     h3_resolution: str | None = h3_resolution_query,
     modalities: str | None = modalities_query,
-    origin_cells: str | None = origin_cells_query
+    origin_cells: str | None = origin_cells_query,
+    stream: str | None = stream_query,
+    min_trips: int = min_trips_query,
+    top_k: int | None = top_k_query,
+    limit: int | None = limit_query,
+    offset: int = offset_query,
+    cursor: str | None = cursor_query,
+    group_by: str | None = group_by_query
 ):
     h3_resolution = int(h3_resolution)
     query_origins = query_od_parameters.convert_h3_cells(cells=origin_cells, h3_resolution=h3_resolution)
-    if not accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, query_origins, h3_resolution):
+    if not await accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, query_origins, h3_resolution):
         raise HTTPException(403, "this user is not authorized to receive information of these h3 cells")
     
     query_od_parameter = query_od_parameters.prepare_query(
@@ -156,15 +409,24 @@ async def get_destinations_h3(
         end_date = end_date,
         days_of_week = days_of_week,
         time_periods = time_periods,
-        modalities = modalities
+        modalities = modalities,
+        min_trips = min_trips,
+        top_k = top_k,
+        limit = limit,
+        offset = offset,
+        cursor = cursor,
+        group_by = group_by
     )
 
-    result = db.query_h3_destinations(query_origins, h3_resolution, query_od_parameter)
-    return {
-        "result": {
-            "destinations": serialize_od_h3_result(result)
-        }  
-    }
+    args = (query_origins, h3_resolution, query_od_parameter)
+    media_type = None if stream else columnar.negotiate(request.headers.get("accept"))
+    validator = await http_cache.od_validator("query_h3_destinations", args, media_type, stream)
+    if validator.matches(request):
+        return validator.not_modified()
+    if stream:
+        return validator.apply(await streaming_od_response("query_h3_destinations", args, stream, serialize_od_h3_result), cacheable=False)
+    result = await db.query_h3_destinations(*args)
+    return validator.apply(await od_response(result, "cell", query_od_parameter, serialize_od_h3_result, media_type))
 
 @app.get("/origins/geometry")
 async def get_origins(
@@ -174,10 +436,17 @@ async def get_origins(
     days_of_week: str | None = days_of_week_query,
     time_periods: str | None = time_periods_query,
     modalities: str | None = modalities_query,
-    destination_stat_refs: str | None = destination_stat_refs_query
+    destination_stat_refs: str | None = destination_stat_refs_query,
+    stream: str | None = stream_query,
+    min_trips: int = min_trips_query,
+    top_k: int | None = top_k_query,
+    limit: int | None = limit_query,
+    offset: int = offset_query,
+    cursor: str | None = cursor_query,
+    group_by: str | None = group_by_query
 ):  
     destination_stat_refs = destination_stat_refs.split(",")
-    if not accessible_geometry.check_if_user_has_access_to_geometries(request.state.acl, destination_stat_refs):
+    if not await accessible_geometry.check_if_user_has_access_to_geometries(request.state.acl, destination_stat_refs):
         raise HTTPException(403, "This user is not authorized to receive this information")
     
     query_od_parameter = query_od_parameters.prepare_query(
@@ -185,15 +454,25 @@ async def get_origins(
         end_date = end_date,
         days_of_week = days_of_week,
         time_periods = time_periods,
-        modalities = modalities
+        modalities = modalities,
+        min_trips = min_trips,
+        top_k = top_k,
+        limit = limit,
+        offset = offset,
+        cursor = cursor,
+        group_by = group_by,
+        cursor_key_type = str
     )
     
-    result = db.query_geometry_origins(destination_stat_refs, query_od_parameter)
-    return {
-        "result": {
-            "destinations": result
-        } 
-    }
+    args = (destination_stat_refs, query_od_parameter)
+    media_type = None if stream else columnar.negotiate(request.headers.get("accept"))
+    validator = await http_cache.od_validator("query_geometry_origins", args, media_type, stream)
+    if validator.matches(request):
+        return validator.not_modified()
+    if stream:
+        return validator.apply(await streaming_od_response("query_geometry_origins", args, stream, list), cacheable=False)
+    result = await db.query_geometry_origins(*args)
+    return validator.apply(await od_response(result, "origin_stat_ref", query_od_parameter, None, media_type))
 
 @app.get("/destinations/geometry")
 async def get_destinations(
@@ -203,10 +482,17 @@ async def get_destinations(
     days_of_week: str | None = days_of_week_query,
     time_periods: str | None = time_periods_query,
     modalities: str | None = modalities_query,
-    origin_stat_refs: str | None = origin_stat_refs_query
+    origin_stat_refs: str | None = origin_stat_refs_query,
+    stream: str | None = stream_query,
+    min_trips: int = min_trips_query,
+    top_k: int | None = top_k_query,
+    limit: int | None = limit_query,
+    offset: int = offset_query,
+    cursor: str | None = cursor_query,
+    group_by: str | None = group_by_query
 ):
     origin_stat_refs = origin_stat_refs.split(",")
-    if not accessible_geometry.check_if_user_has_access_to_geometries(request.state.acl, origin_stat_refs):
+    if not await accessible_geometry.check_if_user_has_access_to_geometries(request.state.acl, origin_stat_refs):
         raise HTTPException(403, "this user is not authorized to receive this information")
     
     query_od_parameter = query_od_parameters.prepare_query(
@@ -214,14 +500,24 @@ async def get_destinations(
         end_date = end_date,
         days_of_week = days_of_week,
         time_periods = time_periods,
-        modalities = modalities
+        modalities = modalities,
+        min_trips = min_trips,
+        top_k = top_k,
+        limit = limit,
+        offset = offset,
+        cursor = cursor,
+        group_by = group_by,
+        cursor_key_type = str
     )
-    result = db.query_geometry_destinations(origin_stat_refs, query_od_parameter)
-    return {
-        "result": {
-            "destinations": result
-        }  
-    }
+    args = (origin_stat_refs, query_od_parameter)
+    media_type = None if stream else columnar.negotiate(request.headers.get("accept"))
+    validator = await http_cache.od_validator("query_geometry_destinations", args, media_type, stream)
+    if validator.matches(request):
+        return validator.not_modified()
+    if stream:
+        return validator.apply(await streaming_od_response("query_geometry_destinations", args, stream, list), cacheable=False)
+    result = await db.query_geometry_destinations(*args)
+    return validator.apply(await od_response(result, "destination_stat_ref", query_od_parameter, None, media_type))
 
 @app.get("/accessible/h3")
 async def get_accessible_h3_cells(
@@ -229,9 +525,12 @@ async def get_accessible_h3_cells(
     filter_municipalities: str | None = "",
     h3_resolution: str | None = h3_resolution_query,
 ):
+    media_type = columnar.negotiate(request.headers.get("accept"))
     filter_municipalities = set(filter_municipalities.split(","))
     filter_municipalities.discard("")
     if len(filter_municipalities) == 0 and request.state.acl.is_admin:
+        if media_type != columnar.json_media_type:
+            return await columnar_response(media_type, {"cell": np.array([], dtype=np.uint64)}, {"all_accessible": True})
         return {
             "result": {
                 "all_accessible": True,
@@ -239,25 +538,36 @@ async def get_accessible_h3_cells(
             }  
         }
 
-    accessible_municipalities = get_acl.get_accessible_municipalities(request.state.acl)
+    accessible_municipalities = await get_acl.get_accessible_municipalities(request.state.acl)
     if not request.state.acl.is_admin and not filter_municipalities.issubset(accessible_municipalities):
          raise HTTPException(403, "This user is not allowed to retreive information for all municipalities specified in filter")
     if len(filter_municipalities) == 0:
         filter_municipalities = accessible_municipalities
     
     h3_resolution = int(h3_resolution)
-    result = accessible_h3.get_accessible_h3_cells(list(filter_municipalities), h3_resolution)  
-    return {
+    validator = await http_cache.accessible_h3_validator(filter_municipalities, h3_resolution, request.state.acl.is_admin, media_type)
+    if validator.matches(request):
+        return validator.not_modified()
+    result = await accessible_h3.get_accessible_h3_cells(list(filter_municipalities), h3_resolution)  
+    if media_type != columnar.json_media_type:
+        return validator.apply(await columnar_response(media_type, {"cell": result}, {"all_accessible": request.state.acl.is_admin}))
+    return validator.apply({
         "result": {
             "all_accessible": request.state.acl.is_admin,
-            "accessible_h3_cells": result
+            "accessible_h3_cells": h3_codec.to_strings(result)
         }  
-    }
+    })
 
 @app.get("/accessible/geometry")
 async def get_accessible_geometries(
     request: Request,
-    filter_municipalities: str | None = ""
+    filter_municipalities: str | None = "",
+    zoom: int | None = Query(
+        default = None,
+        ge = 0,
+        le = 22,
+        title = "Simplify the polygons for display at this zoom level"
+    )
 ):
     filter_municipalities = set(filter_municipalities.split(","))
     filter_municipalities.discard("")
@@ -269,20 +579,386 @@ async def get_accessible_geometries(
             }  
         }
 
-    accessible_municipalities = get_acl.get_accessible_municipalities(request.state.acl)
+    accessible_municipalities = await get_acl.get_accessible_municipalities(request.state.acl)
     if not request.state.acl.is_admin and not filter_municipalities.issubset(accessible_municipalities):
          raise HTTPException(403, "this user is not allowed to retrieve information for all municipalities specified in filter")
     if len(filter_municipalities) == 0:
         filter_municipalities = accessible_municipalities
     
-    result = accessible_geometry.get_accessible_geometries(filter_municipalities)
+    validator = http_cache.accessible_geometry_validator(filter_municipalities, request.state.acl.is_admin, zoom)
+    if validator.matches(request):
+        return validator.not_modified()
+    bundles = await accessible_geometry.get_accessible_geometries(filter_municipalities, zoom)
+    with metrics.stage("serialize.accessible_geometry"):
+        content = geometry_cache.encode_response(bundles, request.state.acl.is_admin)
+    return validator.apply(Response(
+        content=content,
+        media_type="application/json"
+    ))
+
+tile_z_path = Path(default = ..., ge = 0, le = 22, title = "Zoom level")
+tile_x_path = Path(default = ..., ge = 0, title = "Tile column")
+tile_y_path = Path(default = ..., ge = 0, title = "Tile row")
+
+def tile_response(content: bytes):
+    return Response(content=content, media_type=tiles.media_type)
+
+def check_tile(z: int, x: int, y: int):
+    if not tiles.check_tile(z, x, y):
+        raise HTTPException(422, "tile x and y should be smaller than 2^z")
+
+# Returns the municipalities a tile of accessible areas is made of, None if everything is accessible.
+async def get_tile_municipalities(user_acl, filter_municipalities: str):
+    filter_municipalities = set(filter_municipalities.split(","))
+    filter_municipalities.discard("")
+    if len(filter_municipalities) == 0 and user_acl.is_admin:
+        return None
+    accessible_municipalities = await get_acl.get_accessible_municipalities(user_acl)
+    if not user_acl.is_admin and not filter_municipalities.issubset(accessible_municipalities):
+        raise HTTPException(403, "this user is not allowed to retrieve information for all municipalities specified in filter")
+    if len(filter_municipalities) == 0:
+        return accessible_municipalities
+    return filter_municipalities
+
+@app.get("/tiles/origins/h3/{z}/{x}/{y}")
+async def get_origins_h3_tile(
+    request: Request,
+    z: int = tile_z_path,
+    x: int = tile_x_path,
+    y: int = tile_y_path,
+    start_date: date | None = start_date_query,
+    end_date: date | None = end_date_query,
+    days_of_week: str | None = days_of_week_query,
+    time_periods: str | None = time_periods_query,
+    h3_resolution: str | None = h3_resolution_query,
+    modalities: str | None = modalities_query,
+    destination_cells: str | None = destination_cells_query
+):
+    check_tile(z, x, y)
+    h3_resolution = int(h3_resolution)
+    query_destinations = query_od_parameters.convert_h3_cells(cells=destination_cells, h3_resolution=h3_resolution)
+    if not await accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, query_destinations, h3_resolution):
+        raise HTTPException(403, "this user is not authorized to receive information of these h3 cells")
+
+    query_od_parameter = query_od_parameters.prepare_query(
+        start_date = start_date,
+        end_date = end_date,
+        days_of_week = days_of_week,
+        time_periods = time_periods,
+        modalities = modalities
+    )
+    args = (query_destinations, h3_resolution, query_od_parameter)
+    validator = await http_cache.od_validator("query_h3_origins", args, "tile", z, x, y, vary="Authorization")
+    if validator.matches(request):
+        return validator.not_modified()
+    result = await db.query_h3_origins(*args)
+    if result is None:
+        raise HTTPException(500, "query failed")
+    return validator.apply(tile_response(tiles.od_h3_tile("origins", result, z, x, y)))
+
+@app.get("/tiles/destinations/h3/{z}/{x}/{y}")
+async def get_destinations_h3_tile(
+    request: Request,
+    z: int = tile_z_path,
+    x: int = tile_x_path,
+    y: int = tile_y_path,
+    start_date: date | None = start_date_query,
+    end_date: date | None = end_date_query,
+    days_of_week: str | None = days_of_week_query,
+    time_periods: str | None = time_periods_query,
+    h3_resolution: str | None = h3_resolution_query,
+    modalities: str | None = modalities_query,
+    origin_cells: str | None = origin_cells_query
+):
+    check_tile(z, x, y)
+    h3_resolution = int(h3_resolution)
+    query_origins = query_od_parameters.convert_h3_cells(cells=origin_cells, h3_resolution=h3_resolution)
+    if not await accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, query_origins, h3_resolution):
+        raise HTTPException(403, "this user is not authorized to receive information of these h3 cells")
+
+    query_od_parameter = query_od_parameters.prepare_query(
+        start_date = start_date,
+        end_date = end_date,
+        days_of_week = days_of_week,
+        time_periods = time_periods,
+        modalities = modalities
+    )
+    args = (query_origins, h3_resolution, query_od_parameter)
+    validator = await http_cache.od_validator("query_h3_destinations", args, "tile", z, x, y, vary="Authorization")
+    if validator.matches(request):
+        return validator.not_modified()
+    result = await db.query_h3_destinations(*args)
+    if result is None:
+        raise HTTPException(500, "query failed")
+    return validator.apply(tile_response(tiles.od_h3_tile("destinations", result, z, x, y)))
+
+@app.get("/tiles/origins/geometry/{z}/{x}/{y}")
+async def get_origins_geometry_tile(
+    request: Request,
+    z: int = tile_z_path,
+    x: int = tile_x_path,
+    y: int = tile_y_path,
+    start_date: date | None = start_date_query,
+    end_date: date | None = end_date_query,
+    days_of_week: str | None = days_of_week_query,
+    time_periods: str | None = time_periods_query,
+    modalities: str | None = modalities_query,
+    destination_stat_refs: str | None = destination_stat_refs_query
+):
+    check_tile(z, x, y)
+    destination_stat_refs = destination_stat_refs.split(",")
+    if not await accessible_geometry.check_if_user_has_access_to_geometries(request.state.acl, destination_stat_refs):
+        raise HTTPException(403, "This user is not authorized to receive this information")
+
+    query_od_parameter = query_od_parameters.prepare_query(
+        start_date = start_date,
+        end_date = end_date,
+        days_of_week = days_of_week,
+        time_periods = time_periods,
+        modalities = modalities
+    )
+    args = (destination_stat_refs, query_od_parameter)
+    validator = await http_cache.od_validator("query_geometry_origins", args, "tile", z, x, y, http_cache.residential_areas_version, vary="Authorization")
+    if validator.matches(request):
+        return validator.not_modified()
+    result = await db.query_geometry_origins(*args)
+    if result is None:
+        raise HTTPException(500, "query failed")
+    return validator.apply(tile_response(await tiles.od_geometry_tile("origins", result, "origin_stat_ref", z, x, y)))
+
+@app.get("/tiles/destinations/geometry/{z}/{x}/{y}")
+async def get_destinations_geometry_tile(
+    request: Request,
+    z: int = tile_z_path,
+    x: int = tile_x_path,
+    y: int = tile_y_path,
+    start_date: date | None = start_date_query,
+    end_date: date | None = end_date_query,
+    days_of_week: str | None = days_of_week_query,
+    time_periods: str | None = time_periods_query,
+    modalities: str | None = modalities_query,
+    origin_stat_refs: str | None = origin_stat_refs_query
+):
+    check_tile(z, x, y)
+    origin_stat_refs = origin_stat_refs.split(",")
+    if not await accessible_geometry.check_if_user_has_access_to_geometries(request.state.acl, origin_stat_refs):
+        raise HTTPException(403, "This user is not authorized to receive this information")
+
+    query_od_parameter = query_od_parameters.prepare_query(
+        start_date = start_date,
+        end_date = end_date,
+        days_of_week = days_of_week,
+        time_periods = time_periods,
+        modalities = modalities
+    )
+    args = (origin_stat_refs, query_od_parameter)
+    validator = await http_cache.od_validator("query_geometry_destinations", args, "tile", z, x, y, http_cache.residential_areas_version, vary="Authorization")
+    if validator.matches(request):
+        return validator.not_modified()
+    result = await db.query_geometry_destinations(*args)
+    if result is None:
+        raise HTTPException(500, "query failed")
+    return validator.apply(tile_response(await tiles.od_geometry_tile("destinations", result, "destination_stat_ref", z, x, y)))
+
+# Like /accessible/h3 and /accessible/geometry, admins without a filter get an empty tile because everything is accessible.
+@app.get("/tiles/accessible/h3/{z}/{x}/{y}")
+async def get_accessible_h3_tile(
+    request: Request,
+    z: int = tile_z_path,
+    x: int = tile_x_path,
+    y: int = tile_y_path,
+    filter_municipalities: str | None = "",
+    h3_resolution: str | None = h3_resolution_query
+):
+    check_tile(z, x, y)
+    municipalities = await get_tile_municipalities(request.state.acl, filter_municipalities)
+    if municipalities is None:
+        return tile_response(tiles.accessible_h3_tile([], z, x, y))
+    validator = await http_cache.accessible_h3_validator(municipalities, int(h3_resolution), "tile", z, x, y, vary="Authorization")
+    if validator.matches(request):
+        return validator.not_modified()
+    cells = await h3_access_index.h3_access_index.accessible_cells(list(municipalities), int(h3_resolution))
+    return validator.apply(tile_response(tiles.accessible_h3_tile(cells, z, x, y)))
+
+@app.get("/tiles/accessible/geometry/{z}/{x}/{y}")
+async def get_accessible_geometry_tile(
+    request: Request,
+    z: int = tile_z_path,
+    x: int = tile_x_path,
+    y: int = tile_y_path,
+    filter_municipalities: str | None = ""
+):
+    check_tile(z, x, y)
+    municipalities = await get_tile_municipalities(request.state.acl, filter_municipalities)
+    if municipalities is None:
+        municipalities = []
+    validator = http_cache.accessible_geometry_validator(municipalities, "tile", z, x, y)
+    if validator.matches(request):
+        return validator.not_modified()
+    return validator.apply(tile_response(await tiles.accessible_geometry_tile(municipalities, z, x, y)))
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), headers={"Content-Type": metrics.content_type})
+
+@app.post("/batch")
+async def post_batch(
+    request: Request,
+    specs: list[batch_query.ODQuerySpec]
+):
+    queries = batch_query.prepare_queries(specs)
+
+    h3_cells_per_resolution = {}
+    stat_refs = []
+    for name, args in queries:
+        if name.startswith("query_h3"):
+            h3_cells_per_resolution.setdefault(args[1], []).extend(args[0])
+        else:
+            stat_refs.extend(args[0])
+    for h3_resolution, cells in h3_cells_per_resolution.items():
+        if not await accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, cells, h3_resolution):
+            raise HTTPException(403, "this user is not authorized to receive information of these h3 cells")
+    if len(stat_refs) > 0 and not await accessible_geometry.check_if_user_has_access_to_geometries(request.state.acl, stat_refs):
+        raise HTTPException(403, "this user is not authorized to receive this information")
+
+    media_type = columnar.negotiate(request.headers.get("accept"))
+    results = await db.query_batch(queries)
+    if results is None:
+        raise HTTPException(500, "query failed")
+    if media_type != columnar.json_media_type:
+        return await columnar_response(media_type, batch_query.columns(queries, results))
+    if sum(map(len, results)) >= executor.thread_min_size:
+        columns = batch_query.columns(queries, results)
+        keys = [query_builder.od_queries[name][3] for name, _ in queries]
+        return json_response(await executor.run(columnar.encode_batch_json, columns, keys, size=len(columns["query"])))
     return {
-        "result": {
-            "all_accessible": request.state.acl.is_admin,
-            "accessible_geometries": result
-        }  
+        "result": [
+            {
+                "destinations": serialize_od_h3_result(result) if name.startswith("query_h3") else result
+            }
+            for (name, _), result in zip(queries, results)
+        ]
+    }
+
+@app.get("/admin/acl_cache")
+async def get_acl_cache_stats(request: Request):
+    if not request.state.acl.is_admin:
+        raise HTTPException(403, "this user is not allowed to view the acl cache")
+    return {
+        "result": acl_cache.stats()
+    }
+
+@app.post("/admin/acl_cache/invalidate")
+async def invalidate_acl_cache(
+    request: Request,
+    user_id: str | None = None
+):
+    if not request.state.acl.is_admin:
+        raise HTTPException(403, "this user is not allowed to invalidate the acl cache")
+    acl_cache.invalidate(user_id)
+    return {
+        "result": acl_cache.stats()
+    }
+
+@app.get("/admin/result_cache")
+async def get_result_cache_stats(request: Request):
+    if not request.state.acl.is_admin:
+        raise HTTPException(403, "this user is not allowed to view the result cache")
+    return {
+        "result": result_cache.stats()
+    }
+
+@app.post("/admin/result_cache/invalidate")
+async def invalidate_result_cache(request: Request):
+    if not request.state.acl.is_admin:
+        raise HTTPException(403, "this user is not allowed to invalidate the result cache")
+    await result_cache.clear()
+    return {
+        "result": result_cache.stats()
+    }
+
+@app.get("/admin/geometry_cache")
+async def get_geometry_cache_stats(request: Request):
+    if not request.state.acl.is_admin:
+        raise HTTPException(403, "this user is not allowed to view the geometry cache")
+    return {
+        "result": geometry_cache.stats()
+    }
+
+@app.get("/admin/od_cube")
+async def get_od_cube_stats(request: Request):
+    if not request.state.acl.is_admin:
+        raise HTTPException(403, "this user is not allowed to view the od cube")
+    return {
+        "result": od_cube.od_cube.stats()
+    }
+
+@app.post("/admin/geometry_cache/invalidate")
+async def invalidate_geometry_cache(request: Request):
+    if not request.state.acl.is_admin:
+        raise HTTPException(403, "this user is not allowed to invalidate the geometry cache")
+    geometry_cache.invalidate()
+    return {
+        "result": geometry_cache.stats()
     }
 
 @app.get("/matrix/h3")
-async def get_matrix():
-    return {"message": "Hello World"}
\ No newline at end of file
+async def get_matrix(
+    request: Request,
+    start_date: date | None = start_date_query,
+    end_date: date | None = end_date_query,
+    days_of_week: str | None = days_of_week_query,
+    time_periods: str | None = time_periods_query,
+    h3_resolution: str | None = h3_resolution_query,
+    modalities: str | None = modalities_query,
+    origin_cells: str | None = origin_cells_query,
+    destination_cells: str | None = destination_cells_query,
+    representation: str = matrix_representation_query,
+    format: str = matrix_format_query,
+    min_trips: int = min_trips_query,
+    top_k: int | None = top_k_query,
+    limit: int | None = limit_query,
+    offset: int = offset_query
+):
+    h3_resolution = int(h3_resolution)
+    query_origins = query_od_parameters.convert_h3_cells(cells=origin_cells, h3_resolution=h3_resolution)
+    query_destinations = query_od_parameters.convert_h3_cells(cells=destination_cells, h3_resolution=h3_resolution)
+    if not await accessible_h3.check_if_user_has_access_to_h3_cells(request.state.acl, query_origins + query_destinations, h3_resolution):
+        raise HTTPException(403, "this user is not authorized to receive information of these h3 cells")
+
+    query_od_parameter = query_od_parameters.prepare_query(
+        start_date = start_date,
+        end_date = end_date,
+        days_of_week = days_of_week,
+        time_periods = time_periods,
+        modalities = modalities,
+        min_trips = min_trips,
+        top_k = top_k,
+        limit = limit,
+        offset = offset
+    )
+    media_type = columnar.json_media_type if format == "npz" else columnar.negotiate(request.headers.get("accept"))
+    args = (query_origins, query_destinations, h3_resolution, query_od_parameter)
+    validator = await http_cache.od_validator("query_h3_matrix", args, media_type, representation, format)
+    if validator.matches(request):
+        return validator.not_modified()
+    result = await db.query_h3_matrix(*args)
+    if result is None:
+        raise HTTPException(500, "query failed")
+    matrix = od_matrix.create_od_matrix(result, query_origins, query_destinations)
+    size = len(matrix.number_of_trips)
+    if format == "npz":
+        return validator.apply(Response(
+            content=await executor.run(matrix.to_npz, representation, size=size),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": "attachment; filename=matrix.npz"}
+        ))
+    if media_type != columnar.json_media_type:
+        return validator.apply(await columnar_response(media_type, matrix.columns()))
+    if size >= executor.thread_min_size:
+        return validator.apply(json_response(await executor.run(matrix.encode_json, representation, size=size)))
+    return validator.apply({
+        "result": {
+            "matrix": matrix.to_json(representation)
+        }
+    })
\ No newline at end of file
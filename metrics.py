@@ -0,0 +1,135 @@
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from prometheus_client import multiprocess
+from contextlib import contextmanager
+from db_helper import db_helper
+from acl import acl_cache
+import result_cache
+import geometry_cache
+import functools
+import inspect
+import json
+import time
+import os
+
+# Queries that take longer than this many seconds are logged with their normalized parameters, disabled when not set.
+slow_query_seconds = float(os.getenv("SLOW_QUERY_SECONDS", "0")) or None
+
+request_duration = Histogram(
+    "od_api_request_duration_seconds",
+    "Duration of http requests",
+    ["method", "endpoint", "status"]
+)
+stage_duration = Histogram(
+    "od_api_stage_duration_seconds",
+    "Duration of the stages of a request",
+    ["stage"]
+)
+db_errors = Counter(
+    "od_api_db_errors",
+    "Number of queries that failed",
+    ["query"]
+)
+coalesced_executions = Counter(
+    "od_api_coalesced_executions",
+    "Number of query executions that concurrent identical requests could share",
+    ["query"]
+)
+coalesced_requests = Counter(
+    "od_api_coalesced_requests",
+    "Number of requests that awaited the execution of a concurrent identical request",
+    ["query"]
+)
+rows_returned = Histogram(
+    "od_api_rows_returned",
+    "Number of rows returned by a query",
+    ["query"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+)
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.labels(name).observe(time.perf_counter() - start)
+
+def timed(name: str):
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with stage(name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def observe_query(name: str, duration: float, rows, parameters=None):
+    stage_duration.labels(f"db.{name}").observe(duration)
+    if rows is None:
+        db_errors.labels(name).inc()
+    else:
+        rows_returned.labels(name).observe(len(rows))
+    if slow_query_seconds is not None and duration >= slow_query_seconds:
+        print(json.dumps({
+            "slow_query": name,
+            "duration": round(duration, 3),
+            "rows": None if rows is None else len(rows),
+            "parameters": parameters
+        }, default=str))
+
+class PoolCollector:
+    def collect(self):
+        stats = db_helper.get_stats()
+        size = stats.get("pool_size", 0)
+        available = stats.get("pool_available", 0)
+        yield GaugeMetricFamily("od_api_db_pool_size", "Number of connections in the pool", value=size)
+        yield GaugeMetricFamily("od_api_db_pool_in_use", "Number of connections in use", value=size - available)
+        yield GaugeMetricFamily("od_api_db_pool_waiting", "Number of requests waiting for a connection", value=stats.get("requests_waiting", 0))
+        yield CounterMetricFamily("od_api_db_pool_requests", "Number of connections requested from the pool", value=stats.get("requests_num", 0))
+        yield CounterMetricFamily("od_api_db_pool_wait_seconds", "Time spent waiting for a connection", value=stats.get("requests_wait_ms", 0) / 1000)
+        yield CounterMetricFamily("od_api_db_pool_timeouts", "Number of requests that timed out waiting for a connection", value=stats.get("requests_errors", 0))
+
+class CacheCollector:
+    def collect(self):
+        caches = {
+            **{f"acl_{name}": cache_stats for name, cache_stats in acl_cache.stats().items()},
+            "result": result_cache.stats(),
+            "geometry": geometry_cache.stats()
+        }
+        hits = CounterMetricFamily("od_api_cache_hits", "Number of cache hits", labels=["cache"])
+        misses = CounterMetricFamily("od_api_cache_misses", "Number of cache misses", labels=["cache"])
+        hit_ratio = GaugeMetricFamily("od_api_cache_hit_ratio", "Hits divided by lookups since start", labels=["cache"])
+        size = GaugeMetricFamily("od_api_cache_size", "Number of entries in the cache", labels=["cache"])
+        for name, cache_stats in caches.items():
+            if "hits" not in cache_stats:
+                continue
+            lookups = cache_stats["hits"] + cache_stats["misses"]
+            hits.add_metric([name], cache_stats["hits"])
+            misses.add_metric([name], cache_stats["misses"])
+            hit_ratio.add_metric([name], cache_stats["hits"] / lookups if lookups else 0)
+            if "size" in cache_stats:
+                size.add_metric([name], cache_stats["size"])
+        yield from (hits, misses, hit_ratio, size)
+
+REGISTRY.register(PoolCollector())
+REGISTRY.register(CacheCollector())
+
+# With several worker processes prometheus_client aggregates the histograms of all workers
+# when PROMETHEUS_MULTIPROC_DIR is set, the pool and cache metrics are those of the worker that serves /metrics.
+def render():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(PoolCollector())
+        registry.register(CacheCollector())
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+content_type = CONTENT_TYPE_LATEST
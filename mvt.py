@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+import numpy as np
+import struct
+
+# Minimal encoder for Mapbox Vector Tiles (specification 2.1) with polygon features only,
+# see https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+POLYGON = 3
+
+@dataclass
+class Feature:
+    id: int
+    properties: dict
+    # Polygons as lists of rings, the first ring is the exterior. Rings are (n, 2) arrays in tile coordinates.
+    polygons: list[list[np.ndarray]]
+
+def _varint(value: int):
+    result = bytearray()
+    while value > 0x7F:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def _zigzag(value: int):
+    return (value << 1) ^ (value >> 63)
+
+def _field(number: int, wire_type: int):
+    return _varint((number << 3) | wire_type)
+
+def _bytes_field(number: int, value: bytes):
+    return _field(number, 2) + _varint(len(value)) + value
+
+def _packed_field(number: int, values):
+    return _bytes_field(number, b"".join(map(_varint, values)))
+
+def _value(value):
+    if isinstance(value, bool):
+        return _field(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        return _field(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _field(3, 1) + struct.pack("<d", value)
+    return _bytes_field(1, str(value).encode())
+
+def _command(command: int, count: int):
+    return (command & 0x7) | (count << 3)
+
+# Rings are rounded to integer coordinates, repeated points are dropped and rings that collapse are skipped.
+# Exterior rings are written clockwise, interior rings counterclockwise (in tile coordinates, y pointing down).
+def _geometry(polygons: list[list[np.ndarray]]):
+    commands = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for polygon in polygons:
+        for ring_index, ring in enumerate(polygon):
+            points = np.rint(ring).astype(np.int64)
+            if len(points) > 1 and (points[0] == points[-1]).all():
+                points = points[:-1]
+            if len(points) == 0:
+                continue
+            points = points[np.r_[True, (np.diff(points, axis=0) != 0).any(axis=1)]]
+            if len(points) > 1 and (points[0] == points[-1]).all():
+                points = points[:-1]
+            if len(points) < 3:
+                if ring_index == 0:
+                    break
+                continue
+            area = np.sum(points[:, 0] * np.roll(points[:, 1], -1) - np.roll(points[:, 0], -1) * points[:, 1])
+            if area == 0:
+                if ring_index == 0:
+                    break
+                continue
+            if (area > 0) != (ring_index == 0):
+                points = points[::-1]
+            deltas = np.diff(np.vstack((cursor, points)), axis=0)
+            cursor = points[-1]
+            parameters = ((deltas << 1) ^ (deltas >> 63)).tolist()
+            commands.append(_command(MOVE_TO, 1))
+            commands.extend(parameters[0])
+            commands.append(_command(LINE_TO, len(points) - 1))
+            for parameter in parameters[1:]:
+                commands.extend(parameter)
+            commands.append(_command(CLOSE_PATH, 1))
+    return commands
+
+def encode_layer(name: str, features: list[Feature], extent: int = 4096):
+    keys = {}
+    values = {}
+    encoded_features = []
+    for feature in features:
+        geometry = _geometry(feature.polygons)
+        if len(geometry) == 0:
+            continue
+        tags = []
+        for key, value in feature.properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        encoded_features.append(_bytes_field(2, b"".join((
+            _field(1, 0) + _varint(feature.id),
+            _packed_field(2, tags),
+            _field(3, 0) + _varint(POLYGON),
+            _packed_field(4, geometry)
+        ))))
+    layer = b"".join((
+        _field(15, 0) + _varint(2),
+        _bytes_field(1, name.encode()),
+        *encoded_features,
+        *(_bytes_field(3, key.encode()) for key in keys),
+        *(_bytes_field(4, _value(value)) for _, value in values),
+        _field(5, 0) + _varint(extent)
+    ))
+    return _bytes_field(3, layer)
+
+def encode_tile(layers: list[bytes]):
+    return b"".join(layers)
@@ -0,0 +1,34 @@
+import query_od_parameters
+import h3_codec
+
+# Bucket values as returned by the database converted to the values of the API parameters.
+bucket_labels = {
+    "isodow": {str(value): label for label, value in query_od_parameters.days_of_week_db_values.items()},
+    "time_period": {str(value): label for label, value in query_od_parameters.time_periods_db_values.items()}
+}
+
+def bucket_order(group_by: str, bucket: str):
+    if group_by in bucket_labels:
+        return int(bucket)
+    return bucket
+
+# Converts rows with a bucket to one array of buckets and per key an array of the number of trips per bucket,
+# buckets without a row, for example because they have less than min_trips trips, are 0.
+# Keys are sorted on their total number of trips.
+def create_od_breakdown(rows, key: str, group_by: str):
+    buckets = sorted({row["bucket"] for row in rows}, key=lambda bucket: bucket_order(group_by, bucket))
+    bucket_index = {bucket: index for index, bucket in enumerate(buckets)}
+    number_of_trips = {}
+    for row in rows:
+        trips = number_of_trips.setdefault(row[key], [0] * len(buckets))
+        trips[bucket_index[row["bucket"]]] = row["number_of_trips"]
+    keys = sorted(number_of_trips, key=lambda value: (-sum(number_of_trips[value]), value))
+    labels = bucket_labels.get(group_by)
+    return {
+        "group_by": group_by,
+        "buckets": [labels[bucket] for bucket in buckets] if labels else buckets,
+        "destinations": {
+            key: h3_codec.to_strings(keys) if key == "cell" else keys,
+            "number_of_trips": [number_of_trips[value] for value in keys]
+        }
+    }
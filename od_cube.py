@@ -0,0 +1,328 @@
+from dataclasses import dataclass
+from db_helper import db_helper
+from aggregation_periods import aggregation_period_index
+import query_od_parameters
+import numpy as np
+import h3_codec
+import metrics
+import executor
+import asyncio
+import os
+
+# The cube keeps od_h3 and od_geometry of the last days in memory and answers the single OD queries
+# without a database round trip, queries with periods outside the cube fall back to SQL.
+enabled = os.getenv("OD_CUBE_ENABLED", "false") == "true"
+window_days = int(os.getenv("OD_CUBE_DAYS", "90"))
+refresh_interval = float(os.getenv("OD_CUBE_REFRESH_INTERVAL", "300"))
+# Aggregation periods are only loaded after this delay so that all their od rows are present.
+refresh_delay_hours = float(os.getenv("OD_CUBE_DELAY_HOURS", "6"))
+load_batch_size = int(os.getenv("OD_CUBE_LOAD_BATCH_SIZE", "100000"))
+
+h3_levels = (7, 8)
+
+class Index:
+    """Positions of the rows sorted on a column, with the distinct values and the offset of their first row."""
+
+    def __init__(self, column: np.ndarray):
+        self.order = np.argsort(column, kind="stable")
+        self.values, offsets = np.unique(column[self.order], return_index=True)
+        self.offsets = np.append(offsets, len(column))
+
+    @classmethod
+    def from_arrays(cls, order: np.ndarray, values: np.ndarray, offsets: np.ndarray):
+        index = cls.__new__(cls)
+        index.order, index.values, index.offsets = order, values, offsets
+        return index
+
+    # values should be unique. Values that aren't in the index are dropped by comparing each value with the
+    # value at its own position, values missing from the index would otherwise select the next value again.
+    def rows(self, values: np.ndarray):
+        positions = np.searchsorted(self.values, values)
+        found = positions < len(self.values)
+        found[found] = self.values[positions[found]] == values[found]
+        positions = positions[found]
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        # Concatenation of the ranges starts[i]:starts[i] + lengths[i] without a python loop.
+        range_starts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.order[np.arange(lengths.sum()) + range_starts]
+
+@dataclass
+class ODTable:
+    """Rows of od_h3 of one h3_level or of od_geometry as columns.
+
+    periods are positions in Snapshot.aggregation_period_ids and modalities codes of ODCube.modality_code.
+    Cells are uint64, stat_refs of od_geometry are positions in ODCube.stats_refs.
+    """
+    origins: np.ndarray
+    destinations: np.ndarray
+    periods: np.ndarray
+    modalities: np.ndarray
+    trips: np.ndarray
+    by_origin: Index
+    by_destination: Index
+
+    @classmethod
+    def create(cls, origins, destinations, periods, modalities, trips):
+        return cls(origins, destinations, periods, modalities, trips, Index(origins), Index(destinations))
+
+    def __len__(self):
+        return len(self.trips)
+
+@dataclass
+class Snapshot:
+    aggregation_period_ids: np.ndarray
+    # (table, h3_level): ODTable, h3_level is None for od_geometry.
+    tables: dict
+    stats_refs: np.ndarray
+
+class ODCube:
+    def __init__(self):
+        self.snapshot = Snapshot(np.array([], dtype=np.int64), {}, np.array([], dtype=str))
+        self.stats_refs = []
+        self._modality_codes = {}
+        self._stats_ref_codes = {}
+        self._lock = asyncio.Lock()
+
+    def modality_code(self, modality: str):
+        return self._modality_codes.setdefault(modality, len(self._modality_codes))
+
+    def stats_ref_code(self, stats_ref: str):
+        code = self._stats_ref_codes.get(stats_ref)
+        if code is None:
+            code = self._stats_ref_codes[stats_ref] = len(self.stats_refs)
+            self.stats_refs.append(stats_ref)
+        return code
+
+    # Loads the aggregation periods that entered the window and drops the ones that left it.
+    async def refresh(self):
+        async with self._lock:
+            aggregation_period_ids = await get_complete_aggregation_periods(window_days, refresh_delay_hours)
+            if aggregation_period_ids is None:
+                return
+            aggregation_period_ids = np.unique(np.array(aggregation_period_ids, dtype=np.int64))
+            snapshot = self.snapshot
+            new_aggregation_period_ids = np.setdiff1d(aggregation_period_ids, snapshot.aggregation_period_ids)
+            if len(new_aggregation_period_ids) == 0 and np.array_equal(aggregation_period_ids, snapshot.aggregation_period_ids):
+                return
+            new_rows = {}
+            if len(new_aggregation_period_ids) > 0:
+                new_rows = await self.load(new_aggregation_period_ids)
+                if new_rows is None:
+                    return
+            stats_refs = np.array(self.stats_refs, dtype=str)
+            self.snapshot = await executor.run_in_thread(build_snapshot, snapshot, aggregation_period_ids, new_rows, stats_refs)
+
+    async def load(self, aggregation_period_ids: np.ndarray):
+        new_rows = {}
+        h3_rows = await load_rows("""
+            SELECT h3_level, origin_cell, destination_cell, modality::text, aggregation_period_id, number_of_trips
+            FROM od_h3
+            WHERE aggregation_period_id = ANY(%(aggregation_period_ids)s::bigint[])
+            AND h3_level = ANY(%(h3_levels)s::int[])
+        """, aggregation_period_ids, lambda rows: self.h3_columns(rows))
+        geometry_rows = await load_rows("""
+            SELECT origin_stats_ref, destination_stats_ref, modality::text, aggregation_period_id, number_of_trips
+            FROM od_geometry
+            WHERE aggregation_period_id = ANY(%(aggregation_period_ids)s::bigint[])
+        """, aggregation_period_ids, lambda rows: self.geometry_columns(rows))
+        if h3_rows is None or geometry_rows is None:
+            return None
+        levels, *columns = h3_rows
+        for h3_level in h3_levels:
+            new_rows[("od_h3", h3_level)] = [column[levels == h3_level] for column in columns]
+        new_rows[("od_geometry", None)] = geometry_rows
+        return new_rows
+
+    def h3_columns(self, rows):
+        count = len(rows)
+        return (
+            np.fromiter((row[0] for row in rows), dtype=np.int8, count=count),
+            np.fromiter((row[1] for row in rows), dtype=np.uint64, count=count),
+            np.fromiter((row[2] for row in rows), dtype=np.uint64, count=count),
+            np.fromiter((row[4] for row in rows), dtype=np.int64, count=count),
+            np.fromiter((self.modality_code(row[3]) for row in rows), dtype=np.int8, count=count),
+            np.fromiter((row[5] for row in rows), dtype=np.int32, count=count)
+        )
+
+    def geometry_columns(self, rows):
+        count = len(rows)
+        return (
+            np.fromiter((self.stats_ref_code(row[0]) for row in rows), dtype=np.int32, count=count),
+            np.fromiter((self.stats_ref_code(row[1]) for row in rows), dtype=np.int32, count=count),
+            np.fromiter((row[3] for row in rows), dtype=np.int64, count=count),
+            np.fromiter((self.modality_code(row[2]) for row in rows), dtype=np.int8, count=count),
+            np.fromiter((row[4] for row in rows), dtype=np.int32, count=count)
+        )
+
+    # Same rows as db.query_od, None when the cube doesn't contain all aggregation periods of the query.
+    # Filtering on values is done on the origins when filter_on_origins is True, otherwise on the destinations.
+    async def query(self, table: str, filter_on_origins: bool, key: str, values: list, h3_level: int | None, h3_resolution: int | None,
+            data: query_od_parameters.QueryODParameters):
+        if data.group_by is not None:
+            return None
+        aggregation_period_ids = np.array(await aggregation_period_index.resolve(data, data.start_date, data.end_date), dtype=np.int64)
+        snapshot = self.snapshot
+        od_table = snapshot.tables.get((table, h3_level))
+        if od_table is None:
+            return None
+        positions = np.searchsorted(snapshot.aggregation_period_ids, aggregation_period_ids)
+        if (positions == len(snapshot.aggregation_period_ids)).any() or (snapshot.aggregation_period_ids[positions] != aggregation_period_ids).any():
+            return None
+
+        with metrics.stage(f"od_cube.{table}"):
+            if table == "od_h3":
+                values = np.unique(h3_codec.to_children(values, h3_level))
+            else:
+                values = np.unique(np.array([self._stats_ref_codes[value] for value in values if value in self._stats_ref_codes], dtype=np.int32))
+            index, others = (od_table.by_origin, od_table.destinations) if filter_on_origins else (od_table.by_destination, od_table.origins)
+            rows = index.rows(values)
+
+            mask = np.zeros(len(snapshot.aggregation_period_ids), dtype=bool)
+            mask[positions] = True
+            selected = mask[od_table.periods[rows]]
+            if not data.dont_filter_on_modality:
+                modalities = np.zeros(len(self._modality_codes) + 1, dtype=bool)
+                modalities[[self._modality_codes[modality] for modality in data.modalities if modality in self._modality_codes]] = True
+                selected &= modalities[od_table.modalities[rows]]
+            rows = rows[selected]
+
+            keys = others[rows]
+            if h3_resolution is not None and h3_resolution < h3_level:
+                keys = h3_codec.to_parents(keys, h3_resolution)
+            keys, inverse = np.unique(keys, return_inverse=True)
+            number_of_trips = np.bincount(inverse, weights=od_table.trips[rows], minlength=len(keys)).astype(np.int64)
+            return page(keys if table == "od_h3" else snapshot.stats_refs[keys], number_of_trips, key, data)
+
+    # Columns of the cube as flat arrays and the codes of the modalities, for snapshot files.
+    def export(self):
+        snapshot = self.snapshot
+        arrays = {
+            "od_cube.aggregation_period_ids": snapshot.aggregation_period_ids,
+            "od_cube.stats_refs": snapshot.stats_refs
+        }
+        for (table, h3_level), od_table in snapshot.tables.items():
+            prefix = f"od_cube.{table}.{h3_level}."
+            for name in ("origins", "destinations", "periods", "modalities", "trips"):
+                arrays[prefix + name] = getattr(od_table, name)
+            for name in ("by_origin", "by_destination"):
+                index = getattr(od_table, name)
+                arrays[f"{prefix}{name}.order"] = index.order
+                arrays[f"{prefix}{name}.values"] = index.values
+                arrays[f"{prefix}{name}.offsets"] = index.offsets
+        return arrays, {"modalities": self._modality_codes}
+
+    # Replaces the cube with arrays written by export, the arrays aren't copied.
+    def load_export(self, arrays: dict, metadata: dict):
+        tables = {}
+        for table_key in [("od_h3", h3_level) for h3_level in h3_levels] + [("od_geometry", None)]:
+            prefix = f"od_cube.{table_key[0]}.{table_key[1]}."
+            if prefix + "trips" not in arrays:
+                continue
+            indexes = [
+                Index.from_arrays(arrays[f"{prefix}{name}.order"], arrays[f"{prefix}{name}.values"], arrays[f"{prefix}{name}.offsets"])
+                for name in ("by_origin", "by_destination")
+            ]
+            columns = [arrays[prefix + name] for name in ("origins", "destinations", "periods", "modalities", "trips")]
+            tables[table_key] = ODTable(*columns, *indexes)
+        stats_refs = arrays["od_cube.stats_refs"]
+        self._modality_codes = dict(metadata["modalities"])
+        self.stats_refs = stats_refs.tolist()
+        self._stats_ref_codes = {stats_ref: code for code, stats_ref in enumerate(self.stats_refs)}
+        self.snapshot = Snapshot(arrays["od_cube.aggregation_period_ids"], tables, stats_refs)
+
+    async def refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(e)
+            await asyncio.sleep(refresh_interval)
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            "aggregation_periods": len(snapshot.aggregation_period_ids),
+            "rows": {f"{table}_{h3_level}" if h3_level else table: len(od_table) for (table, h3_level), od_table in snapshot.tables.items()},
+            "bytes": sum(
+                column.nbytes
+                for od_table in snapshot.tables.values()
+                for column in (od_table.origins, od_table.destinations, od_table.periods, od_table.modalities, od_table.trips,
+                    od_table.by_origin.order, od_table.by_destination.order)
+            )
+        }
+
+# Applies the minimum number of trips, the order and the page of db.query_od to the aggregated keys.
+def page(keys: np.ndarray, number_of_trips: np.ndarray, key: str, data: query_od_parameters.QueryODParameters):
+    selected = number_of_trips >= data.min_trips
+    if data.after is not None:
+        after_number_of_trips, after_key, _ = data.after
+        selected &= (number_of_trips < after_number_of_trips) | ((number_of_trips == after_number_of_trips) & (keys > after_key))
+    keys, number_of_trips = keys[selected], number_of_trips[selected]
+    order = np.lexsort((keys, -number_of_trips))
+    start = data.offset if data.after is None else 0
+    page_size = data.page_size()
+    order = order[start:] if page_size is None else order[start:start + page_size]
+    return [{key: value, "number_of_trips": trips} for value, trips in zip(keys[order].tolist(), number_of_trips[order].tolist())]
+
+def build_snapshot(snapshot: Snapshot, aggregation_period_ids: np.ndarray, new_rows: dict, stats_refs: np.ndarray):
+    tables = {}
+    for table_key in [("od_h3", h3_level) for h3_level in h3_levels] + [("od_geometry", None)]:
+        columns = []
+        old_table = snapshot.tables.get(table_key)
+        if old_table is not None:
+            # Rows of periods that left the window are dropped, the others get the position in the new periods.
+            old_aggregation_period_ids = snapshot.aggregation_period_ids[old_table.periods]
+            kept = np.isin(old_aggregation_period_ids, aggregation_period_ids)
+            columns.append((old_table.origins[kept], old_table.destinations[kept], old_aggregation_period_ids[kept],
+                old_table.modalities[kept], old_table.trips[kept]))
+        if table_key in new_rows:
+            columns.append(tuple(new_rows[table_key]))
+        if len(columns) == 0:
+            continue
+        origins, destinations, periods, modalities, trips = (np.concatenate(column) for column in zip(*columns))
+        tables[table_key] = ODTable.create(
+            origins, destinations, np.searchsorted(aggregation_period_ids, periods).astype(np.int32), modalities, trips
+        )
+    return Snapshot(aggregation_period_ids, tables, stats_refs)
+
+async def get_complete_aggregation_periods(days: int, delay_hours: float):
+    stmt = """
+        SELECT aggregation_period_id
+        FROM od_aggregation_period
+        WHERE start_time_period >= current_date - %(days)s::int
+        AND start_time_period < now() - %(delay)s * interval '1 hour'
+    """
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            await db_helper.execute(cur, stmt, {"days": days, "delay": delay_hours})
+            return [row["aggregation_period_id"] for row in await cur.fetchall()]
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+
+# Fetches the rows in batches from a server side cursor and converts every batch to columns.
+async def load_rows(stmt: str, aggregation_period_ids: np.ndarray, to_columns):
+    params = {"aggregation_period_ids": aggregation_period_ids.tolist(), "h3_levels": list(h3_levels)}
+    batches = []
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            async with conn.cursor(name="od_cube_load") as server_cursor:
+                await server_cursor.execute(stmt, params)
+                while True:
+                    rows = await server_cursor.fetchmany(load_batch_size)
+                    if len(rows) == 0:
+                        break
+                    batches.append(to_columns(rows))
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+            return None
+    if len(batches) == 0:
+        return to_columns([])
+    return [np.concatenate(column) for column in zip(*batches)]
+
+od_cube = ODCube()
+
+def start_background_refresh():
+    return asyncio.create_task(od_cube.refresh_periodically())
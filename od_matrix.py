@@ -0,0 +1,74 @@
+from dataclasses import dataclass
+import numpy as np
+import columnar
+import h3_codec
+import io
+
+@dataclass
+class ODMatrix:
+    origins: np.ndarray
+    destinations: np.ndarray
+    origin_index: np.ndarray
+    destination_index: np.ndarray
+    number_of_trips: np.ndarray
+
+    def dense(self):
+        matrix = np.zeros((len(self.origins), len(self.destinations)), dtype=np.int64)
+        matrix[self.origin_index, self.destination_index] = self.number_of_trips
+        return matrix
+
+    def to_json(self, representation: str):
+        result = {
+            "origins": h3_codec.to_strings(self.origins),
+            "destinations": h3_codec.to_strings(self.destinations)
+        }
+        if representation == "dense":
+            result["number_of_trips"] = self.dense().tolist()
+        else:
+            result["origin_index"] = self.origin_index.tolist()
+            result["destination_index"] = self.destination_index.tolist()
+            result["number_of_trips"] = self.number_of_trips.tolist()
+        return result
+
+    def encode_json(self, representation: str):
+        return columnar.json_bytes({"result": {"matrix": self.to_json(representation)}})
+
+    # Non empty entries with the cell ids instead of indexes, for the columnar formats.
+    def columns(self):
+        return {
+            "origin_cell": self.origins[self.origin_index],
+            "destination_cell": self.destinations[self.destination_index],
+            "number_of_trips": self.number_of_trips
+        }
+
+    # .npz is a zip of .npy arrays, cell ids are stored as uint64.
+    def to_npz(self, representation: str):
+        arrays = {
+            "origins": self.origins,
+            "destinations": self.destinations
+        }
+        if representation == "dense":
+            arrays["number_of_trips"] = self.dense()
+        else:
+            arrays["origin_index"] = self.origin_index
+            arrays["destination_index"] = self.destination_index
+            arrays["number_of_trips"] = self.number_of_trips
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+def create_od_matrix(rows, origin_cells: list[int], destination_cells: list[int]):
+    origins = np.unique(np.array(origin_cells, dtype=np.uint64))
+    destinations = np.unique(np.array(destination_cells, dtype=np.uint64))
+    number_of_rows = len(rows)
+    origin_index = np.searchsorted(origins, np.fromiter((row["origin_cell"] for row in rows), dtype=np.uint64, count=number_of_rows))
+    destination_index = np.searchsorted(destinations, np.fromiter((row["destination_cell"] for row in rows), dtype=np.uint64, count=number_of_rows))
+    number_of_trips = np.fromiter((row["number_of_trips"] for row in rows), dtype=np.int64, count=number_of_rows)
+    order = np.lexsort((destination_index, origin_index))
+    return ODMatrix(
+        origins=origins,
+        destinations=destinations,
+        origin_index=origin_index[order],
+        destination_index=destination_index[order],
+        number_of_trips=number_of_trips[order]
+    )
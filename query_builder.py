@@ -0,0 +1,151 @@
+import query_od_parameters
+import h3_codec
+import rollup
+
+# Builds the statements of the OD queries. Every query reads the source of a table (raw rows and
+# rollups, see rollup.plan) for the days start_date up to and including end_date, filters it on cells
+# or stat_refs with array parameters, and groups it by one or more columns. Filters that don't restrict
+# anything are left out of the statement instead of being disabled with a parameter, so the planner
+# can use the indexes.
+
+# h3 levels in od_h3, coarser resolutions are rolled up from the coarsest stored level.
+stored_h3_levels = (7, 8)
+
+def h3_base_level(h3_resolution: int):
+    return max(h3_resolution, min(stored_h3_levels))
+
+# SQL expression of the parent at h3_resolution of the cells in column, the same bit operations as h3_codec.to_parents.
+def h3_parent_sql(column: str, h3_resolution: int):
+    if h3_resolution >= min(stored_h3_levels):
+        return column
+    keep, set_bits = h3_codec.parent_constants(h3_resolution)
+    # keep has the highest bit set, as a signed bigint it is negative.
+    return f"(({column} & ({keep - (1 << 64)})::bigint) | {set_bits}::bigint)"
+
+# LIMIT and OFFSET of the requested page, adds its parameters to params. Postgres uses a top-N heapsort for a LIMIT.
+def page_sql(p: str, data: query_od_parameters.QueryODParameters, params: dict):
+    page_size = data.page_size()
+    stmt = ""
+    if page_size is not None:
+        stmt = f"LIMIT %({p}page_size)s"
+        params[p + "page_size"] = int(page_size)
+    if data.after is None and data.offset:
+        stmt += f" OFFSET %({p}offset)s"
+        params[p + "offset"] = int(data.offset)
+    return stmt
+
+# name of the single query: table, column filtered on, column grouped by, key in result rows
+od_queries = {
+    "query_h3_destinations": ("od_h3", "origin_cell", "destination_cell", "cell"),
+    "query_h3_origins": ("od_h3", "destination_cell", "origin_cell", "cell"),
+    "query_geometry_destinations": ("od_geometry", "origin_stats_ref", "destination_stats_ref", "destination_stat_ref"),
+    "query_geometry_origins": ("od_geometry", "destination_stats_ref", "origin_stats_ref", "origin_stat_ref")
+}
+
+array_types = {"od_h3": "bigint[]", "od_geometry": "text[]"}
+
+# Source statement of table for the days of data and its parameters, parameters are prefixed with p.
+async def source_sql(table: str, p: str, data: query_od_parameters.QueryODParameters):
+    sources = rollup.plan(data, data.start_date, data.end_date)
+    return await rollup.source_statement(table, sources, p, data)
+
+# WHERE clause with column = ANY(values) for every item of filters, adds its parameters to params.
+def where_sql(table: str, filters: dict, h3_level: int | None, p: str, data: query_od_parameters.QueryODParameters, params: dict):
+    conditions = []
+    for column, values in filters.items():
+        conditions.append(f"{column} = ANY(%({p}{column})s::{array_types[table]})")
+        params[p + column] = list(values)
+    if h3_level is not None:
+        conditions.append(f"h3_level = %({p}h3_level)s")
+        params[p + "h3_level"] = h3_level
+    if not data.dont_filter_on_modality:
+        conditions.append(f"modality = ANY(%({p}modalities)s::text[])")
+        params[p + "modalities"] = list(data.modalities)
+    return "WHERE " + "\n        AND ".join(conditions)
+
+# Statement of a single OD query, numbered index so that several can be combined with UNION ALL.
+# Rows have the columns spec, cell, stat_ref, bucket and number_of_trips.
+async def od_statement(index: int, name: str, args):
+    table, filter_column, group_column, _ = od_queries[name]
+    p = f"s{index}_"
+    if table == "od_h3":
+        values, h3_resolution, data = args
+        h3_level = h3_base_level(h3_resolution)
+        values = h3_codec.to_children(values, h3_level).tolist()
+        group_column = h3_parent_sql(group_column, h3_resolution)
+        columns = f"{group_column} as cell, NULL::text as stat_ref"
+        key_type = "bigint"
+    else:
+        values, data = args
+        h3_level = None
+        columns = f"NULL::bigint as cell, {group_column} as stat_ref"
+        key_type = "text"
+    source_stmt, params = await source_sql(table, p, data)
+    where = where_sql(table, {filter_column: values}, h3_level, p, data, params)
+    # Keyset pagination, rows after the last row of the previous page in the order of od_order.
+    after_filter = ""
+    if data.after is not None:
+        after_filter = f"""AND (sum(number_of_trips) < %({p}after_number_of_trips)s
+            OR (sum(number_of_trips) = %({p}after_number_of_trips)s AND {group_column} > %({p}after_key)s::{key_type}))"""
+        params[p + "after_number_of_trips"], params[p + "after_key"], _ = data.after
+    bucket, group_by = "NULL::text", group_column
+    if data.group_by is not None:
+        bucket, group_by = "bucket", f"{group_column}, bucket"
+    stmt = f"""
+        SELECT {index} as spec, {columns}, {bucket} as bucket, sum(number_of_trips)::bigint as number_of_trips
+        FROM ({source_stmt}) as od
+        {where}
+        GROUP BY {group_by}
+        HAVING sum(number_of_trips) >= %({p}min_trips)s
+        {after_filter}
+    """
+    params[p + "min_trips"] = data.min_trips
+    return stmt, params
+
+# Converts a row of od_statement to the row the single query function returns.
+def od_row(name: str, row):
+    key = od_queries[name][3]
+    value = row["cell"] if key == "cell" else row["stat_ref"]
+    if row["bucket"] is not None:
+        return {key: value, "bucket": row["bucket"], "number_of_trips": row["number_of_trips"]}
+    return {key: value, "number_of_trips": row["number_of_trips"]}
+
+# Order of the rows of od_statement, ties are broken on the key to make pages stable.
+od_order = "number_of_trips DESC, cell, stat_ref"
+
+# Statement of a single OD query, ordered and paged.
+async def single_od_statement(name: str, args):
+    stmt, params = await od_statement(0, name, args)
+    return stmt + f" ORDER BY {od_order} {page_sql('s0_', args[-1], params)}", params
+
+# Statement of several OD queries in one, rows are ordered by the index of their query.
+async def batch_od_statement(queries: list[tuple[int, str, tuple]]):
+    stmts = []
+    params = {}
+    for index, name, args in queries:
+        stmt, query_params = await od_statement(index, name, args)
+        stmts.append(stmt)
+        params.update(query_params)
+    return " UNION ALL ".join(stmts) + f" ORDER BY spec, {od_order}", params
+
+# Statement of the trips between origin_cells and destination_cells, grouped by both.
+async def matrix_statement(origin_cells: list[int], destination_cells: list[int], h3_resolution: int, data: query_od_parameters.QueryODParameters):
+    h3_level = h3_base_level(h3_resolution)
+    source_stmt, params = await source_sql("od_h3", "", data)
+    where = where_sql("od_h3", {
+        "origin_cell": h3_codec.to_children(origin_cells, h3_level).tolist(),
+        "destination_cell": h3_codec.to_children(destination_cells, h3_level).tolist()
+    }, h3_level, "", data, params)
+    origin_cell = h3_parent_sql("origin_cell", h3_resolution)
+    destination_cell = h3_parent_sql("destination_cell", h3_resolution)
+    stmt = f"""
+        SELECT {origin_cell} as origin_cell, {destination_cell} as destination_cell, sum(number_of_trips)::bigint as number_of_trips
+        FROM ({source_stmt}) as od
+        {where}
+        GROUP BY {origin_cell}, {destination_cell}
+        HAVING sum(number_of_trips) >= %(min_trips)s
+        ORDER BY number_of_trips DESC, origin_cell, destination_cell
+        {page_sql("", data, params)}
+    """
+    params["min_trips"] = data.min_trips
+    return stmt, params
@@ -1,7 +1,12 @@
-from datetime import date
-import h3
+from datetime import date, timedelta
+import h3_codec
 from fastapi import HTTPException
 from dataclasses import dataclass
+import base64
+import json
+
+# Results never contain od pairs with fewer trips, for privacy.
+MIN_TRIPS = 4
 
 @dataclass
 class QueryODParameters:
@@ -13,16 +18,77 @@ class QueryODParameters:
     dont_filter_on_days_of_week: bool
     time_periods: list[int]
     dont_filter_on_time_periods: bool
+    # Rows are sorted on number_of_trips descending and then on cell or stat_ref.
+    min_trips: int = MIN_TRIPS
+    top_k: int | None = None
+    limit: int | None = None
+    offset: int = 0
+    # (number_of_trips, cell or stat_ref, position) of the last row of the previous page.
+    after: tuple | None = None
+    # date, isoweek, isodow, time_period or modality, rows are aggregated per bucket as well.
+    group_by: str | None = None
+
+    def normalized(self):
+        # Canonical representation that is equal for queries that return the same result.
+        return (
+            self.start_date.isoformat(),
+            self.end_date.isoformat(),
+            None if self.dont_filter_on_modality else tuple(sorted(set(self.modalities))),
+            None if self.dont_filter_on_days_of_week else tuple(sorted(set(self.days_of_week))),
+            None if self.dont_filter_on_time_periods else tuple(sorted(set(self.time_periods))),
+            self.min_trips,
+            self.top_k,
+            self.limit,
+            self.offset,
+            self.after,
+            self.group_by
+        )
+
+    # Aggregations of the last day can still change, older ranges are immutable.
+    def is_historical(self):
+        return self.end_date < date.today() - timedelta(days=1)
+
+    # Position of the first row of the page in the complete result.
+    def position(self):
+        return self.after[2] if self.after is not None else self.offset
+
+    # Number of rows of the page, None for all remaining rows.
+    def page_size(self):
+        sizes = [size for size in (self.limit, None if self.top_k is None else max(self.top_k - self.position(), 0)) if size is not None]
+        return min(sizes) if sizes else None
+
+    # Cursor of the next page, None when this page was the last one.
+    def next_cursor(self, rows, key: str):
+        if self.limit is None or rows is None or len(rows) < self.limit:
+            return None
+        position = self.position() + len(rows)
+        if self.top_k is not None and position >= self.top_k:
+            return None
+        last_row = rows[-1]
+        return encode_cursor((last_row["number_of_trips"], last_row[key], position))
 
 def prepare_query(
         start_date,
         end_date,
         days_of_week,
         time_periods,
-        modalities
+        modalities,
+        min_trips = MIN_TRIPS,
+        top_k = None,
+        limit = None,
+        offset = 0,
+        cursor = None,
+        group_by = None,
+        cursor_key_type = int
         ):
     if start_date > end_date:
         raise HTTPException(status_code=422, detail="start_date is after end_date")
+    if min_trips < MIN_TRIPS:
+        raise HTTPException(status_code=422, detail=f"min_trips should be at least {MIN_TRIPS}")
+    if cursor and offset:
+        raise HTTPException(status_code=422, detail="specify either offset or cursor")
+    if group_by and (top_k or limit or offset or cursor):
+        raise HTTPException(status_code=422, detail="group_by can't be combined with top_k, limit, offset or cursor")
 
     query_days_of_week = [-1]
     dont_filter_on_days_of_week = True
@@ -50,43 +116,70 @@ def prepare_query(
         dont_filter_on_days_of_week = dont_filter_on_days_of_week,
         days_of_week = query_days_of_week,
         dont_filter_on_modality = dont_filter_on_modalities,
-        modalities = query_modalities
+        modalities = query_modalities,
+        min_trips = min_trips,
+        top_k = top_k,
+        limit = limit,
+        offset = offset or 0,
+        after = decode_cursor(cursor, cursor_key_type) if cursor else None,
+        group_by = group_by
     )
 
+def encode_cursor(after: tuple):
+    return base64.urlsafe_b64encode(json.dumps(after).encode()).decode()
+
+def is_bigint(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 1 << 63
+
+# key_type is the type of the key of the endpoint, int for cells and str for stat_refs.
+def decode_cursor(cursor: str, key_type: type):
+    try:
+        number_of_trips, key, position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=422, detail="invalid cursor")
+    valid_key = is_bigint(key) if key_type is int else isinstance(key, str)
+    if not is_bigint(number_of_trips) or not valid_key or not is_bigint(position):
+        raise HTTPException(status_code=422, detail="invalid cursor")
+    return (number_of_trips, key, position)
+
+days_of_week_db_values = {
+    "mo": 1,
+    "tu": 2,
+    "we": 3,
+    "th": 4,
+    "fr": 5,
+    "sa": 6,
+    "su": 7
+}
+
+time_periods_db_values = {
+    "2-6": 2,
+    "6-10": 6,
+    "10-14": 10,
+    "14-18": 14,
+    "18-22": 18,
+    "22-2": 22
+}
+
 def convert_days_of_week(days_of_week): 
     days_of_week = days_of_week.split(",")
-    api_to_db_value = {
-        "mo": 1,
-        "tu": 2,
-        "we": 3,
-        "th": 4,
-        "fr": 5,
-        "sa": 6,
-        "su": 7
-    }
-    return [api_to_db_value[param] for param in days_of_week]
+    return [days_of_week_db_values[param] for param in days_of_week]
 
 def convert_time_periods(time_periods):
     time_periods = time_periods.split(",")
-    api_to_db_value = {
-        "2-6": 2,
-        "6-10": 6,
-        "10-14": 10,
-        "14-18": 14,
-        "18-22": 18,
-        "22-2": 22
-    }
-    return [api_to_db_value[param] for param in time_periods]
+    return [time_periods_db_values[param] for param in time_periods]
 
 def convert_h3_cells(cells, h3_resolution):
     if cells == None:
         return []
     
-    cells = cells.split(",")
-    result = []
-    for cell in cells:
-        h3_cell = h3.string_to_h3(cell)
-        if h3.h3_get_resolution(cell) != h3_resolution:
-            raise HTTPException(status_code=422, detail="h3_level doesn't match with origin and destination cells.")
-        result.append(h3_cell)
-    return result
+    cells = [cell for cell in cells.split(",") if cell]
+    try:
+        result = h3_codec.from_strings(cells)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not h3_codec.are_cells(result).all():
+        raise HTTPException(status_code=422, detail="not all specified h3 indexes are h3 cells.")
+    if (h3_codec.get_resolutions(result) != h3_resolution).any():
+        raise HTTPException(status_code=422, detail="h3_level doesn't match with origin and destination cells.")
+    return result.tolist()
@@ -0,0 +1,130 @@
+from cache import TTLCache
+import query_od_parameters
+import functools
+import hashlib
+import pickle
+import sys
+import os
+
+class MemoryBackend:
+    def __init__(self, max_size: int, max_bytes: int):
+        self._cache = TTLCache(max_size=max_size, ttl=0, max_weight=max_bytes)
+
+    async def get(self, key):
+        return self._cache.get(key)
+
+    async def set(self, key, value, ttl: float):
+        self._cache.set(key, value, ttl=ttl, weight=estimate_size(value))
+
+    async def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+# Works with any server that speaks the redis protocol (redis, valkey, dragonfly, keydb).
+# Memory is bounded by the server, configure it with maxmemory and an allkeys-lru policy.
+class RedisBackend:
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+        self._client = redis.from_url(url)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        try:
+            value = await self._client.get("od-api:" + key)
+        except Exception as e:
+            print(e)
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    async def set(self, key, value, ttl: float):
+        try:
+            await self._client.set("od-api:" + key, pickle.dumps(value), ex=max(1, int(ttl)))
+        except Exception as e:
+            print(e)
+
+    async def clear(self):
+        async for key in self._client.scan_iter("od-api:*"):
+            await self._client.delete(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+def estimate_size(rows):
+    if not rows:
+        return sys.getsizeof(rows)
+    row_size = sys.getsizeof(rows[0]) + sum(sys.getsizeof(value) for value in rows[0].values())
+    return sys.getsizeof(rows) + len(rows) * row_size
+
+def create_backend():
+    backend = os.getenv("RESULT_CACHE_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryBackend(
+            max_size=int(os.getenv("RESULT_CACHE_MAX_SIZE", "10000")),
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        )
+    if backend == "redis":
+        return RedisBackend(os.getenv("RESULT_CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "none":
+        return None
+    raise ValueError(f"unknown RESULT_CACHE_BACKEND {backend}")
+
+backend = create_backend()
+historical_ttl = float(os.getenv("RESULT_CACHE_HISTORICAL_TTL", "86400"))
+recent_ttl = float(os.getenv("RESULT_CACHE_RECENT_TTL", "60"))
+
+def normalize(value):
+    if isinstance(value, query_od_parameters.QueryODParameters):
+        return value.normalized()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(sorted(set(value)))
+    return value
+
+def cache_key(name: str, args):
+    key = repr((name,) + tuple(normalize(arg) for arg in args))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def ttl_for(args):
+    for arg in args:
+        if isinstance(arg, query_od_parameters.QueryODParameters) and not arg.is_historical():
+            return recent_ttl
+    return historical_ttl
+
+async def lookup(name: str, args):
+    if backend is None:
+        return None
+    return await backend.get(cache_key(name, args))
+
+async def store(name: str, args, result):
+    if backend is None or result is None:
+        return
+    await backend.set(cache_key(name, args), result, ttl_for(args))
+
+def cached(query):
+    @functools.wraps(query)
+    async def wrapper(*args):
+        result = await lookup(query.__name__, args)
+        if result is not None:
+            return result
+        result = await query(*args)
+        await store(query.__name__, args, result)
+        return result
+    return wrapper
+
+def stats():
+    if backend is None:
+        return {}
+    return backend.stats()
+
+async def clear():
+    if backend is not None:
+        await backend.clear()
@@ -0,0 +1,207 @@
+from dataclasses import dataclass
+from datetime import date, timedelta
+from db_helper import db_helper
+from aggregation_periods import aggregation_period_index
+import query_od_parameters
+import asyncio
+import os
+
+# Rollups are pre-aggregated copies of od_h3 and od_geometry per day and time period and per month,
+# created with sql/rollups.sql and refreshed incrementally when new aggregation periods arrive.
+enabled = os.getenv("ROLLUPS_ENABLED", "false") == "true"
+refresh_interval = float(os.getenv("ROLLUP_REFRESH_INTERVAL", "3600"))
+# Aggregation periods are only rolled up after this delay so that all their od rows are present.
+refresh_delay_hours = float(os.getenv("ROLLUP_DELAY_HOURS", "24"))
+
+# Days before this date are completely aggregated in the rollup tables.
+complete_until: date | None = None
+
+# table: columns that are kept in the rollups, besides modality and number_of_trips
+rollup_tables = {
+    "od_h3": ["h3_level", "origin_cell", "destination_cell"],
+    "od_geometry": ["origin_stats_ref", "destination_stats_ref"]
+}
+
+@dataclass
+class Source:
+    granularity: str
+    start_date: date
+    end_date: date
+
+def first_day_of_next_month(day: date):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+# Buckets of group_by in the day rollup, grouping on modality can use every source.
+day_buckets = {
+    "date": "day::text",
+    "isoweek": "to_char(day, 'IYYY-\"W\"IW')",
+    "isodow": "extract(isodow from day)::int::text",
+    "time_period": "time_period::text",
+    "modality": "modality"
+}
+
+# granularity: columns of the period in the rollup and their value in the raw tables
+granularities = {
+    "day": {"day": "start_time_period::date", "time_period": "extract(hour from start_time_period)::smallint"},
+    "month": {"month": "date_trunc('month', start_time_period)::date"}
+}
+
+# Splits the days from first_day up to and including last_day over the coarsest sources that answer the query exactly.
+# The day rollup keeps the time period (its start hour), the month rollup has no time period and day of week.
+def plan(data: query_od_parameters.QueryODParameters, first_day: date, last_day: date):
+    raw = [Source("raw", first_day, last_day)]
+    if not enabled or complete_until is None:
+        return raw
+    rollup_end = min(last_day, complete_until - timedelta(days=1))
+    if rollup_end < first_day:
+        return raw
+
+    sources = []
+    month_start = first_day if first_day.day == 1 else first_day_of_next_month(first_day)
+    month_end = rollup_end
+    if (rollup_end + timedelta(days=1)).day != 1:
+        month_end = rollup_end.replace(day=1) - timedelta(days=1)
+    day_only = not data.dont_filter_on_days_of_week or not data.dont_filter_on_time_periods
+    if day_only or data.group_by not in (None, "modality") or month_start > month_end:
+        sources.append(Source("day", first_day, rollup_end))
+    else:
+        if first_day < month_start:
+            sources.append(Source("day", first_day, month_start - timedelta(days=1)))
+        sources.append(Source("month", month_start, month_end))
+        if month_end < rollup_end:
+            sources.append(Source("day", month_end + timedelta(days=1), rollup_end))
+    if rollup_end < last_day:
+        sources.append(Source("raw", rollup_end + timedelta(days=1), last_day))
+    return sources
+
+# Returns a UNION ALL of the sources that selects the columns of table, modality and number_of_trips,
+# and the bucket of data.group_by as text when it is set.
+# Filters on day of week and time of day are applied, other filters are left to the caller.
+# Aggregation periods of the raw tables are resolved up front and passed as an array.
+async def source_statement(table: str, sources: list[Source], p: str, data: query_od_parameters.QueryODParameters):
+    columns = ", ".join(rollup_tables[table])
+    bucket = ""
+    if data.group_by == "modality":
+        bucket = ", modality::text as bucket"
+    stmts = []
+    params = {}
+    # Filters that don't restrict anything are left out, see query_builder.
+    days_of_week_filter = ""
+    if not data.dont_filter_on_days_of_week:
+        days_of_week_filter = f"AND extract(isodow from day) = ANY(%({p}days_of_week)s::int[])"
+        params[p + "days_of_week"] = list(data.days_of_week)
+    time_periods_filter = ""
+    if not data.dont_filter_on_time_periods:
+        time_periods_filter = f"AND time_period = ANY(%({p}time_periods)s::int[])"
+        params[p + "time_periods"] = list(data.time_periods)
+    for index, source in enumerate(sources):
+        if source.granularity == "raw" and data.group_by not in (None, "modality"):
+            # The bucket of every aggregation period is passed along with its id.
+            aggregation_period_ids, buckets = await aggregation_period_index.resolve_buckets(data, source.start_date, source.end_date)
+            params[f"{p}r{index}_aggregation_period_ids"] = aggregation_period_ids
+            params[f"{p}r{index}_buckets"] = buckets
+            stmts.append(f"""
+                SELECT {columns}, bucket, modality::text as modality, number_of_trips
+                FROM {table}
+                JOIN unnest(%({p}r{index}_aggregation_period_ids)s::bigint[], %({p}r{index}_buckets)s::text[])
+                    AS period (aggregation_period_id, bucket) USING (aggregation_period_id)
+            """)
+            continue
+        if source.granularity == "raw":
+            params[f"{p}r{index}_aggregation_period_ids"] = await aggregation_period_index.resolve(data, source.start_date, source.end_date)
+            stmts.append(f"""
+                SELECT {columns}{bucket}, modality::text as modality, number_of_trips
+                FROM {table}
+                WHERE aggregation_period_id = ANY(%({p}r{index}_aggregation_period_ids)s::bigint[])
+            """)
+            continue
+        start_date = f"%({p}r{index}_start_date)s"
+        end_date = f"%({p}r{index}_end_date)s"
+        params[f"{p}r{index}_start_date"] = source.start_date
+        params[f"{p}r{index}_end_date"] = source.end_date
+        if source.granularity == "day":
+            day_bucket = f", {day_buckets[data.group_by]} as bucket" if data.group_by is not None else ""
+            stmts.append(f"""
+                SELECT {columns}{day_bucket}, modality, number_of_trips
+                FROM {table}_rollup_day
+                WHERE day >= {start_date} AND day <= {end_date}
+                {days_of_week_filter}
+                {time_periods_filter}
+            """)
+        else:
+            stmts.append(f"""
+                SELECT {columns}{bucket}, modality, number_of_trips
+                FROM {table}_rollup_month
+                WHERE month >= {start_date} AND month <= {end_date}
+            """)
+    return " UNION ALL ".join(stmts), params
+
+async def load_state():
+    global complete_until
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            await cur.execute("SELECT complete_until FROM od_rollup_state")
+            complete_until = (await cur.fetchone())["complete_until"]
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+
+# Adds the aggregation periods that arrived since the last refresh to the rollups.
+# The state row is locked, so concurrent refreshes from several workers don't count periods twice.
+async def refresh():
+    async with db_helper.get_resource() as (cur, conn):
+        try:
+            await cur.execute("SELECT last_aggregation_period_id FROM od_rollup_state FOR UPDATE")
+            last_aggregation_period_id = (await cur.fetchone())["last_aggregation_period_id"]
+            await cur.execute("""
+                SELECT max(aggregation_period_id) as aggregation_period_id, max(start_time_period)::date as last_day
+                FROM od_aggregation_period
+                WHERE aggregation_period_id > %(last_aggregation_period_id)s
+                AND start_time_period < now() - %(delay)s * interval '1 hour'
+            """, {"last_aggregation_period_id": last_aggregation_period_id, "delay": refresh_delay_hours})
+            new_periods = await cur.fetchone()
+            if new_periods["aggregation_period_id"] is None:
+                return
+            params = {
+                "last_aggregation_period_id": last_aggregation_period_id,
+                "aggregation_period_id": new_periods["aggregation_period_id"]
+            }
+            for table, columns in rollup_tables.items():
+                for granularity, period_columns in granularities.items():
+                    key = ", ".join(columns + ["modality"] + list(period_columns))
+                    period = ", ".join(period_columns.values())
+                    await cur.execute(f"""
+                        INSERT INTO {table}_rollup_{granularity} ({key}, number_of_trips)
+                        SELECT {", ".join(columns)}, modality::text, {period}, sum(number_of_trips)
+                        FROM {table}
+                        JOIN od_aggregation_period USING (aggregation_period_id)
+                        WHERE aggregation_period_id > %(last_aggregation_period_id)s
+                        AND aggregation_period_id <= %(aggregation_period_id)s
+                        GROUP BY {", ".join(columns)}, modality, {period}
+                        ON CONFLICT ({key}) DO UPDATE
+                        SET number_of_trips = {table}_rollup_{granularity}.number_of_trips + EXCLUDED.number_of_trips
+                    """, params)
+            await cur.execute("""
+                UPDATE od_rollup_state
+                SET last_aggregation_period_id = %(aggregation_period_id)s,
+                complete_until = GREATEST(complete_until, %(last_day)s)
+            """, {"aggregation_period_id": new_periods["aggregation_period_id"], "last_day": new_periods["last_day"]})
+        except Exception as e:
+            await conn.rollback()
+            print(e)
+    await load_state()
+
+async def refresh_periodically():
+    while True:
+        try:
+            await refresh()
+        except Exception as e:
+            print(e)
+        await asyncio.sleep(refresh_interval)
+
+async def refresh_once():
+    await refresh()
+    await db_helper.shutdown_connection_pool()
+
+if __name__ == "__main__":
+    asyncio.run(refresh_once())
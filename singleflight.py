@@ -0,0 +1,38 @@
+import result_cache
+import functools
+import asyncio
+import metrics
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one execution.
+
+    The execution runs in its own task, so a caller that is cancelled (for example because the client disconnected)
+    doesn't cancel it for the other callers.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, name: str, key, func):
+        task = self._tasks.get(key)
+        if task is None:
+            metrics.coalesced_executions.labels(name).inc()
+            task = asyncio.ensure_future(func())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            metrics.coalesced_requests.labels(name).inc()
+        return await asyncio.shield(task)
+
+single_flight = SingleFlight()
+
+# Concurrent calls of query with the same normalized arguments await one execution,
+# including the result cache lookup when it is combined with result_cache.cached.
+def coalesced(query):
+    name = query.__name__
+
+    @functools.wraps(query)
+    async def wrapper(*args):
+        key = (name,) + tuple(result_cache.normalize(arg) for arg in args)
+        return await single_flight.do(name, key, lambda: query(*args))
+    return wrapper
@@ -0,0 +1,190 @@
+from h3_access_index import h3_access_index
+import numpy as np
+import od_cube
+import query_builder
+import executor
+import asyncio
+import fcntl
+import json
+import mmap
+import time
+import db
+import os
+
+# Snapshot files contain the data that every worker keeps in memory. One worker writes a new version,
+# all workers map the current version read-only, so the pages are shared between the worker processes.
+enabled = os.getenv("SNAPSHOT_ENABLED", "false") == "true"
+directory = os.getenv("SNAPSHOT_DIR", "/tmp/od-api-snapshots")
+refresh_interval = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", "60"))
+# A new version is written when the current version is older than this.
+max_age = float(os.getenv("SNAPSHOT_MAX_AGE", "600"))
+keep_versions = 2
+
+magic = b"ODSNAP01"
+alignment = 64
+
+def aligned(offset: int):
+    return -(-offset // alignment) * alignment
+
+# File layout: magic, the length of the json header as 8 bytes little endian, the header
+# and the arrays, every array starts at a multiple of alignment.
+def write_file(path: str, arrays: dict, metadata: dict):
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    header = {"metadata": metadata, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = aligned(offset + array.nbytes)
+    encoded_header = json.dumps(header).encode()
+    data_start = aligned(len(magic) + 8 + len(encoded_header))
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(magic)
+        file.write(len(encoded_header).to_bytes(8, "little"))
+        file.write(encoded_header)
+        for name, array in arrays.items():
+            file.seek(data_start + header["arrays"][name]["offset"])
+            file.write(array.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+class SnapshotFile:
+    """A snapshot file mapped read-only, the arrays are views of the mapping."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(magic)] != magic:
+            raise ValueError(f"{path} is not a snapshot file")
+        header_length = int.from_bytes(self._mmap[len(magic):len(magic) + 8], "little")
+        header = json.loads(self._mmap[len(magic) + 8:len(magic) + 8 + header_length])
+        data_start = aligned(len(magic) + 8 + header_length)
+        self.metadata = header["metadata"]
+        self.arrays = {}
+        for name, spec in header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(spec["shape"]))
+            if count == 0:
+                self.arrays[name] = np.empty(spec["shape"], dtype=dtype)
+                continue
+            self.arrays[name] = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=data_start + spec["offset"]).reshape(spec["shape"])
+        # Sorted stats_refs and the position of their municipality in metadata["municipalities"].
+        self._stats_refs = self.arrays["stats_refs"]
+        self._stats_ref_municipalities = self.arrays["stats_ref_municipalities"]
+
+    @property
+    def version(self):
+        return self.metadata["version"]
+
+    def age(self):
+        return time.time() - self.metadata["created_at"]
+
+    # Municipality of every stats_ref, None for unknown stats_refs.
+    def municipalities_of(self, stats_refs: list[str]):
+        municipalities = self.metadata["municipalities"]
+        if len(self._stats_refs) == 0:
+            return [None for _ in stats_refs]
+        requested = np.array(stats_refs, dtype=str)
+        positions = np.searchsorted(self._stats_refs, requested)
+        positions[positions == len(self._stats_refs)] = 0
+        found = self._stats_refs[positions] == requested
+        return [municipalities[self._stats_ref_municipalities[position]] if is_found else None for position, is_found in zip(positions.tolist(), found.tolist())]
+
+# Mapped current version, None when snapshots are disabled or no version was mapped yet.
+current: SnapshotFile | None = None
+
+def current_path():
+    try:
+        with open(os.path.join(directory, "current")) as file:
+            return os.path.join(directory, file.read().strip())
+    except FileNotFoundError:
+        return None
+
+async def build():
+    arrays = {}
+    metadata = {"version": time.time_ns(), "created_at": time.time(), "h3_levels": {}}
+    for h3_level in query_builder.stored_h3_levels:
+        await h3_access_index.load(h3_level)
+        municipalities, offsets, cells = await h3_access_index.export(h3_level)
+        metadata["h3_levels"][str(h3_level)] = municipalities
+        arrays[f"h3_acl.{h3_level}.offsets"] = offsets
+        arrays[f"h3_acl.{h3_level}.cells"] = cells
+
+    rows = await db.get_stats_ref_municipalities()
+    if rows is None:
+        return None
+    rows = sorted((row["stats_ref"], row["municipality"]) for row in rows)
+    municipalities = sorted({municipality for _, municipality in rows})
+    municipality_index = {municipality: index for index, municipality in enumerate(municipalities)}
+    metadata["municipalities"] = municipalities
+    arrays["stats_refs"] = np.array([stats_ref for stats_ref, _ in rows], dtype=str)
+    arrays["stats_ref_municipalities"] = np.array([municipality_index[municipality] for _, municipality in rows], dtype=np.int32)
+
+    if od_cube.enabled:
+        await od_cube.od_cube.refresh()
+        cube_arrays, metadata["od_cube"] = od_cube.od_cube.export()
+        arrays.update(cube_arrays)
+
+    name = f"snapshot-{metadata['version']}.bin"
+    await executor.run_in_thread(write_file, os.path.join(directory, name), arrays, metadata)
+    # The pointer is replaced atomically, workers read either the old or the new version.
+    with open(os.path.join(directory, "current.tmp"), "w") as file:
+        file.write(name)
+    os.replace(os.path.join(directory, "current.tmp"), os.path.join(directory, "current"))
+    remove_old_versions()
+    return name
+
+# Workers that still map a removed version keep using it until they map the new one.
+def remove_old_versions():
+    versions = sorted(name for name in os.listdir(directory) if name.startswith("snapshot-") and name.endswith(".bin"))
+    for name in versions[:-keep_versions]:
+        os.remove(os.path.join(directory, name))
+
+# Only the worker that gets the lock writes a new version, the others keep their current version.
+async def build_if_unlocked():
+    with open(os.path.join(directory, "lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        try:
+            path = current_path()
+            if path is not None and os.path.exists(path) and SnapshotFile(path).age() < max_age:
+                return
+            await build()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def apply(snapshot_file: SnapshotFile):
+    global current
+    for h3_level, municipalities in snapshot_file.metadata["h3_levels"].items():
+        h3_level = int(h3_level)
+        h3_access_index.load_export(
+            h3_level, municipalities,
+            snapshot_file.arrays[f"h3_acl.{h3_level}.offsets"], snapshot_file.arrays[f"h3_acl.{h3_level}.cells"]
+        )
+    if od_cube.enabled and "od_cube" in snapshot_file.metadata:
+        od_cube.od_cube.load_export(snapshot_file.arrays, snapshot_file.metadata["od_cube"])
+    current = snapshot_file
+
+async def refresh():
+    os.makedirs(directory, exist_ok=True)
+    path = current_path()
+    if path is None or not os.path.exists(path) or current is None or current.age() >= max_age:
+        await build_if_unlocked()
+        path = current_path()
+    if path is not None and (current is None or current.path != path):
+        try:
+            apply(SnapshotFile(path))
+        except (OSError, ValueError) as e:
+            print(e)
+
+async def refresh_periodically():
+    while True:
+        await asyncio.sleep(refresh_interval)
+        try:
+            await refresh()
+        except Exception as e:
+            print(e)
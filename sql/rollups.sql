@@ -0,0 +1,56 @@
+-- Pre-aggregated copies of od_h3 and od_geometry, used when ROLLUPS_ENABLED=true.
+-- They are filled incrementally by rollup.refresh (python rollup.py).
+-- time_period of the day rollups is the start hour of the aggregation period, as in od_aggregation_period.
+
+CREATE TABLE IF NOT EXISTS od_h3_rollup_day (
+    h3_level smallint NOT NULL,
+    origin_cell bigint NOT NULL,
+    destination_cell bigint NOT NULL,
+    modality text NOT NULL,
+    day date NOT NULL,
+    time_period smallint NOT NULL,
+    number_of_trips bigint NOT NULL,
+    PRIMARY KEY (h3_level, origin_cell, destination_cell, modality, day, time_period)
+);
+CREATE INDEX IF NOT EXISTS od_h3_rollup_day_destination ON od_h3_rollup_day (h3_level, destination_cell, day);
+
+CREATE TABLE IF NOT EXISTS od_h3_rollup_month (
+    h3_level smallint NOT NULL,
+    origin_cell bigint NOT NULL,
+    destination_cell bigint NOT NULL,
+    modality text NOT NULL,
+    month date NOT NULL,
+    number_of_trips bigint NOT NULL,
+    PRIMARY KEY (h3_level, origin_cell, destination_cell, modality, month)
+);
+CREATE INDEX IF NOT EXISTS od_h3_rollup_month_destination ON od_h3_rollup_month (h3_level, destination_cell, month);
+
+CREATE TABLE IF NOT EXISTS od_geometry_rollup_day (
+    origin_stats_ref text NOT NULL,
+    destination_stats_ref text NOT NULL,
+    modality text NOT NULL,
+    day date NOT NULL,
+    time_period smallint NOT NULL,
+    number_of_trips bigint NOT NULL,
+    PRIMARY KEY (origin_stats_ref, destination_stats_ref, modality, day, time_period)
+);
+CREATE INDEX IF NOT EXISTS od_geometry_rollup_day_destination ON od_geometry_rollup_day (destination_stats_ref, day);
+
+CREATE TABLE IF NOT EXISTS od_geometry_rollup_month (
+    origin_stats_ref text NOT NULL,
+    destination_stats_ref text NOT NULL,
+    modality text NOT NULL,
+    month date NOT NULL,
+    number_of_trips bigint NOT NULL,
+    PRIMARY KEY (origin_stats_ref, destination_stats_ref, modality, month)
+);
+CREATE INDEX IF NOT EXISTS od_geometry_rollup_month_destination ON od_geometry_rollup_month (destination_stats_ref, month);
+
+-- Single row with the last aggregation period that is rolled up,
+-- days before complete_until are completely present in the rollups.
+CREATE TABLE IF NOT EXISTS od_rollup_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    last_aggregation_period_id integer NOT NULL,
+    complete_until date
+);
+INSERT INTO od_rollup_state (last_aggregation_period_id) VALUES (0) ON CONFLICT DO NOTHING;
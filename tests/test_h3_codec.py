@@ -0,0 +1,58 @@
+import h3
+import numpy as np
+import pytest
+import h3_codec
+
+# Cells around Utrecht at every resolution the API uses, and a pentagon.
+utrecht = [h3.geo_to_h3(52.09 + 0.01 * i, 5.12 + 0.013 * i, 8) for i in range(20)]
+pentagon = sorted(h3.get_pentagon_indexes(5))[0]
+
+def ints(cells):
+    return [h3.string_to_h3(cell) for cell in cells]
+
+def test_strings_round_trip():
+    cells = utrecht + [h3.h3_to_parent(cell, 5) for cell in utrecht] + [pentagon]
+    assert h3_codec.to_strings(ints(cells)) == cells
+    assert h3_codec.from_strings(cells).tolist() == ints(cells)
+
+def test_from_strings_rejects_invalid():
+    with pytest.raises(ValueError):
+        h3_codec.from_strings(["88196908zzfffff"])
+    with pytest.raises(ValueError):
+        h3_codec.from_strings([""])
+
+@pytest.mark.parametrize("resolution", [5, 6, 7, 8])
+def test_to_parents(resolution):
+    assert h3_codec.to_parents(ints(utrecht), resolution).tolist() == ints(h3.h3_to_parent(cell, resolution) for cell in utrecht)
+
+@pytest.mark.parametrize("cell_resolution, resolution", [(5, 7), (6, 8), (7, 8), (8, 8)])
+def test_to_children(cell_resolution, resolution):
+    cells = sorted({h3.h3_to_parent(cell, cell_resolution) for cell in utrecht})
+    expected = sorted(ints(child for cell in cells for child in h3.h3_to_children(cell, resolution)))
+    assert sorted(h3_codec.to_children(ints(cells), resolution).tolist()) == expected
+
+# The children of the deleted subsequence of a pentagon are included, the real children are all there.
+def test_to_children_of_pentagon():
+    children = set(h3_codec.to_children(ints([pentagon]), 7).tolist())
+    assert set(ints(h3.h3_to_children(pentagon, 7))) <= children
+    assert len(children) == 7 ** 2
+
+def test_to_children_of_mixed_resolutions():
+    cells = [h3.h3_to_parent(utrecht[0], 6), h3.h3_to_parent(utrecht[10], 7)]
+    expected = ints(h3.h3_to_children(cells[0], 8)) + ints(h3.h3_to_children(cells[1], 8))
+    assert sorted(h3_codec.to_children(ints(cells), 8).tolist()) == sorted(expected)
+
+def test_complete_parents():
+    parents = sorted({h3.h3_to_parent(cell, 6) for cell in utrecht})
+    cells = [child for parent in parents for child in h3.h3_to_children(parent, 8)]
+    # One missing child makes its parent incomplete.
+    incomplete = h3.h3_to_parent(cells.pop(5), 6)
+    expected = sorted(ints(parent for parent in parents if parent != incomplete))
+    assert sorted(h3_codec.complete_parents(ints(cells), 6).tolist()) == expected
+
+def test_parent_sql_constants_match_to_parents():
+    # query_builder.h3_parent_sql uses the same constants on signed bigints.
+    cells = np.array(ints(utrecht), dtype=np.uint64)
+    keep, set_bits = h3_codec.parent_constants(6)
+    signed = (cells.astype(np.int64) & np.int64(keep - (1 << 64))) | np.int64(set_bits)
+    assert signed.astype(np.uint64).tolist() == h3_codec.to_parents(cells, 6).tolist()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import mvt
+
+mapbox_vector_tile = pytest.importorskip("mapbox_vector_tile")
+shapely_geometry = pytest.importorskip("shapely.geometry")
+
+def decode(tile: bytes):
+    return mapbox_vector_tile.decode(tile, default_options={"y_coord_down": True})
+
+def ring(*points):
+    return np.array(points, dtype=float)
+
+square = ring((0, 0), (100, 0), (100, 100), (0, 100), (0, 0))
+hole = ring((20, 20), (20, 80), (80, 80), (80, 20), (20, 20))
+other = ring((200, 200), (300, 200), (250, 300))
+
+def shape(polygons):
+    return shapely_geometry.MultiPolygon([(polygon[0], polygon[1:]) for polygon in polygons])
+
+# Shoelace area in tile coordinates, the specification requires exterior rings with a positive area
+# (clockwise with y pointing down) and interior rings with a negative area.
+def signed_area(points):
+    points = np.array(points, dtype=float)
+    return np.sum(points[:-1, 0] * points[1:, 1] - points[1:, 0] * points[:-1, 1]) / 2
+
+def decoded_polygons(geometry):
+    return [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+
+def test_properties_and_layers():
+    properties = {"cell": "8819690843fffff", "number_of_trips": 12, "negative": -3, "share": 0.25, "accessible": True, "missing": None}
+    tile = mvt.encode_tile([
+        mvt.encode_layer("origins", [mvt.Feature(7, properties, [[square]]), mvt.Feature(8, {"cell": "other"}, [[other]])]),
+        mvt.encode_layer("accessible_h3", [mvt.Feature(1, {}, [[square]])], extent=512)
+    ])
+    layers = decode(tile)
+    assert set(layers) == {"origins", "accessible_h3"}
+    assert layers["origins"]["extent"] == 4096 and layers["accessible_h3"]["extent"] == 512
+    features = layers["origins"]["features"]
+    assert [feature["id"] for feature in features] == [7, 8]
+    assert features[0]["properties"] == {key: value for key, value in properties.items() if value is not None}
+    assert features[1]["properties"] == {"cell": "other"}
+
+# Rings are written in the winding order of the specification, whatever the order of the input.
+@pytest.mark.parametrize("polygons", [
+    [[square]],
+    [[square[::-1]]],
+    [[square, hole]],
+    [[square[::-1], hole[::-1]]],
+    [[square, hole], [other]],
+])
+def test_geometry(polygons):
+    feature = decode(mvt.encode_tile([mvt.encode_layer("zones", [mvt.Feature(1, {}, polygons)])]))["zones"]["features"][0]
+    decoded = shapely_geometry.shape(feature["geometry"])
+    assert decoded.is_valid
+    assert decoded.equals(shape(polygons))
+    for polygon in decoded_polygons(feature["geometry"]):
+        assert signed_area(polygon[0]) > 0
+        assert all(signed_area(interior) < 0 for interior in polygon[1:])
+
+# Points are rounded to the tile grid and repeated points are dropped.
+def test_rounding_and_repeated_points():
+    polygon = ring((0.2, 0.4), (0.4, 0.1), (100, 0), (99.7, 0.2), (100, 100), (0, 100))
+    feature = decode(mvt.encode_tile([mvt.encode_layer("zones", [mvt.Feature(1, {}, [[polygon]])])]))["zones"]["features"][0]
+    assert shapely_geometry.shape(feature["geometry"]).equals(shape([[square]]))
+    assert len(feature["geometry"]["coordinates"][0]) == 5
+
+# Features whose exterior collapses to a line or a point after rounding are left out, collapsed holes are dropped.
+def test_collapsed_rings():
+    line = ring((0, 0), (50, 0.2), (100, 0))
+    point = ring((10.1, 10.1), (10.2, 10.2), (9.9, 9.9))
+    tile = mvt.encode_tile([mvt.encode_layer("zones", [
+        mvt.Feature(1, {}, [[line]]),
+        mvt.Feature(2, {}, [[square, point]])
+    ])])
+    features = decode(tile)["zones"]["features"]
+    assert [feature["id"] for feature in features] == [2]
+    assert shapely_geometry.shape(features[0]["geometry"]).equals(shape([[square]]))
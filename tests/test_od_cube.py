@@ -0,0 +1,163 @@
+from datetime import date, timedelta
+import asyncio
+import random
+import time
+import h3
+import numpy as np
+import pytest
+import aggregation_periods
+import od_cube
+import query_od_parameters
+
+modalities = ["bicycle", "moped", "scooter"]
+start_day = date(2023, 1, 1)
+# 10 days with six periods each are in the cube, the 11th day isn't.
+periods = [
+    (start_day + timedelta(days=day), hour)
+    for day in range(11)
+    for hour in query_od_parameters.time_periods_db_values.values()
+]
+cube_periods = [aggregation_period_id for aggregation_period_id, (day, _) in enumerate(periods, 1) if day < start_day + timedelta(days=10)]
+
+origin_parents = [h3.geo_to_h3(52.09, 5.12, 6), h3.geo_to_h3(52.37, 4.9, 6)]
+origin_cells = {level: [child for parent in origin_parents for child in sorted(h3.h3_to_children(parent, level))] for level in (7, 8)}
+destination_cells = {level: [h3.geo_to_h3(51.9 + 0.01 * i, 4.4 + 0.02 * i, level) for i in range(40)] for level in (7, 8)}
+stats_refs = ["cbs:WK%06d" % i for i in range(25)]
+
+# Rows of od_h3 per level and od_geometry: (origin, destination, aggregation_period_id, modality, number_of_trips).
+# Small numbers of trips give ties and sums around min_trips.
+def random_rows(origins, destinations, count, seed):
+    generator = random.Random(seed)
+    return [
+        (generator.choice(origins), generator.choice(destinations), generator.choice(cube_periods), generator.choice(modalities), generator.randint(1, 5))
+        for _ in range(count)
+    ]
+
+rows = {
+    ("od_h3", 7): random_rows(origin_cells[7], destination_cells[7], 4000, 7),
+    ("od_h3", 8): random_rows(origin_cells[8], destination_cells[8], 6000, 8),
+    ("od_geometry", None): random_rows(stats_refs[:10], stats_refs[5:], 4000, 0)
+}
+
+@pytest.fixture
+def cube(monkeypatch):
+    index = aggregation_periods.AggregationPeriodIndex()
+    index.aggregation_period_ids = np.arange(1, len(periods) + 1, dtype=np.int64)
+    index.days = np.array([day for day, _ in periods], dtype="datetime64[D]")
+    index.isodows = np.array([day.isoweekday() for day, _ in periods], dtype=np.int8)
+    index.hours = np.array([hour for _, hour in periods], dtype=np.int8)
+    index.last_aggregation_period_id = len(periods)
+    index.loaded_at = time.monotonic()
+    monkeypatch.setattr(od_cube, "aggregation_period_index", index)
+
+    cube = od_cube.ODCube()
+    new_rows = {}
+    for (table, h3_level), table_rows in rows.items():
+        origins, destinations, period_ids, row_modalities, trips = zip(*table_rows)
+        if table == "od_h3":
+            origins = np.array([h3.string_to_h3(cell) for cell in origins], dtype=np.uint64)
+            destinations = np.array([h3.string_to_h3(cell) for cell in destinations], dtype=np.uint64)
+        else:
+            origins = np.array([cube.stats_ref_code(stats_ref) for stats_ref in origins], dtype=np.int32)
+            destinations = np.array([cube.stats_ref_code(stats_ref) for stats_ref in destinations], dtype=np.int32)
+        new_rows[(table, h3_level)] = [
+            origins, destinations, np.array(period_ids, dtype=np.int64),
+            np.array([cube.modality_code(modality) for modality in row_modalities], dtype=np.int8), np.array(trips, dtype=np.int32)
+        ]
+    cube.snapshot = od_cube.build_snapshot(cube.snapshot, np.array(cube_periods, dtype=np.int64), new_rows, np.array(cube.stats_refs, dtype=str))
+    return cube
+
+def parameters(start=start_day, end=start_day + timedelta(days=9), days_of_week=None, time_periods=None, modalities=None, cursor_key_type=int, **kwargs):
+    return query_od_parameters.prepare_query(start, end, days_of_week, time_periods, modalities, cursor_key_type=cursor_key_type, **kwargs)
+
+# The query of db.query_od written out row by row.
+def reference(table, h3_level, filter_on_origins, values, h3_resolution, data):
+    selected_periods = {
+        aggregation_period_id for aggregation_period_id, (day, hour) in enumerate(periods, 1)
+        if data.start_date <= day <= data.end_date
+        and (data.dont_filter_on_days_of_week or day.isoweekday() in data.days_of_week)
+        and (data.dont_filter_on_time_periods or hour in data.time_periods)
+    }
+    totals = {}
+    for origin, destination, aggregation_period_id, modality, trips in rows[(table, h3_level)]:
+        filtered, grouped = (origin, destination) if filter_on_origins else (destination, origin)
+        if table == "od_h3":
+            if not any(h3.h3_to_parent(filtered, h3.h3_get_resolution(value)) == value for value in values):
+                continue
+            grouped = h3.string_to_h3(h3.h3_to_parent(grouped, h3_resolution) if h3_resolution < h3_level else grouped)
+        elif filtered not in values:
+            continue
+        if aggregation_period_id not in selected_periods or not (data.dont_filter_on_modality or modality in data.modalities):
+            continue
+        totals[grouped] = totals.get(grouped, 0) + trips
+    result = sorted(((trips, key) for key, trips in totals.items() if trips >= data.min_trips), key=lambda item: (-item[0], item[1]))
+    if data.after is not None:
+        after_trips, after_key, _ = data.after
+        result = [(trips, key) for trips, key in result if trips < after_trips or (trips == after_trips and key > after_key)]
+    start = data.offset if data.after is None else 0
+    page_size = data.page_size()
+    return result[start:] if page_size is None else result[start:start + page_size]
+
+def query(cube, table, h3_level, filter_on_origins, values, h3_resolution, key, data):
+    if table == "od_h3":
+        values = [h3.string_to_h3(value) for value in values]
+    result = asyncio.run(cube.query(table, filter_on_origins, key, values, h3_level, h3_resolution, data))
+    return None if result is None else [(row["number_of_trips"], row[key]) for row in result]
+
+filters = [
+    {},
+    {"days_of_week": "mo,sa"},
+    {"time_periods": "6-10,22-2"},
+    {"modalities": "bicycle,scooter"},
+    {"days_of_week": "tu", "time_periods": "14-18", "modalities": "moped"},
+    {"start": start_day + timedelta(days=3), "end": start_day + timedelta(days=3)},
+    {"min_trips": 12},
+    {"top_k": 5},
+    {"limit": 4, "offset": 3}
+]
+
+@pytest.mark.parametrize("filter", filters)
+@pytest.mark.parametrize("h3_resolution, value_resolution", [(8, 8), (8, 6), (7, 7), (6, 6), (5, 6)])
+@pytest.mark.parametrize("filter_on_origins", [True, False])
+def test_h3_query(cube, filter, h3_resolution, value_resolution, filter_on_origins):
+    h3_level = max(h3_resolution, 7)
+    cells = origin_cells[8] if filter_on_origins else destination_cells[8]
+    values = sorted({h3.h3_to_parent(cell, value_resolution) for cell in cells[::7]})
+    data = parameters(**filter)
+    expected = reference("od_h3", h3_level, filter_on_origins, values, h3_resolution, data)
+    assert query(cube, "od_h3", h3_level, filter_on_origins, values, h3_resolution, "cell", data) == expected
+
+@pytest.mark.parametrize("filter", filters)
+@pytest.mark.parametrize("filter_on_origins", [True, False])
+def test_geometry_query(cube, filter, filter_on_origins):
+    values = stats_refs[5:10] if filter_on_origins else stats_refs[8:12]
+    data = parameters(cursor_key_type=str, **filter)
+    key = "destination_stat_ref" if filter_on_origins else "origin_stat_ref"
+    expected = reference("od_geometry", None, filter_on_origins, values, None, data)
+    assert query(cube, "od_geometry", None, filter_on_origins, values, None, key, data) == expected
+
+# Following next_cursor gives the complete result, in the same order and without duplicates.
+@pytest.mark.parametrize("table, h3_level, key, values, cursor_key_type", [
+    ("od_h3", 8, "cell", origin_cells[8][:20], int),
+    ("od_geometry", None, "destination_stat_ref", stats_refs[:10], str)
+])
+def test_keyset_pages(cube, table, h3_level, key, values, cursor_key_type):
+    expected = reference(table, h3_level, True, values, h3_level, parameters())
+    assert len(expected) > 12
+    pages = []
+    cursor = None
+    while True:
+        data = parameters(limit=6, cursor=cursor, cursor_key_type=cursor_key_type)
+        page = query(cube, table, h3_level, True, values, h3_level, key, data)
+        assert page == reference(table, h3_level, True, values, h3_level, data)
+        pages.extend(page)
+        cursor = data.next_cursor([{key: value, "number_of_trips": trips} for trips, value in page], key)
+        if cursor is None:
+            break
+    assert pages == expected
+
+# Periods that aren't in the cube are left to SQL.
+def test_periods_outside_the_cube(cube):
+    data = parameters(end=start_day + timedelta(days=10))
+    assert query(cube, "od_h3", 8, True, origin_cells[8][:5], 8, "cell", data) is None
+    assert query(cube, "od_h3", 8, True, origin_cells[8][:5], 8, "cell", parameters(group_by="date")) is None
@@ -0,0 +1,73 @@
+from datetime import date, timedelta
+import pytest
+import query_od_parameters
+import rollup
+from rollup import Source
+
+def plan(start: date, end: date, complete_until: date | None = date(2023, 3, 1), enabled: bool = True,
+        days_of_week=None, time_periods=None, modalities=None, group_by=None, monkeypatch=None):
+    monkeypatch.setattr(rollup, "enabled", enabled)
+    monkeypatch.setattr(rollup, "complete_until", complete_until)
+    data = query_od_parameters.prepare_query(start, end, days_of_week, time_periods, modalities, group_by=group_by)
+    return rollup.plan(data, start, end)
+
+D = date
+
+@pytest.mark.parametrize("start, end, kwargs, expected", [
+    # Disabled or never refreshed.
+    (D(2023, 1, 1), D(2023, 1, 31), {"enabled": False}, [Source("raw", D(2023, 1, 1), D(2023, 1, 31))]),
+    (D(2023, 1, 1), D(2023, 1, 31), {"complete_until": None}, [Source("raw", D(2023, 1, 1), D(2023, 1, 31))]),
+    # Whole months from the month rollup, the remaining days from the day rollup and the raw tables.
+    (D(2023, 1, 15), D(2023, 3, 1), {}, [
+        Source("day", D(2023, 1, 15), D(2023, 1, 31)),
+        Source("month", D(2023, 2, 1), D(2023, 2, 28)),
+        Source("raw", D(2023, 3, 1), D(2023, 3, 1))
+    ]),
+    (D(2023, 1, 1), D(2023, 1, 31), {}, [Source("month", D(2023, 1, 1), D(2023, 1, 31))]),
+    (D(2023, 1, 1), D(2023, 2, 20), {}, [
+        Source("month", D(2023, 1, 1), D(2023, 1, 31)),
+        Source("day", D(2023, 2, 1), D(2023, 2, 20))
+    ]),
+    (D(2023, 1, 10), D(2023, 1, 12), {}, [Source("day", D(2023, 1, 10), D(2023, 1, 12))]),
+    (D(2023, 12, 15), D(2024, 2, 29), {"complete_until": D(2024, 3, 1)}, [
+        Source("day", D(2023, 12, 15), D(2023, 12, 31)),
+        Source("month", D(2024, 1, 1), D(2024, 2, 29))
+    ]),
+    # A month that isn't completely rolled up yet.
+    (D(2023, 1, 1), D(2023, 2, 28), {"complete_until": D(2023, 2, 15)}, [
+        Source("month", D(2023, 1, 1), D(2023, 1, 31)),
+        Source("day", D(2023, 2, 1), D(2023, 2, 14)),
+        Source("raw", D(2023, 2, 15), D(2023, 2, 28))
+    ]),
+    (D(2023, 3, 1), D(2023, 3, 31), {}, [Source("raw", D(2023, 3, 1), D(2023, 3, 31))]),
+    # The month rollup has no day of week and time period, and only serves group_by modality.
+    (D(2023, 1, 15), D(2023, 3, 1), {"days_of_week": "mo,sa"}, [
+        Source("day", D(2023, 1, 15), D(2023, 2, 28)),
+        Source("raw", D(2023, 3, 1), D(2023, 3, 1))
+    ]),
+    (D(2023, 1, 1), D(2023, 2, 28), {"time_periods": "6-10"}, [Source("day", D(2023, 1, 1), D(2023, 2, 28))]),
+    (D(2023, 1, 1), D(2023, 2, 28), {"group_by": "time_period"}, [Source("day", D(2023, 1, 1), D(2023, 2, 28))]),
+    (D(2023, 1, 1), D(2023, 2, 28), {"group_by": "date"}, [Source("day", D(2023, 1, 1), D(2023, 2, 28))]),
+    (D(2023, 1, 1), D(2023, 2, 28), {"group_by": "modality", "modalities": "bicycle"}, [Source("month", D(2023, 1, 1), D(2023, 2, 28))]),
+])
+def test_plan(start, end, kwargs, expected, monkeypatch):
+    assert plan(start, end, monkeypatch=monkeypatch, **kwargs) == expected
+
+# Every day of the range is in exactly one source, rollups are only used for days before complete_until
+# and the month rollup only for whole months.
+@pytest.mark.parametrize("kwargs", [{}, {"days_of_week": "su"}, {"group_by": "isoweek"}])
+def test_plan_covers_every_day_once(kwargs, monkeypatch):
+    complete_until = D(2023, 4, 11)
+    first_days = [D(2023, 1, 1) + timedelta(days=offset) for offset in range(0, 130, 3)]
+    for start in first_days:
+        for end in [start + timedelta(days=length) for length in (0, 1, 27, 30, 31, 59, 100)]:
+            sources = plan(start, end, complete_until, monkeypatch=monkeypatch, **kwargs)
+            assert sources[0].start_date == start and sources[-1].end_date == end
+            for previous, source in zip(sources, sources[1:]):
+                assert source.start_date == previous.end_date + timedelta(days=1)
+            for source in sources:
+                assert source.start_date <= source.end_date
+                if source.granularity != "raw":
+                    assert source.end_date < complete_until
+                if source.granularity == "month":
+                    assert source.start_date.day == 1 and (source.end_date + timedelta(days=1)).day == 1
@@ -0,0 +1,162 @@
+from dataclasses import dataclass
+from fastapi import HTTPException
+from cache import TTLCache
+import numpy as np
+import functools
+import h3
+import h3_codec
+import json
+import mvt
+import metrics
+import db
+import os
+
+extent = 4096
+# Features are included when they are within this many tile units from the tile, so polygons don't end at tile borders.
+buffer = int(os.getenv("TILE_BUFFER", "64"))
+media_type = "application/vnd.mapbox-vector-tile"
+
+# Projected residential areas, keyed on ("stats_ref", stats_ref) and ("municipality", municipality).
+zone_cache = TTLCache(
+    max_size=int(os.getenv("TILE_ZONE_CACHE_MAX_SIZE", "100000")),
+    ttl=float(os.getenv("GEOMETRY_CACHE_TTL", "3600"))
+)
+
+@dataclass
+class Zone:
+    zone_id: int
+    municipality: str
+    stats_ref: str
+    # Rings in web mercator coordinates between 0 and 1, with the origin at the top left.
+    polygons: list[list[np.ndarray]]
+    bbox: np.ndarray
+
+MAX_LATITUDE = 85.0511287798
+
+def project(coordinates) -> np.ndarray:
+    coordinates = np.asarray(coordinates, dtype=np.float64)[:, :2]
+    lat = np.radians(np.clip(coordinates[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+    x = (coordinates[:, 0] + 180) / 360
+    y = 0.5 - np.log(np.tan(np.pi / 4 + lat / 2)) / (2 * np.pi)
+    return np.column_stack((x, y))
+
+def bbox(polygons: list[list[np.ndarray]]):
+    points = np.vstack([polygon[0] for polygon in polygons])
+    return np.concatenate((points.min(axis=0), points.max(axis=0)))
+
+def check_tile(z: int, x: int, y: int):
+    return 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+def in_tile(bbox: np.ndarray, z: int, x: int, y: int):
+    margin = buffer / extent
+    scaled = bbox * 2 ** z
+    return scaled[0] <= x + 1 + margin and scaled[2] >= x - margin and scaled[1] <= y + 1 + margin and scaled[3] >= y - margin
+
+def to_tile(polygons: list[list[np.ndarray]], z: int, x: int, y: int):
+    scale = 2 ** z * extent
+    offset = np.array([x, y], dtype=np.float64) * extent
+    return [[ring * scale - offset for ring in polygon] for polygon in polygons]
+
+@functools.lru_cache(maxsize=int(os.getenv("TILE_HEXAGON_CACHE_MAX_SIZE", "100000")))
+def hexagon(cell: int):
+    polygon = [project(h3.h3_to_geo_boundary(h3_codec.to_strings([cell])[0], geo_json=True))]
+    return polygon, bbox([polygon])
+
+def parse_zone(row):
+    geojson = json.loads(row["area"])
+    if geojson["type"] == "Polygon":
+        polygons = [geojson["coordinates"]]
+    elif geojson["type"] == "MultiPolygon":
+        polygons = geojson["coordinates"]
+    else:
+        polygons = []
+    polygons = [[project(ring) for ring in polygon] for polygon in polygons if len(polygon) > 0]
+    return Zone(
+        zone_id=row["zone_id"],
+        municipality=row["municipality"],
+        stats_ref=row["stats_ref"],
+        polygons=polygons,
+        bbox=bbox(polygons) if polygons else None
+    )
+
+def store_zones(rows):
+    zones = [parse_zone(row) for row in rows]
+    for zone in zones:
+        zone_cache.set(("stats_ref", zone.stats_ref), zone)
+    return zones
+
+async def get_zones_by_stats_refs(stats_refs: list[str]) -> list[Zone]:
+    zones = {stats_ref: zone_cache.get(("stats_ref", stats_ref)) for stats_ref in stats_refs}
+    missing = [stats_ref for stats_ref, zone in zones.items() if zone is None]
+    if len(missing) > 0:
+        rows = await db.get_geometries_with_geojson(missing)
+        if rows is None:
+            raise HTTPException(500, "geometries could not be loaded")
+        for zone in store_zones(rows):
+            zones[zone.stats_ref] = zone
+    return [zone for zone in zones.values() if zone is not None]
+
+async def get_zones_by_municipalities(municipalities: list[str]) -> list[Zone]:
+    zones = {municipality: zone_cache.get(("municipality", municipality)) for municipality in municipalities}
+    missing = [municipality for municipality, municipality_zones in zones.items() if municipality_zones is None]
+    if len(missing) > 0:
+        rows = await db.get_accessible_geometries_with_geojson(missing)
+        if rows is None:
+            raise HTTPException(500, "geometries could not be loaded")
+        for municipality in missing:
+            zones[municipality] = []
+        for zone in store_zones(rows):
+            zones[zone.municipality].append(zone)
+        for municipality in missing:
+            zone_cache.set(("municipality", municipality), zones[municipality])
+    return [zone for municipality_zones in zones.values() for zone in municipality_zones]
+
+@metrics.timed("serialize.mvt")
+def h3_layer(name: str, cells, number_of_trips, z: int, x: int, y: int):
+    features = []
+    strings = h3_codec.to_strings(cells)
+    for cell, cell_string, trips in zip(h3_codec.to_array(cells).tolist(), strings, number_of_trips):
+        polygon, cell_bbox = hexagon(cell)
+        if not in_tile(cell_bbox, z, x, y):
+            continue
+        features.append(mvt.Feature(
+            id=cell,
+            properties={"cell": cell_string, "number_of_trips": trips},
+            polygons=to_tile([polygon], z, x, y)
+        ))
+    return mvt.encode_layer(name, features, extent)
+
+@metrics.timed("serialize.mvt")
+def zone_layer(name: str, zones: list[Zone], number_of_trips: dict | None, z: int, x: int, y: int):
+    features = []
+    for zone in zones:
+        if zone.bbox is None or not in_tile(zone.bbox, z, x, y):
+            continue
+        features.append(mvt.Feature(
+            id=zone.zone_id,
+            properties={
+                "zone_id": zone.zone_id,
+                "stats_ref": zone.stats_ref,
+                "municipality_code": zone.municipality,
+                "number_of_trips": None if number_of_trips is None else number_of_trips.get(zone.stats_ref)
+            },
+            polygons=to_tile(zone.polygons, z, x, y)
+        ))
+    return mvt.encode_layer(name, features, extent)
+
+def od_h3_tile(name: str, result, z: int, x: int, y: int):
+    cells = [row["cell"] for row in result]
+    number_of_trips = [int(row["number_of_trips"]) for row in result]
+    return mvt.encode_tile([h3_layer(name, cells, number_of_trips, z, x, y)])
+
+async def od_geometry_tile(name: str, result, key: str, z: int, x: int, y: int):
+    number_of_trips = {row[key]: int(row["number_of_trips"]) for row in result}
+    zones = await get_zones_by_stats_refs(list(number_of_trips))
+    return mvt.encode_tile([zone_layer(name, zones, number_of_trips, z, x, y)])
+
+def accessible_h3_tile(cells, z: int, x: int, y: int):
+    return mvt.encode_tile([h3_layer("accessible_h3", cells, [None] * len(cells), z, x, y)])
+
+async def accessible_geometry_tile(municipalities: list[str], z: int, x: int, y: int):
+    zones = await get_zones_by_municipalities(sorted(municipalities))
+    return mvt.encode_tile([zone_layer("accessible_geometry", zones, None, z, x, y)])